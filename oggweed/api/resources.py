@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2013 OggWeed LLC
+#
+from __future__ import unicode_literals
+import os
+import json
+from hashlib import sha1
+
+from flask import Response, request
+from oggweed import settings
+from oggweed.framework.http import (
+    JSONResource,
+    JSONNotFound,
+    set_cors_into_headers,
+)
+from oggweed.web.models import Song
+
+
+def strip_folder(path):
+    """Keeps only the file name of a path of the web or worker hosts"""
+    return os.path.basename(path or '') or None
+
+
+class SongResource(JSONResource):
+    """Serves the songs as json.
+
+    The ETag is the hash of the record stored in redis, so a client
+    that already has the current version gets a 304 without the song
+    being parsed nor serialized. Finalized songs never change, caches
+    can keep them for `settings.SONG_API_MAX_AGE` seconds.
+    """
+    def get_cache_control(self, finalized):
+        if finalized:
+            return 'public, max-age={0}'.format(settings.SONG_API_MAX_AGE)
+
+        # the song is still being converted, caches must revalidate
+        return 'no-cache'
+
+    def get_representation(self, raw):
+        data = Song(**json.loads(raw)).as_dict()
+        # the path in the upload folder of the web server
+        data['filename'] = strip_folder(data['filename'])
+
+        # and the paths of the converted files on the worker
+        metadata = data['metadata'] or {}
+        if 'final_path' in metadata:
+            metadata['final_path'] = strip_folder(metadata['final_path'])
+
+        for rendition in (metadata.get('renditions') or {}).values():
+            if 'final_path' in rendition:
+                rendition['final_path'] = strip_folder(rendition['final_path'])
+
+        return data
+
+    def get(self, token):
+        raw, finalized = Song.get_record(token)
+        if raw is None:
+            return JSONNotFound('song not found').as_response()
+
+        etag = sha1(raw).hexdigest()
+        headers = {
+            'ETag': '"{0}"'.format(etag),
+            'Cache-Control': self.get_cache_control(finalized),
+        }
+        if etag in request.if_none_match:
+            set_cors_into_headers(headers, allow_origin='*')
+            return Response(status=304, headers=headers)
+
+        return self.get_representation(raw), 200, headers
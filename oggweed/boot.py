@@ -21,6 +21,9 @@ from oggweed.framework.commands.core import (
     RunServer,
     Shell,
     RunWorker,
+    ListWorkers,
+    PipelineReport,
+    BuildStatic,
 )
 
 # Importing db commands
@@ -45,6 +48,9 @@ application.enable_commands([
     ('run', RunServer(application)),
     ('shell', Shell(application)),
     ('converter-pipeline', RunWorker(application)),
+    ('workers', ListWorkers(application)),
+    ('pipeline-report', PipelineReport(application)),
+    ('build-static', BuildStatic(application)),
 
     # DB commands
     ('db', CreateDB(application)),
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import os
+import json
+import time
+import socket
+import logging
+
+from oggweed import settings
+from oggweed.framework.db import get_redis_connection
+
+log = logging.getLogger('oggweed:coordination')
+
+
+def get_node_id():
+    """Identifies this worker process across the cluster"""
+    return settings.WORKER_NODE_ID or '{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+
+class WorkerRegistry(object):
+    """Every worker process advertises itself in redis with its
+    capacity and how many slots are busy. A node whose heartbeat is
+    older than `ttl` seconds is considered dead."""
+    key = 'workers'
+
+    def __init__(self, redis=None, node=None, ttl=None):
+        self.redis = redis or get_redis_connection()
+        self.node = node or get_node_id()
+        self.ttl = ttl or settings.WORKER_HEARTBEAT_INTERVAL * 3
+
+    def make_key(self, node):
+        return 'workers:{0}'.format(node)
+
+    def heartbeat(self, capacity, busy, now=None):
+        now = time.time() if now is None else now
+        key = self.make_key(self.node)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hmset(key, {
+            'node': self.node,
+            'capacity': capacity,
+            'busy': busy,
+            'heartbeat_at': now,
+        })
+        pipe.expire(key, int(self.ttl))
+        pipe.zadd(self.key, now, self.node)
+        pipe.execute()
+
+    def nodes(self, now=None):
+        """Returns the live nodes with their capacity and the tokens
+        of the songs they hold a lease on"""
+        now = time.time() if now is None else now
+        self.redis.zremrangebyscore(self.key, '-inf', now - self.ttl)
+        names = self.redis.zrange(self.key, 0, -1)
+
+        pipe = self.redis.pipeline(transaction=False)
+        for name in names:
+            pipe.hgetall(self.make_key(name))
+            pipe.smembers(JobLeases.make_owned_key(name))
+        replies = pipe.execute()
+
+        nodes = []
+        for name, info, tokens in zip(names, replies[::2], replies[1::2]):
+            if not info:
+                continue
+
+            nodes.append({
+                'node': name,
+                'capacity': int(info.get('capacity', 0)),
+                'busy': int(info.get('busy', 0)),
+                'heartbeat_at': float(info.get('heartbeat_at', 0)),
+                'leases': sorted(tokens),
+            })
+
+        return nodes
+
+
+class JobLeases(object):
+    """Tracks which node is working on each song.
+
+    A lease lasts `visibility_timeout` seconds and the node that owns
+    it renews it on every heartbeat. Whichever node processes a song
+    claims its lease, so when a node dies its leases expire and any
+    other node delivers the songs again, from the instructions saved
+    at the last claim, so they resume at their last checkpoint.
+    """
+    key = 'leases:songs'
+    payloads_key = 'leases:songs:payloads'
+    owners_key = 'leases:songs:owners'
+
+    def __init__(self, redis=None, node=None, visibility_timeout=None):
+        self.redis = redis or get_redis_connection()
+        self.node = node or get_node_id()
+        self.visibility_timeout = visibility_timeout or settings.LEASE_VISIBILITY_TIMEOUT
+
+    @classmethod
+    def make_owned_key(cls, node):
+        return 'workers:{0}:leases'.format(node)
+
+    def get_deadline(self, now=None):
+        return (time.time() if now is None else now) + self.visibility_timeout
+
+    def acquire(self, job, now=None):
+        job['leased'] = True
+        token = job['token']
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.zadd(self.key, self.get_deadline(now), token)
+        pipe.hset(self.payloads_key, token, json.dumps(job))
+        pipe.hset(self.owners_key, token, self.node)
+        pipe.sadd(self.make_owned_key(self.node), token)
+        pipe.execute()
+        return job
+
+    def claim(self, instructions, now=None):
+        """Moves the lease of a song to this node and saves its latest
+        instructions. Returns False for songs without a lease"""
+        if not instructions.get('leased'):
+            return False
+
+        token = instructions['token']
+        previous = self.redis.hget(self.owners_key, token)
+        if previous is None:
+            # released or delivered again in the meantime
+            return False
+
+        payload = dict(instructions)
+        payload.pop('__lineup__error__', None)
+
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.srem(self.make_owned_key(previous), token)
+        pipe.sadd(self.make_owned_key(self.node), token)
+        pipe.hset(self.owners_key, token, self.node)
+        pipe.hset(self.payloads_key, token, json.dumps(payload))
+        pipe.zadd(self.key, self.get_deadline(now), token)
+        pipe.execute()
+        return True
+
+    def renew(self, now=None):
+        """Extends every lease owned by this node, forgetting the ones
+        that were released"""
+        owned_key = self.make_owned_key(self.node)
+        tokens = list(self.redis.smembers(owned_key))
+        if not tokens:
+            return []
+
+        pipe = self.redis.pipeline(transaction=False)
+        for token in tokens:
+            pipe.zscore(self.key, token)
+        scores = pipe.execute()
+
+        deadline = self.get_deadline(now)
+        renewed = []
+        for token, score in zip(tokens, scores):
+            if score is None:
+                pipe.srem(owned_key, token)
+            else:
+                pipe.zadd(self.key, deadline, token)
+                renewed.append(token)
+        pipe.execute()
+        return renewed
+
+    def release_many(self, tokens):
+        """Drops the leases of finished songs, their owners forget them
+        on their next `renew`"""
+        if not tokens:
+            return
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zrem(self.key, *tokens)
+        pipe.hdel(self.payloads_key, *tokens)
+        pipe.hdel(self.owners_key, *tokens)
+        pipe.execute()
+
+    def release(self, token):
+        self.release_many([token])
+
+    def redeliver_expired(self, scheduler, now=None):
+        """Hands the songs whose lease expired back to the scheduler.
+        Safe to call from every node: only the one whose ZREM removed
+        the token delivers it"""
+        now = time.time() if now is None else now
+        jobs = []
+        for token in self.redis.zrangebyscore(self.key, '-inf', now):
+            pipe = self.redis.pipeline(transaction=True)
+            pipe.zrem(self.key, token)
+            pipe.hget(self.payloads_key, token)
+            pipe.hget(self.owners_key, token)
+            pipe.hdel(self.payloads_key, token)
+            pipe.hdel(self.owners_key, token)
+            removed, raw, owner, _, _ = pipe.execute()
+            if not removed or not raw:
+                continue
+
+            if owner:
+                self.redis.srem(self.make_owned_key(owner), token)
+
+            job = json.loads(raw)
+            job.pop('leased', None)
+            job['deliveries'] = job.get('deliveries', 1) + 1
+            log.warning("lease of %s held by %s expired, delivering it again",
+                        token, owner)
+            scheduler.push_again(job)
+            jobs.append(job)
+
+        return jobs
+
+
+def heartbeat_forever(registry, leases, slots, scheduler):
+    """Advertises this node, renews its leases and delivers the songs
+    of dead nodes again, every `settings.WORKER_HEARTBEAT_INTERVAL`"""
+    while True:
+        try:
+            registry.heartbeat(slots.size, slots.busy)
+            leases.renew()
+            leases.redeliver_expired(scheduler)
+        except Exception:
+            log.exception("worker heartbeat failed")
+
+        time.sleep(settings.WORKER_HEARTBEAT_INTERVAL)
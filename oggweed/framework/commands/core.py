@@ -13,12 +13,23 @@ Contains commands for managing the http server in the local environment
 
 import sys
 import logging
+import threading
 
-from flask.ext.script import Command
+from flask.ext.script import Command, Option
 from werkzeug.serving import run_simple
 
 from lineup.backends.redis import JSONRedisBackend
-from oggweed.workers import OggPipeline
+from oggweed import settings
+from oggweed.workers import (
+    get_pipeline_class,
+    get_conversion_slots,
+    RetryQueue,
+)
+from oggweed.scheduling import SongScheduler
+from oggweed.staging import StagingArea
+from oggweed.coordination import WorkerRegistry, JobLeases, heartbeat_forever
+from oggweed.metrics import StepMetrics
+from oggweed.framework.http.assets import StaticBuilder
 
 
 class RunServer(Command):  # pragma: no cover
@@ -57,12 +68,122 @@ class Shell(Command):  # pragma: no cover
 
 
 class RunWorker(Command):
+    option_list = (
+        Option('-s', '--slots', dest='slots', type=int,
+               default=settings.CONVERSION_SLOTS,
+               help='how many songs are converted at the same time'),
+    )
+
     def __init__(self, application):
         self.application = application
 
-    def run(self):
-        pipeline = OggPipeline(JSONRedisBackend)
+    def run(self, slots):
+        settings.CONVERSION_SLOTS = slots
+        Pipeline = get_pipeline_class()
+        pipeline = Pipeline(JSONRedisBackend)
         pipeline._start()
+
+        slots = get_conversion_slots()
+        scheduler = SongScheduler()
+        feeder = threading.Thread(
+            target=scheduler.feed_forever,
+            args=(pipeline.input, slots))
+        feeder.daemon = True
+        feeder.start()
+
+        heartbeat = threading.Thread(
+            target=heartbeat_forever,
+            args=(WorkerRegistry(), JobLeases(), slots, scheduler))
+        heartbeat.daemon = True
+        heartbeat.start()
+
+        retries = threading.Thread(
+            target=RetryQueue().pump_forever,
+            args=(scheduler, ))
+        retries.daemon = True
+        retries.start()
+
+        eviction = threading.Thread(target=StagingArea().evict_forever)
+        eviction.daemon = True
+        eviction.start()
+
         while pipeline.is_running():
             result = pipeline.output.get(wait=True)
             pprint.pprint(result)
+
+
+class ListWorkers(Command):
+    """Shows the live worker nodes, their free slots and the songs
+    they hold a lease on"""
+
+    def __init__(self, application):
+        self.application = application
+
+    def run(self):
+        nodes = WorkerRegistry().nodes()
+        for node in nodes:
+            sys.stdout.write("{node}  {busy}/{capacity} busy  {count} leases\n".format(
+                count=len(node['leases']), **node))
+            for token in node['leases']:
+                sys.stdout.write("    {0}\n".format(token))
+
+        sys.stdout.write("{0} nodes, {1} free slots\n".format(
+            len(nodes), sum(n['capacity'] - n['busy'] for n in nodes)))
+
+
+class PipelineReport(Command):
+    """Shows p50/p95/p99 of how long songs waited in the queues, ran
+    ffmpeg and uploaded to the storage, and how many each step finished per
+    minute"""
+    option_list = (
+        Option('-m', '--minutes', dest='minutes', type=int, default=15,
+               help='how many of the last minutes are covered'),
+    )
+    metrics = ('queue_wait', 'slot_wait', 'ffmpeg', 'upload', 'processing')
+
+    def __init__(self, application):
+        self.application = application
+
+    def format_seconds(self, seconds):
+        if seconds is None:
+            return '-'
+
+        return '{0:.2f}s'.format(seconds)
+
+    def run(self, minutes):
+        report = StepMetrics().report(minutes)
+        sys.stdout.write("last {0} minutes\n".format(minutes))
+        for step in sorted(report):
+            step_metrics = report[step]
+            processed = step_metrics.get('processing', {})
+            sys.stdout.write("{0}  {1:.1f} songs/min\n".format(
+                step, processed.get('per_minute', 0)))
+
+            for metric in self.metrics:
+                if metric not in step_metrics:
+                    continue
+
+                stats = step_metrics[metric]
+                sys.stdout.write("    {0:<12} p50 {1:>9} p95 {2:>9} p99 {3:>9}  ({4} songs)\n".format(
+                    metric,
+                    self.format_seconds(stats['p50']),
+                    self.format_seconds(stats['p95']),
+                    self.format_seconds(stats['p99']),
+                    stats['count']))
+
+
+class BuildStatic(Command):
+    """Writes the static files under fingerprinted names with their
+    `.gz` siblings and the manifest that `static_url` resolves through"""
+    option_list = (
+        Option('-o', '--output', dest='output', default=settings.STATIC_BUILD_ROOT,
+               help='the folder served at settings.STATIC_BUILD_URL'),
+    )
+
+    def __init__(self, application):
+        self.application = application
+
+    def run(self, output):
+        source = self.application.flask_app.static_folder
+        manifest = StaticBuilder(source, output).build()
+        sys.stdout.write("{0} static files written to {1}\n".format(len(manifest), output))
@@ -11,6 +11,7 @@ import sys
 # 3rd party stuff
 from flask import Flask, render_template
 from flask.ext.script import Manager
+from flask.ext.restful import Api
 
 # our stuff
 from oggweed import settings
@@ -18,6 +19,7 @@ from oggweed import settings
 from . import log
 from .http.assets import AssetsManager
 from .http.sessions import RedisSessionInterface
+from .http.uploads import StreamingUploadRequest
 
 
 class Application(object):
@@ -34,6 +36,7 @@ class Application(object):
 
     def __init__(self, settings_path='oggweed.settings', *args, **kwargs):
         self.assets = None
+        self.api = None
         self.commands_manager = None
         self.flask_app = Flask(__name__, *args, **kwargs)
         self.flask_app.config.from_object(settings_path)
@@ -62,6 +65,11 @@ class Application(object):
         """Uses redis as session interface"""
         self.flask_app.session_interface = session_interface or RedisSessionInterface()
 
+    def enable_streaming_uploads(self, request_class=StreamingUploadRequest):
+        """Uploaded files get written to the staging folder while the
+        request body is parsed, instead of being spooled first"""
+        self.flask_app.request_class = request_class
+
     def enable_assets(self):
         """Enable support to WebAssets:
         http://elsdoerfer.name/docs/flask-assets/
@@ -70,6 +78,13 @@ class Application(object):
         # Loading our JS/CSS
         self.assets.create_bundles()
 
+    def enable_api(self, resources, prefix='/api'):
+        """Takes a list of 2-item tuples containing a url rule and the
+        `JSONResource` that serves it under the given prefix"""
+        self.api = Api(self.flask_app, prefix=prefix)
+        for url, resource in resources:
+            self.api.add_resource(resource, url)
+
     def enable_commands(self, commands):
         """Takes a list of 2-item tuples containing a command label
         for the shell and the command instance.
@@ -6,6 +6,7 @@ from __future__ import unicode_literals
 import __builtin__
 
 import inspect
+import threading
 import dateutil.parser
 import datetime
 from functools import partial
@@ -13,6 +14,7 @@ from decimal import Decimal
 
 from flask import current_app
 from redis import StrictRedis
+from redis.connection import BlockingConnectionPool
 from oggweed import settings
 from oggweed.framework.formats import json
 from flask.ext.sqlalchemy import SQLAlchemy
@@ -26,20 +28,97 @@ engine = create_engine(settings.SQLALCHEMY_DATABASE_URI)
 metadata = MetaData()
 
 
-def get_redis_connection(db=0):
-    """This function knows how to return a new `redis.StrictRedis`
-    instance with the redis credentials from settings"""
+class RedisConnectionPool(BlockingConnectionPool):
+    """A thread-safe pool of redis connections that keeps count of
+    how many connections it created, how many are in use and how many
+    times a caller had to wait for one.
+
+    The pool is re-created after a fork, so pre-fork gunicorn workers
+    never share sockets with their parent.
+    """
+    def __init__(self, *args, **kw):
+        super(RedisConnectionPool, self).__init__(*args, **kw)
+        self.stats_lock = threading.Lock()
+        self.in_use = 0
+        self.waits = 0
+
+    def get_connection(self, *args, **kw):
+        if self.pool.empty():
+            with self.stats_lock:
+                self.waits += 1
+
+        connection = super(RedisConnectionPool, self).get_connection(*args, **kw)
+        with self.stats_lock:
+            self.in_use += 1
+
+        return connection
+
+    def release(self, connection):
+        super(RedisConnectionPool, self).release(connection)
+        with self.stats_lock:
+            self.in_use = max(self.in_use - 1, 0)
+
+    def stats(self):
+        return {
+            'created': len(self._connections),
+            'in_use': self.in_use,
+            'waits': self.waits,
+            'max_connections': self.max_connections,
+        }
+
+
+redis_pools = {}
+redis_pools_lock = threading.Lock()
+
+
+def get_redis_pool(db=0):
+    """Returns the connection pool of this process for the given
+    redis database, creating it in the first call"""
     conf = settings.REDIS_URI
+    key = (conf.host, conf.port, db)
 
-    return StrictRedis(
-        db=db,
-        host=conf.host,
-        port=conf.port,
+    with redis_pools_lock:
+        if key not in redis_pools:
+            redis_pools[key] = RedisConnectionPool(
+                max_connections=settings.REDIS_MAX_CONNECTIONS,
+                timeout=settings.REDIS_POOL_TIMEOUT,
+                socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+                db=db,
+                host=conf.host,
+                port=conf.port,
 
-        # using `path` as password to support the URI like:
-        # redis://hostname:port/veryverylongpasswordhashireallymeanSHA512
-        password=conf.path,
-    )
+                # using `path` as password to support the URI like:
+                # redis://hostname:port/veryverylongpasswordhashireallymeanSHA512
+                password=conf.path,
+            )
+
+        return redis_pools[key]
+
+
+def get_redis_pool_stats():
+    """Returns the stats of every pool, keyed by `host:port/db`"""
+    with redis_pools_lock:
+        pools = redis_pools.items()
+
+    return dict(("{0}:{1}/{2}".format(*key), pool.stats())
+                for key, pool in pools)
+
+
+def get_redis_connection(db=0):
+    """This function knows how to return a `redis.StrictRedis`
+    instance with the redis credentials from settings, all the
+    instances of a process share the connection pool of `db`"""
+    return StrictRedis(connection_pool=get_redis_pool(db))
+
+
+def get_redis_pubsub(db=0):
+    """Returns a `PubSub` on a connection of its own: subscribers wait
+    for messages indefinitely, so they never take a connection of the
+    shared pool nor use its socket timeout"""
+    conf = settings.REDIS_URI
+    redis = StrictRedis(host=conf.host, port=conf.port, db=db,
+                        password=conf.path)
+    return redis.pubsub()
 
 
 class ORM(type):
@@ -4,13 +4,45 @@
 #
 from __future__ import unicode_literals
 
+import os
+import re
+import gzip
+import json
+import hashlib
+import threading
+import posixpath
+from io import BytesIO
+
 from flask.ext.assets import (
     Environment,
     Bundle,
     ManageAssets,
 )
+from oggweed import settings
+
+__all__ = ['AssetsManager', 'StaticBuilder', 'static_url']
+
+# worth compressing, the woff fonts and the images are compressed already
+COMPRESSIBLE_EXTENSIONS = ('.js', '.css', '.map', '.json', '.svg', '.eot', '.ttf', '.txt')
+CSS_URL_REGEX = re.compile(r'''url\(\s*(['"]?)([^'")]+?)\1\s*\)''')
+
+
+def get_fingerprinted_name(name, data):
+    """`js/oggweed.js` becomes `js/oggweed.<hash>.js`, the hash being
+    the first 12 hex digits of the md5 of the content"""
+    base, extension = posixpath.splitext(name)
+    return '{0}.{1}{2}'.format(base, hashlib.md5(data).hexdigest()[:12], extension)
 
-__all__ = ['AssetsManager']
+
+def gzip_data(data):
+    """Compresses without name nor timestamp, so that building the same
+    files twice writes the same bytes"""
+    output = BytesIO()
+    with gzip.GzipFile(filename='', mode='wb', fileobj=output,
+                       compresslevel=9, mtime=0) as compressed:
+        compressed.write(data)
+
+    return output.getvalue()
 
 
 # disabling test coverage here for now because we don't need assets yet.
@@ -44,3 +76,112 @@ class AssetsManager(object): # pragma: no cover
         """Create the `assets` command in Flask-Script
         """
         manager.add_command('assets', ManageAssets(self.env))
+
+
+class StaticBuilder(object):
+    """Copies the static files to `destination` under names that carry
+    a hash of their content, with a `.gz` sibling when compressing
+    shrinks them, and writes a manifest of the original names to the
+    fingerprinted ones.
+
+    The stylesheets go last: their `url()` references to the other
+    files are rewritten to the fingerprinted names before they are
+    hashed, so a new font also renames the css that uses it.
+    """
+    manifest_name = 'manifest.json'
+
+    def __init__(self, source, destination):
+        self.source = source
+        self.destination = destination
+
+    def find_files(self):
+        for folder, subfolders, filenames in os.walk(self.source):
+            subfolders[:] = [name for name in subfolders if not name.startswith('.')]
+            for filename in filenames:
+                if filename.startswith('.'):
+                    continue
+
+                path = os.path.relpath(os.path.join(folder, filename), self.source)
+                yield path.replace(os.sep, '/')
+
+    def rewrite_css(self, name, data, manifest):
+        folder = posixpath.dirname(name)
+
+        def replace(match):
+            quote, url = match.groups()
+            # keeps the query and fragment of `font.eot?#iefix`
+            path, separator, suffix = (re.split(r'([?#])', url, 1) + ['', ''])[:3]
+            target = posixpath.normpath(posixpath.join(folder, path))
+            if ':' in url or url.startswith('/') or target not in manifest:
+                return match.group(0)
+
+            fingerprinted = posixpath.relpath(manifest[target], folder or '.')
+            return 'url({0}{1}{2}{3}{0})'.format(quote, fingerprinted, separator, suffix)
+
+        # latin-1 maps every byte, the rest of the file is kept as is
+        return CSS_URL_REGEX.sub(replace, data.decode('latin-1')).encode('latin-1')
+
+    def write(self, name, data):
+        path = os.path.join(self.destination, name)
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        with open(path, 'wb') as output:
+            output.write(data)
+
+        if name.endswith(COMPRESSIBLE_EXTENSIONS):
+            compressed = gzip_data(data)
+            if len(compressed) < len(data):
+                with open(path + '.gz', 'wb') as output:
+                    output.write(compressed)
+
+    def build(self):
+        """Writes the files and the manifest, returns the manifest"""
+        manifest = {}
+        names = sorted(self.find_files(), key=lambda name: (name.endswith('.css'), name))
+        for name in names:
+            with open(os.path.join(self.source, name), 'rb') as source:
+                data = source.read()
+
+            if name.endswith('.css'):
+                data = self.rewrite_css(name, data, manifest)
+
+            manifest[name] = get_fingerprinted_name(name, data)
+            self.write(manifest[name], data)
+
+        path = os.path.join(self.destination, self.manifest_name)
+        with open(path, 'wb') as output:
+            output.write(json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+
+        return manifest
+
+
+static_manifest = None
+static_manifest_lock = threading.Lock()
+
+
+def get_static_manifest():
+    """The manifest of `settings.STATIC_MANIFEST`, read once per
+    process. Without a build the static files keep their names"""
+    global static_manifest
+    with static_manifest_lock:
+        if static_manifest is None:
+            try:
+                with open(settings.STATIC_MANIFEST, 'rb') as manifest:
+                    static_manifest = json.loads(manifest.read().decode('utf-8'))
+            except IOError:
+                static_manifest = {}
+
+        return static_manifest
+
+
+def static_url(path):
+    """Returns the url of a static file, its fingerprinted version when
+    the static build has one"""
+    path = path.lstrip('/')
+    fingerprinted = get_static_manifest().get(path)
+    if fingerprinted:
+        return "{0}/{1}".format(settings.STATIC_BUILD_URL.rstrip('/'), fingerprinted)
+
+    return "{0}/{1}".format(settings.STATIC_BASE_URL.rstrip('/'), path)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# <Copyright 2013 - OggWeed LLC>
+from __future__ import unicode_literals
+
+import os
+import mimetypes
+from datetime import datetime
+
+from flask import Response, request, current_app
+from werkzeug.wsgi import wrap_file
+
+
+def get_etag(stat):
+    return '{0:x}-{1:x}-{2:x}'.format(stat.st_ino, int(stat.st_mtime), stat.st_size)
+
+
+def read_range(path, start, length, chunk_size):
+    """Yields `length` bytes of the file from `start`"""
+    with open(path, 'rb') as source:
+        source.seek(start)
+        while length > 0:
+            chunk = source.read(min(chunk_size, length))
+            if not chunk:
+                break
+
+            length -= len(chunk)
+            yield chunk
+
+
+def is_range_allowed(etag):
+    """A range only applies when the `If-Range` validator, if any,
+    still matches. Dates are not trusted, the whole file is sent"""
+    if_range = request.if_range
+    if if_range.date is not None:
+        return False
+
+    return if_range.etag is None or if_range.etag == etag
+
+
+def send_file_range(path, mimetype, max_age=3600, chunk_size=64 * 1024):
+    """Serves a local file with support for conditional and range
+    requests, so that a player seeking in a song only downloads the
+    bytes it needs.
+
+    Whole files go through `X-Sendfile` when `USE_X_SENDFILE` is
+    enabled, the front server then handles the ranges itself, or
+    through `wsgi.file_wrapper`, which lets the wsgi server use
+    `sendfile(2)`. Partial responses are read in `chunk_size` bytes.
+    """
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = get_etag(stat)
+
+    def finish(response):
+        response.set_etag(etag)
+        response.last_modified = datetime.utcfromtimestamp(int(stat.st_mtime))
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+        response.headers['Accept-Ranges'] = 'bytes'
+        return response
+
+    if etag in request.if_none_match:
+        return finish(Response(status=304))
+
+    if current_app.use_x_sendfile:
+        response = Response(mimetype=mimetype, headers={'X-Sendfile': path})
+        response.content_length = size
+        return finish(response)
+
+    byte_range = request.range
+    if byte_range and is_range_allowed(etag):
+        bounds = byte_range.range_for_length(size)
+        if bounds is None and len(byte_range.ranges) == 1:
+            response = Response(status=416)
+            response.headers['Content-Range'] = 'bytes */{0}'.format(size)
+            return finish(response)
+
+        if bounds is not None:
+            start, stop = bounds
+            response = Response(read_range(path, start, stop - start, chunk_size),
+                                status=206, mimetype=mimetype, direct_passthrough=True)
+            response.headers['Content-Range'] = 'bytes {0}-{1}/{2}'.format(
+                start, stop - 1, size)
+            response.content_length = stop - start
+            return finish(response)
+
+    data = wrap_file(request.environ, open(path, 'rb'), buffer_size=chunk_size)
+    response = Response(data, mimetype=mimetype, direct_passthrough=True)
+    response.content_length = size
+    return finish(response)
+
+
+def send_asset(path, max_age=60 * 60 * 24 * 365):
+    """Serves a fingerprinted static file, see
+    `oggweed.framework.http.assets.StaticBuilder`. Its name changes
+    with its content, so browsers keep it without revalidating.
+
+    The precompressed `.gz` sibling is sent to the clients that accept
+    gzip.
+    """
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    compressed = path + '.gz'
+    gzipped = request.accept_encodings.quality('gzip') > 0 and os.path.isfile(compressed)
+
+    response = send_file_range(gzipped and compressed or path, mimetype, max_age=max_age)
+    if gzipped and response.status_code != 304:
+        response.headers['Content-Encoding'] = 'gzip'
+
+    response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = 'public, max-age={0}, immutable'.format(max_age)
+    return response
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# <Copyright 2013 - OggWeed LLC>
+from __future__ import unicode_literals
+
+import io
+import os
+import errno
+import tempfile
+from hashlib import sha1
+
+from flask import Request
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from oggweed import settings
+
+
+class StagedUpload(object):
+    """A file-like object that werkzeug writes an uploaded file into
+    while it parses the request body.
+
+    The bytes go straight to a hidden file in the staging folder,
+    through a buffer of `chunk_size` bytes, while their sha1 and
+    count are computed. `move_to` then just renames the file, so the
+    upload is written to the disk exactly once.
+    """
+
+    def __init__(self, folder, max_size=None, chunk_size=None):
+        self.max_size = max_size
+        self.size = 0
+        self.sha1 = sha1()
+        self.moved = False
+
+        fd, self.path = tempfile.mkstemp(dir=folder, prefix='.upload-')
+        os.close(fd)
+        self.file = io.open(self.path, 'w+b', buffering=chunk_size or -1)
+
+    def write(self, data):
+        try:
+            self.size += len(data)
+            if self.max_size and self.size > self.max_size:
+                raise RequestEntityTooLarge()
+
+            self.sha1.update(data)
+            return self.file.write(data)
+        except Exception:
+            # werkzeug drops the stream when parsing fails
+            self.close()
+            raise
+
+    def hexdigest(self):
+        return self.sha1.hexdigest()
+
+    def move_to(self, destination):
+        self.file.close()
+        os.rename(self.path, destination)
+        self.path = destination
+        self.moved = True
+
+    def close(self):
+        """Deletes the staged file unless it was moved to its
+        destination"""
+        self.file.close()
+        if not self.moved and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __getattr__(self, name):
+        # seek, tell, read, etc.
+        return getattr(self.file, name)
+
+
+class StreamingUploadRequest(Request):
+    """Writes uploaded files straight to `settings.UPLOAD_PATH` instead
+    of spooling them to a temporary file that then gets copied"""
+
+    def __init__(self, *args, **kw):
+        super(StreamingUploadRequest, self).__init__(*args, **kw)
+        self.staged_uploads = []
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        if not filename:
+            return super(StreamingUploadRequest, self)._get_file_stream(
+                total_content_length, content_type, filename, content_length)
+
+        staged = StagedUpload(
+            settings.UPLOAD_PATH,
+            max_size=settings.MAX_UPLOAD_SIZE,
+            chunk_size=settings.UPLOAD_CHUNK_SIZE)
+        self.staged_uploads.append(staged)
+        return staged
+
+    def close(self):
+        """Also deletes the staged files that were not moved to their
+        destination, werkzeug never sees the files of a body that
+        failed to parse"""
+        try:
+            super(StreamingUploadRequest, self).close()
+        finally:
+            for staged in self.staged_uploads:
+                staged.close()
+
+
+def make_folder(folder):
+    """Creates `folder` and its parents unless it exists already"""
+    try:
+        os.makedirs(folder)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def save_upload(file_storage, destination):
+    """Stores a `FileStorage` at `destination` and returns the sha1 and
+    size of its contents, without reading it again when it was
+    already staged by `StreamingUploadRequest`"""
+    make_folder(os.path.dirname(destination))
+    staged = file_storage.stream
+    if isinstance(staged, StagedUpload):
+        staged.move_to(destination)
+        return staged.hexdigest(), staged.size
+
+    file_storage.save(destination)
+    digest = sha1()
+    with open(destination, 'rb') as fd:
+        for chunk in iter(lambda: fd.read(settings.UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest(), os.path.getsize(destination)
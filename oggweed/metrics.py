@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import time
+import logging
+from bisect import bisect_left
+
+from oggweed import settings
+from oggweed.framework.db import get_redis_connection
+
+log = logging.getLogger('oggweed:metrics')
+
+# upper bounds of the histogram buckets, in seconds: 10ms growing 50%
+# each, the last one is a bit over 30 hours
+BUCKETS = [0.01 * 1.5 ** index for index in range(43)]
+
+
+def get_bucket(seconds):
+    return min(bisect_left(BUCKETS, seconds), len(BUCKETS) - 1)
+
+
+def get_percentile(counts, fraction):
+    """Takes `{bucket: count}` and returns the upper bound of the
+    bucket where the given fraction of the samples is reached"""
+    total = sum(counts.values())
+    if not total:
+        return None
+
+    seen = 0
+    for bucket in sorted(counts):
+        seen += counts[bucket]
+        if seen >= fraction * total:
+            return BUCKETS[bucket]
+
+
+class StepMetrics(object):
+    """Rolling histograms of how long the songs spend in each step of
+    the pipeline, one redis hash of bucket counts per step, metric
+    and minute. The minutes expire after `retention` seconds."""
+    prefix = 'metrics'
+    series_key = 'metrics:series'
+
+    def __init__(self, redis=None, retention=None):
+        self.redis = redis or get_redis_connection()
+        self.retention = retention or settings.METRICS_RETENTION
+
+    def make_key(self, step, metric, minute):
+        return ':'.join([self.prefix, step, metric, str(minute)])
+
+    def record(self, step, durations, now=None):
+        """Adds one sample of each `{metric: seconds}` to the histograms
+        of the current minute, in a single round trip"""
+        minute = int((time.time() if now is None else now) // 60)
+        pipe = self.redis.pipeline(transaction=False)
+        for metric, seconds in durations.items():
+            key = self.make_key(step, metric, minute)
+            pipe.hincrby(key, get_bucket(seconds), 1)
+            pipe.expire(key, self.retention)
+            pipe.sadd(self.series_key, '{0}:{1}'.format(step, metric))
+        pipe.execute()
+
+    def get_series(self):
+        """Returns a `{step: [metric, ...]}` dict of what was recorded"""
+        series = {}
+        for name in self.redis.smembers(self.series_key):
+            step, metric = name.split(':', 1)
+            series.setdefault(step, []).append(metric)
+
+        return series
+
+    def get_counts(self, step, metric, minutes, now=None):
+        """Merges the histograms of the last `minutes` minutes"""
+        current = int((time.time() if now is None else now) // 60)
+        pipe = self.redis.pipeline(transaction=False)
+        for minute in range(current - minutes + 1, current + 1):
+            pipe.hgetall(self.make_key(step, metric, minute))
+
+        counts = {}
+        for histogram in pipe.execute():
+            for bucket, count in histogram.items():
+                counts[int(bucket)] = counts.get(int(bucket), 0) + int(count)
+
+        return counts
+
+    def report(self, minutes=15, now=None):
+        """Returns `{step: {metric: {count, per_minute, p50, p95, p99}}}`
+        for the last `minutes` minutes"""
+        report = {}
+        for step, metrics in self.get_series().items():
+            for metric in metrics:
+                counts = self.get_counts(step, metric, minutes, now)
+                total = sum(counts.values())
+                report.setdefault(step, {})[metric] = {
+                    'count': total,
+                    'per_minute': total / float(minutes),
+                    'p50': get_percentile(counts, 0.5),
+                    'p95': get_percentile(counts, 0.95),
+                    'p99': get_percentile(counts, 0.99),
+                }
+
+        return report
+
+
+class StepTimer(object):
+    """Times one song going through one step.
+
+    It is created when the step takes the song from its queue and
+    records in `instructions['timings'][step]` when the song was
+    enqueued, dequeued, started and finished. Steps add their own
+    durations to that same dict, e.g. `ffmpeg` or `upload`. On `stop`
+    all of them go to `StepMetrics`, along with `queue_wait`,
+    `slot_wait` and `processing`.
+    """
+
+    def __init__(self, step, instructions, metrics=None):
+        self.step = step
+        self.metrics = metrics
+        self.dequeued_at = time.time()
+        self.enqueued_at = instructions.get('enqueued_at') or self.dequeued_at
+        self.started_at = None
+
+        if not instructions.get('timings'):
+            instructions['timings'] = {}
+        # a retried song still carries the timings of its last attempt
+        self.timings = instructions['timings'][step] = {}
+
+    def start(self):
+        self.started_at = time.time()
+
+    def stop(self, now=None):
+        finished_at = time.time() if now is None else now
+        started_at = self.started_at or self.dequeued_at
+        durations = dict(
+            (name, value) for name, value in self.timings.items()
+            if not name.endswith('_at'))
+        durations.update({
+            'queue_wait': self.dequeued_at - self.enqueued_at,
+            'slot_wait': started_at - self.dequeued_at,
+            'processing': finished_at - started_at,
+        })
+        self.timings.update({
+            'enqueued_at': self.enqueued_at,
+            'dequeued_at': self.dequeued_at,
+            'started_at': started_at,
+            'finished_at': finished_at,
+        })
+
+        if not settings.PIPELINE_METRICS:
+            return durations
+
+        try:
+            (self.metrics or StepMetrics()).record(self.step, durations, finished_at)
+        except Exception:
+            # metrics must never fail a song
+            log.warning("could not record the metrics of %s", self.step, exc_info=True)
+
+        return durations
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import os
+import json
+import time
+import logging
+import subprocess
+
+from oggweed import settings
+from oggweed.framework.db import get_redis_connection
+from oggweed.workers import probe
+from oggweed.coordination import JobLeases
+
+log = logging.getLogger('oggweed:scheduling')
+
+# used to guess the duration of files that ffprobe can't read, a
+# 128kbps mp3 takes 16000 bytes per second
+FALLBACK_BYTES_PER_SECOND = 16000
+
+
+def estimate_cost_by_size(size):
+    """Guesses how long converting a file of `size` bytes takes, for
+    files that can't be probed"""
+    return size / float(FALLBACK_BYTES_PER_SECOND)
+
+
+def estimate_cost(filename):
+    """Estimates how long converting `filename` takes, in seconds of
+    audio. The duration is read from the file headers and the file
+    size is used when the headers can't be read"""
+    try:
+        info = probe(filename)
+        return float(info['format']['duration'])
+    except (OSError, ValueError, KeyError, TypeError,
+            subprocess.CalledProcessError):
+        log.warning("could not probe %s, estimating its cost by size", filename)
+
+    return estimate_cost_by_size(os.path.getsize(filename))
+
+
+class SongScheduler(object):
+    """Keeps the uploads waiting for a conversion slot and hands them
+    to the pipeline shortest job first.
+
+    Waiting songs live in a sorted set scored by
+    `cost + aging * enqueued_at`: the lowest score is converted
+    first, and since the score of a song never changes while the
+    clock advances, a long song only gets passed by songs uploaded
+    less than `cost / aging` seconds after it.
+    """
+    key = 'schedule:songs'
+    jobs_key = 'schedule:songs:jobs'
+
+    def __init__(self, redis=None, aging=None, leases=None):
+        self.redis = redis or get_redis_connection()
+        self.aging = settings.SCHEDULER_AGING if aging is None else aging
+        self.leases = leases or JobLeases(redis=self.redis)
+
+    def score(self, cost, enqueued_at):
+        return cost + self.aging * enqueued_at
+
+    def push(self, job, cost=None, now=None):
+        if cost is None:
+            cost = estimate_cost(job['filename'])
+
+        now = time.time() if now is None else now
+        job['estimated_cost'] = cost
+
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hset(self.jobs_key, job['token'], json.dumps(job))
+        pipe.zadd(self.key, self.score(cost, now), job['token'])
+        pipe.execute()
+        return job
+
+    def push_again(self, job):
+        """Schedules a song that failed or whose worker died, songs that
+        were already converted are cheap and go first"""
+        if (job.get('checkpoints') or {}).get('convert'):
+            cost = 0
+        else:
+            cost = job.get('estimated_cost')
+
+        return self.push(job, cost=cost)
+
+    def pop(self):
+        """Removes and returns the cheapest waiting job, or None when
+        nothing is waiting. Safe to call from many worker hosts: only
+        the one whose ZREM removed the token gets the job"""
+        while True:
+            tokens = self.redis.zrange(self.key, 0, 0)
+            if not tokens:
+                return None
+
+            token = tokens[0]
+            pipe = self.redis.pipeline(transaction=True)
+            pipe.zrem(self.key, token)
+            pipe.hget(self.jobs_key, token)
+            pipe.hdel(self.jobs_key, token)
+            removed, raw, _ = pipe.execute()
+            if removed and raw:
+                return json.loads(raw)
+
+    def waiting(self):
+        return self.redis.zcard(self.key)
+
+    def feed(self, queue, slots, poll_interval=None, timeout=None):
+        """Moves one job into the lineup `queue` as soon as one of
+        `slots` is free.
+
+        The job is leased to this node before it enters the queue. It
+        then waits until the step submitted it, so at most one job per
+        worker sits in the FIFO queue and every other one keeps
+        competing by cost. `timeout` covers the job being picked by
+        another worker host. Returns the job, or None if nothing was
+        waiting."""
+        poll_interval = poll_interval or settings.SCHEDULER_POLL_INTERVAL
+        slots.wait_for_free_slot()
+        submitted = slots.submitted
+        job = self.pop()
+        if job is None:
+            time.sleep(poll_interval)
+            return None
+
+        self.leases.acquire(job)
+        job['enqueued_at'] = time.time()
+        queue.put(job)
+        slots.wait_for_submission(submitted, timeout or poll_interval * 10)
+        return job
+
+    def feed_forever(self, queue, slots):
+        while True:
+            try:
+                self.feed(queue, slots)
+            except Exception:
+                log.exception("failed to feed the conversion queue")
+                time.sleep(settings.SCHEDULER_POLL_INTERVAL)
@@ -18,7 +18,13 @@ application = Application.from_env(
 )
 
 application.enable_session()
+application.enable_streaming_uploads()
 application.enable_assets()
 
 from .web.controllers import module
 application.register_blueprint(module)
+
+from .api.resources import SongResource
+application.enable_api([
+    ('/songs/<token>', SongResource),
+])
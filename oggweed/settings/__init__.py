@@ -7,6 +7,7 @@ env = Environment()
 SELF = sys.modules[__name__]
 
 from os.path import join, abspath
+from multiprocessing import cpu_count
 
 
 LOCAL_PORT = 8000
@@ -38,6 +39,13 @@ SCHEME = PORT == 443 and 'https://' or "http://"
 SQLALCHEMY_DATABASE_URI = env.get('SQLALCHEMY_DATABASE_URI')
 REDIS_URI = env.get_uri("REDIS_URI")
 
+# every process keeps one pool of redis connections per database,
+# callers wait up to REDIS_POOL_TIMEOUT seconds when all of the
+# REDIS_MAX_CONNECTIONS are in use
+REDIS_MAX_CONNECTIONS = env.get_int('REDIS_MAX_CONNECTIONS', 50)
+REDIS_POOL_TIMEOUT = env.get_float('REDIS_POOL_TIMEOUT', 20)
+REDIS_SOCKET_TIMEOUT = env.get_float('REDIS_SOCKET_TIMEOUT', 5)
+
 # Filesystem
 LOCAL_FILE = lambda *path: abspath(join(__file__, '..', '..', *path))
 
@@ -52,6 +60,7 @@ LOGGER_NAMES = [
     'oggweed.framework.http',
     'oggweed.framework.db',
     'oggweed.web.models',
+    'oggweed.web.events',
     'oggweed.web.controllers',
 ]
 
@@ -59,3 +68,153 @@ API_TOKEN_EXPIRATION_TIME = 60 * 60 * 12  # 12 hours in seconds
 SALT = 'UXLcFCGwG_7tgC_6'
 UPLOAD_PATH = LOCAL_FILE('_uploads')
 UPLOADED_FILE = lambda *path: join(UPLOAD_PATH, *path)
+
+# uploads are written to UPLOAD_PATH in chunks of UPLOAD_CHUNK_SIZE
+# while the request is read. Flask refuses bodies bigger than
+# MAX_CONTENT_LENGTH upfront, and the staging file stops an upload
+# with no content length as soon as it passes MAX_UPLOAD_SIZE
+UPLOAD_CHUNK_SIZE = env.get_int('UPLOAD_CHUNK_SIZE', 1024 * 1024)
+MAX_UPLOAD_SIZE = env.get_int('MAX_UPLOAD_SIZE', 1024 * 1024 * 1024)
+MAX_CONTENT_LENGTH = MAX_UPLOAD_SIZE + 1024 * 1024
+
+# the files under UPLOAD_PATH are kept below STAGING_QUOTA bytes:
+# uploads are refused above STAGING_HIGH_WATERMARK of the quota and
+# the workers delete files of finalized songs, the ones finalized
+# first go first, down to STAGING_LOW_WATERMARK. Files of songs
+# finalized more than STAGING_MAX_AGE seconds ago are deleted anyway
+STAGING_QUOTA = env.get_int('STAGING_QUOTA', 10 * 1024 * 1024 * 1024)
+STAGING_HIGH_WATERMARK = env.get_float('STAGING_HIGH_WATERMARK', 0.9)
+STAGING_LOW_WATERMARK = env.get_float('STAGING_LOW_WATERMARK', 0.75)
+STAGING_MAX_AGE = env.get_int('STAGING_MAX_AGE', 60 * 60 * 24 * 7)
+STAGING_EVICTION_INTERVAL = env.get_float('STAGING_EVICTION_INTERVAL', 60)
+
+# Conversion
+FFMPEG_BIN = env.get('FFMPEG_BIN', '/usr/local/bin/ffmpeg')
+FFPROBE_BIN = env.get('FFPROBE_BIN', '/usr/local/bin/ffprobe')
+
+# ffprobe only reads the headers, it is killed after PROBE_TIMEOUT
+# seconds so a stuck read never holds a worker
+PROBE_TIMEOUT = env.get_float('PROBE_TIMEOUT', 10)
+
+# how many ffmpeg processes a single worker host runs at the same
+# time, defaults to one per core
+CONVERSION_SLOTS = env.get_int('CONVERSION_SLOTS', cpu_count())
+
+# every upload is encoded once for each of these profiles in a
+# single ffmpeg run, the first one is the song's main url. See
+# `oggweed.workers.ENCODING_PROFILES`
+ENCODING_PROFILES = env.get('ENCODING_PROFILES', 'high,standard,mobile').split(',')
+
+# conversions that are still below FFMPEG_MIN_SPEED times realtime
+# after FFMPEG_SPEED_GRACE seconds are killed
+FFMPEG_MIN_SPEED = env.get_float('FFMPEG_MIN_SPEED', 1.0)
+FFMPEG_SPEED_GRACE = env.get_float('FFMPEG_SPEED_GRACE', 15)
+
+# the audio is decoded to mono at WAVEFORM_SAMPLE_RATE and summarized
+# in WAVEFORM_LEVELS zoom levels of min/max peaks. The most detailed
+# one has a peak every WAVEFORM_SAMPLES_PER_PEAK samples and every
+# other level halves it. Peaks are stored with WAVEFORM_BITS, 8 or 16.
+# See `oggweed.waveform`
+WAVEFORM_SAMPLE_RATE = env.get_int('WAVEFORM_SAMPLE_RATE', 8000)
+WAVEFORM_SAMPLES_PER_PEAK = env.get_int('WAVEFORM_SAMPLES_PER_PEAK', 256)
+WAVEFORM_LEVELS = env.get_int('WAVEFORM_LEVELS', 8)
+WAVEFORM_BITS = env.get_int('WAVEFORM_BITS', 8)
+
+# when enabled ffmpeg writes the encoded audio to its stdout and the
+# bytes go straight to the storage, e.g. as a S3 multipart upload
+STREAMING_TRANSCODE = env.get_bool('STREAMING_TRANSCODE', False)
+
+# converted songs are published to `s3` or to `local`, a folder that
+# the web app serves from LOCAL_STORAGE_URL with range requests. The
+# local storage needs the workers and the web app on the same host.
+# See `oggweed.workers.storage`
+STORAGE_BACKEND = env.get('STORAGE_BACKEND', 's3')
+LOCAL_STORAGE_ROOT = env.get('LOCAL_STORAGE_ROOT', LOCAL_FILE('_media'))
+LOCAL_STORAGE_URL = env.get('LOCAL_STORAGE_URL', '/media')
+
+# songs are stored in S3_BUCKET. S3_HOST points boto at another
+# endpoint, like a local S3 stand-in, using path style urls
+S3_BUCKET = env.get('S3_BUCKET', 'oggweed')
+S3_HOST = env.get('S3_HOST', None)
+S3_PORT = env.get('S3_PORT', None) and env.get_int('S3_PORT')
+S3_SECURE = env.get_bool('S3_SECURE', True)
+
+# browsers can upload straight to the bucket with a presigned POST
+# that is valid for DIRECT_UPLOAD_EXPIRATION seconds
+DIRECT_UPLOAD_EXPIRATION = env.get_int('DIRECT_UPLOAD_EXPIRATION', 60 * 60)
+
+# how many direct uploads a worker downloads from the bucket at the
+# same time, apart from its CONVERSION_SLOTS
+FETCH_SLOTS = env.get_int('FETCH_SLOTS', 4)
+
+# S3 does not accept multipart chunks smaller than 5MB, except for
+# the last one
+S3_PART_SIZE = env.get_int('S3_PART_SIZE', 5 * 1024 * 1024)
+
+# files bigger than S3_PART_SIZE are sent as multipart uploads with
+# this many parts in flight, each part being retried a few times
+S3_UPLOAD_CONCURRENCY = env.get_int('S3_UPLOAD_CONCURRENCY', 4)
+S3_PART_RETRIES = env.get_int('S3_PART_RETRIES', 3)
+
+# progress is written to redis at most once every
+# PROGRESS_INTERVAL seconds and only after it advanced
+# PROGRESS_STEP percent
+PROGRESS_INTERVAL = env.get_float('PROGRESS_INTERVAL', 1.0)
+PROGRESS_STEP = env.get_int('PROGRESS_STEP', 10)
+
+# finished songs are saved in groups of up to SONG_BATCH_SIZE, a song
+# never waits more than SONG_BATCH_MAX_WAIT seconds to be saved
+SONG_BATCH_SIZE = env.get_int('SONG_BATCH_SIZE', 20)
+SONG_BATCH_MAX_WAIT = env.get_float('SONG_BATCH_MAX_WAIT', 0.2)
+
+# uploads wait in a sorted set and the shortest ones are converted
+# first. Every second spent waiting takes SCHEDULER_AGING seconds
+# off a song's estimated cost, so a long song is never passed by
+# songs uploaded more than cost / SCHEDULER_AGING seconds after it
+SCHEDULER_AGING = env.get_float('SCHEDULER_AGING', 10.0)
+SCHEDULER_POLL_INTERVAL = env.get_float('SCHEDULER_POLL_INTERVAL', 0.5)
+
+# failed songs are tried again after RETRY_BASE_DELAY seconds,
+# doubling up to RETRY_MAX_DELAY, and end up in the dead-letter list
+# after RETRY_MAX_ATTEMPTS failures
+RETRY_MAX_ATTEMPTS = env.get_int('RETRY_MAX_ATTEMPTS', 5)
+RETRY_BASE_DELAY = env.get_float('RETRY_BASE_DELAY', 5)
+RETRY_MAX_DELAY = env.get_float('RETRY_MAX_DELAY', 600)
+
+# worker processes advertise themselves every WORKER_HEARTBEAT_INTERVAL
+# seconds, renewing the leases of the songs they hold. A song whose
+# lease was not renewed for LEASE_VISIBILITY_TIMEOUT seconds is
+# delivered again. The node id defaults to `hostname:pid`
+WORKER_NODE_ID = env.get('WORKER_NODE_ID', None)
+WORKER_HEARTBEAT_INTERVAL = env.get_float('WORKER_HEARTBEAT_INTERVAL', 5)
+LEASE_VISIBILITY_TIMEOUT = env.get_float('LEASE_VISIBILITY_TIMEOUT', 60)
+
+# every step of the pipeline records how long songs waited and were
+# processed in per-minute histograms kept for METRICS_RETENTION seconds,
+# see `oggweed.metrics` and the `pipeline-report` command
+PIPELINE_METRICS = env.get_bool('PIPELINE_METRICS', not UNIT_TESTING)
+METRICS_RETENTION = env.get_int('METRICS_RETENTION', 60 * 60 * 24)
+
+# browsers follow their songs through /song/<token>/events, every web
+# process shares one redis subscription between all of them. A comment
+# is sent every SONG_EVENTS_KEEPALIVE seconds so that proxies keep the
+# stream open and disconnected clients are noticed, and a client that
+# falls behind drops the events past SONG_EVENTS_BACKLOG. Serve the web
+# app with a cooperative worker (`make serve`) so that a waiting client
+# costs a greenlet rather than a whole worker
+SONG_EVENTS_KEEPALIVE = env.get_float('SONG_EVENTS_KEEPALIVE', 15)
+SONG_EVENTS_BACKLOG = env.get_int('SONG_EVENTS_BACKLOG', 100)
+
+# finalized songs never change, /api/songs/<token> lets caches keep
+# them for SONG_API_MAX_AGE seconds
+SONG_API_MAX_AGE = env.get_int('SONG_API_MAX_AGE', 60 * 60 * 24 * 365)
+
+# `manage.py build-static` writes the static files to STATIC_BUILD_ROOT
+# under fingerprinted names, with .gz siblings and the manifest that
+# `static_url` resolves through. Their names change with their content,
+# so they are served from STATIC_BUILD_URL as immutable for
+# STATIC_MAX_AGE seconds
+STATIC_BUILD_ROOT = env.get('STATIC_BUILD_ROOT', LOCAL_FILE('_static'))
+STATIC_BUILD_URL = env.get('STATIC_BUILD_URL', '/assets')
+STATIC_MANIFEST = join(STATIC_BUILD_ROOT, 'manifest.json')
+STATIC_MAX_AGE = env.get_int('STATIC_MAX_AGE', 60 * 60 * 24 * 365)
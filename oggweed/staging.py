@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import os
+import time
+import errno
+import logging
+
+from oggweed import settings
+from oggweed.framework.db import get_redis_connection
+
+log = logging.getLogger('oggweed:staging')
+
+
+class StagingArea(object):
+    """Keeps `settings.UPLOAD_PATH` under a byte quota.
+
+    Every file written there is recorded in redis with its size, in a
+    hash per song, next to a running total of the bytes in use: an
+    upload is checked against the quota without walking the folder.
+
+    Only the files of finalized songs are ever deleted: the raw upload
+    and every converted rendition. Songs sent to the dead-letter list
+    are finalized too, see `RetryQueue.fail`. Finalized songs wait in a sorted set
+    scored by the time they were finalized and go oldest first until
+    the usage drops to `low_watermark` of the quota, and any of them
+    finalized more than `max_age` seconds ago goes regardless of the
+    quota. Uploads are refused while the usage is above `high_watermark`.
+    """
+    usage_key = 'staging:usage'
+    finalized_key = 'staging:finalized'
+
+    def __init__(self, path=None, quota=None, high_watermark=None,
+                 low_watermark=None, max_age=None, redis=None, batch_size=100):
+        self.path = path or settings.UPLOAD_PATH
+        self.quota = quota or settings.STAGING_QUOTA
+        self.high_watermark = high_watermark or settings.STAGING_HIGH_WATERMARK
+        self.low_watermark = low_watermark or settings.STAGING_LOW_WATERMARK
+        self.max_age = max_age or settings.STAGING_MAX_AGE
+        self.redis = redis or get_redis_connection()
+        self.batch_size = batch_size
+
+    def make_files_key(self, token):
+        return 'staging:files:{0}'.format(token)
+
+    def add(self, token, paths):
+        """Counts the files of a song against the quota, a file that is
+        added again only counts its new size"""
+        sizes = dict((path, os.path.getsize(path)) for path in set(paths))
+        if not sizes:
+            return
+
+        key = self.make_files_key(token)
+        previous = self.redis.hmget(key, list(sizes))
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hmset(key, sizes)
+        pipe.incrby(self.usage_key,
+                    sum(sizes.values()) - sum(int(size or 0) for size in previous))
+        pipe.execute()
+
+    def finalize(self, tokens, now=None):
+        """Makes the files of these songs candidates for eviction"""
+        now = time.time() if now is None else now
+        pipe = self.redis.pipeline(transaction=False)
+        for token in tokens:
+            pipe.zadd(self.finalized_key, now, token)
+
+        pipe.execute()
+
+    def usage(self):
+        return int(self.redis.get(self.usage_key) or 0)
+
+    def accepts(self, incoming=0):
+        """Whether `incoming` more bytes fit below the high watermark"""
+        return self.usage() + (incoming or 0) <= self.quota * self.high_watermark
+
+    def remove_file(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                log.warning("could not evict %s, it is not counted anymore", path)
+                return False
+
+        # the folder of the upload, see `Song.from_upload`
+        folder = os.path.dirname(path)
+        if os.path.abspath(folder) != os.path.abspath(self.path):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                # converted files or other songs are still in there
+                pass
+
+        return True
+
+    def delete(self, token):
+        """Deletes the files of a finalized song and returns their
+        paths. Only the process whose ZREM removed the song deletes
+        them, so their bytes are never subtracted twice"""
+        if not self.redis.zrem(self.finalized_key, token):
+            return []
+
+        key = self.make_files_key(token)
+        files = self.redis.hgetall(key)
+        deleted = [path for path in files if self.remove_file(path)]
+
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.delete(key)
+        pipe.decrby(self.usage_key, sum(int(size) for size in files.values()))
+        pipe.execute()
+        return deleted
+
+    def evict(self, now=None):
+        """Deletes the files of the songs past their max age, then the
+        oldest finalized ones until the usage is back under the low
+        watermark. Returns the deleted paths"""
+        now = time.time() if now is None else now
+        target = self.quota * self.low_watermark
+
+        deleted = []
+        expired = self.redis.zrangebyscore(self.finalized_key, '-inf', now - self.max_age)
+        for token in expired:
+            deleted.extend(self.delete(token))
+
+        usage = self.usage()
+        while usage > target:
+            tokens = self.redis.zrange(self.finalized_key, 0, self.batch_size - 1)
+            if not tokens:
+                break
+
+            for token in tokens:
+                deleted.extend(self.delete(token))
+                usage = self.usage()
+                if usage <= target:
+                    break
+
+        if usage > target:
+            log.warning("staging area still at %d of %d bytes after eviction",
+                        usage, self.quota)
+
+        return deleted
+
+    def evict_forever(self):
+        while True:
+            try:
+                self.evict()
+            except Exception:
+                log.exception("failed to evict the staging area")
+
+            time.sleep(settings.STAGING_EVICTION_INTERVAL)
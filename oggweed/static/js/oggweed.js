@@ -5,4 +5,31 @@ $(function(){
         player.play();
         return e.preventDefault();
     });
+
+    // follows the conversion instead of reloading the page
+    var player = $("#player");
+    var eventsUrl = player.data("events-url");
+    if (eventsUrl && window.EventSource) {
+        var events = new EventSource(eventsUrl);
+        events.addEventListener("progress", function(e){
+            var progress = JSON.parse(e.data);
+            var status = progress.stage;
+            if (progress.total) {
+                status += " " + Math.floor(progress.done * 100 / progress.total) + "%";
+            }
+            $(".song-status").text(status);
+        });
+        events.addEventListener("finalized", function(e){
+            var song = JSON.parse(e.data);
+            events.close();
+            $(".song-status").text("");
+            $(".song-url").text(song.url);
+            player.find("source").attr("src", song.url);
+            player[0].load();
+        });
+        events.addEventListener("failed", function(e){
+            events.close();
+            $(".song-status").text("The conversion failed");
+        });
+    }
 });
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import sys
+import json
+import audioop
+import threading
+import subprocess
+from array import array
+from functools import partial
+
+from oggweed import settings
+from oggweed.framework.db import get_redis_connection
+
+
+# the workers start ffmpeg and ffprobe one thread at a time, so the
+# pipe that a conversion writes its pcm to is only inherited by that
+# conversion's ffmpeg, another child would keep it open after the
+# conversion ended and the peaks would wait for that child to exit
+spawn_lock = threading.Lock()
+
+
+class WaveformError(Exception):
+    pass
+
+
+def get_peaks(pcm, samples_per_peak):
+    """Takes 16-bit mono pcm in the native byte order and returns the
+    min and max of every `samples_per_peak` samples as an
+    `array('h')` of `min, max` pairs"""
+    peaks = array(b'h')
+    block = samples_per_peak * 2
+    # audioop scans each block in C, a loop per peak rather than per sample
+    for offset in range(0, len(pcm), block):
+        peaks.extend(audioop.minmax(pcm[offset:offset + block], 2))
+
+    return peaks
+
+
+def merge_peaks(peaks):
+    """Halves the resolution of an `array('h')` of `min, max` pairs"""
+    merged = array(b'h')
+    for index in range(0, len(peaks), 4):
+        pairs = peaks[index:index + 4]
+        merged.extend([min(pairs[0::2]), max(pairs[1::2])])
+
+    return merged
+
+
+def encode_peaks(peaks, bits):
+    """Serializes the peaks as signed 8-bit integers, keeping the high
+    byte of each sample, or as signed little-endian 16-bit ones"""
+    if bits == 8:
+        return audioop.lin2lin(peaks.tostring(), 2, 1)
+
+    if sys.byteorder == 'big':
+        peaks = array(b'h', peaks)
+        peaks.byteswap()
+
+    return peaks.tostring()
+
+
+class PeakBuilder(object):
+    """Computes the most detailed level of peaks from pcm that arrives
+    in chunks of any size, so the decoded audio is never held in
+    memory as a whole"""
+
+    def __init__(self, samples_per_peak):
+        self.samples_per_peak = samples_per_peak
+        self.block_size = samples_per_peak * 2
+        self.pending = b''
+        self.peaks = array(b'h')
+
+    def feed(self, pcm):
+        data = self.pending + pcm
+        usable = len(data) - len(data) % self.block_size
+        self.pending = data[usable:]
+        if usable:
+            self.peaks.extend(get_peaks(data[:usable], self.samples_per_peak))
+
+    def finish(self):
+        # an odd trailing byte is half a sample
+        pending = self.pending[:len(self.pending) - len(self.pending) % 2]
+        if pending:
+            self.peaks.extend(get_peaks(pending, self.samples_per_peak))
+
+        self.pending = b''
+        return self.peaks
+
+
+class Waveform(object):
+    """Min/max peaks of a song at several zoom levels.
+
+    Zoom 0 is the overview with the fewest peaks, every next zoom
+    level has twice as many, up to one peak per `samples_per_peak`
+    samples at the last one. The audio is decoded by ffmpeg only once,
+    as mono pcm at `sample_rate`: usually as one more output of the
+    conversion, see `oggweed.workers.OggConverter`, or by `decode`.
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, source_filename, sample_rate=None, samples_per_peak=None,
+                 levels=None, bits=None):
+        self.source_filename = source_filename
+        self.sample_rate = sample_rate or settings.WAVEFORM_SAMPLE_RATE
+        self.samples_per_peak = samples_per_peak or settings.WAVEFORM_SAMPLES_PER_PEAK
+        self.levels = levels or settings.WAVEFORM_LEVELS
+        self.bits = bits or settings.WAVEFORM_BITS
+
+    def get_output_args(self, target):
+        """The ffmpeg arguments that write the pcm to `target`"""
+        return [
+            '-map', '0:a:0',
+            '-ac', '1', '-ar', str(self.sample_rate),
+            # the native byte order, so `array('h')` reads it as is
+            '-f', 's16le' if sys.byteorder == 'little' else 's16be',
+            target,
+        ]
+
+    def get_args(self):
+        return [
+            settings.FFMPEG_BIN,
+            '-loglevel', 'error',
+            '-i', self.source_filename,
+        ] + self.get_output_args('pipe:1')
+
+    def decode(self):
+        """Yields the pcm of the source in chunks while ffmpeg runs"""
+        with spawn_lock:
+            process = subprocess.Popen(self.get_args(), stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+
+        try:
+            for chunk in iter(partial(process.stdout.read, self.chunk_size), b''):
+                yield chunk
+        finally:
+            process.stdout.close()
+            errors = process.stderr.read()
+            process.stderr.close()
+
+        if process.wait():
+            raise WaveformError("ffmpeg could not decode {0}: {1}".format(
+                self.source_filename, errors))
+
+    def get_samples_per_peak(self, zoom):
+        return self.samples_per_peak * 2 ** (self.levels - 1 - zoom)
+
+    def compute(self, pcm_chunks=None):
+        """Returns the peaks of every zoom level, the overview first"""
+        builder = PeakBuilder(self.samples_per_peak)
+        for chunk in pcm_chunks or self.decode():
+            builder.feed(chunk)
+
+        return self.get_levels(builder.finish())
+
+    def get_levels(self, peaks):
+        """Returns every zoom level of the most detailed peaks"""
+        levels = [peaks]
+        while len(levels) < self.levels:
+            levels.insert(0, merge_peaks(levels[0]))
+
+        return levels
+
+    def describe(self, levels):
+        """The metadata a client needs to draw the peaks"""
+        return {
+            'sample_rate': self.sample_rate,
+            'bits': self.bits,
+            'levels': [{
+                'zoom': zoom,
+                'samples_per_peak': self.get_samples_per_peak(zoom),
+                'peaks': len(peaks) // 2,
+            } for zoom, peaks in enumerate(levels)],
+        }
+
+
+class WaveformStore(object):
+    """Keeps the encoded peaks of each zoom level next to the song in
+    redis, a few KB each, along with their description"""
+
+    def __init__(self, redis=None):
+        self.redis = redis or get_redis_connection()
+
+    def make_key(self, token, zoom=None):
+        key = "song:{0}:waveform".format(token)
+        if zoom is None:
+            return key
+
+        return "{0}:{1}".format(key, zoom)
+
+    def store(self, token, waveform, levels):
+        """Saves every level in a single transaction and returns their
+        description"""
+        description = waveform.describe(levels)
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.set(self.make_key(token), json.dumps(description))
+        for zoom, peaks in enumerate(levels):
+            pipe.set(self.make_key(token, zoom), encode_peaks(peaks, waveform.bits))
+
+        pipe.execute()
+        return description
+
+    def copy(self, source_token, token):
+        """Gives a song the waveform of another one with the same audio,
+        returns its description or None when the other one has none"""
+        description = self.describe(source_token)
+        if description is None:
+            return None
+
+        zooms = range(len(description['levels']))
+        pipe = self.redis.pipeline(transaction=False)
+        for zoom in zooms:
+            pipe.get(self.make_key(source_token, zoom))
+        levels = pipe.execute()
+        if None in levels:
+            return None
+
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.set(self.make_key(token), json.dumps(description))
+        for zoom, peaks in zip(zooms, levels):
+            pipe.set(self.make_key(token, zoom), peaks)
+
+        pipe.execute()
+        return description
+
+    def describe(self, token):
+        raw = self.redis.get(self.make_key(token))
+        if raw:
+            return json.loads(raw)
+
+    def get(self, token, zoom):
+        """Returns the description and the encoded peaks of one zoom
+        level, either is None when missing"""
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.get(self.make_key(token))
+        pipe.get(self.make_key(token, zoom))
+        raw, peaks = pipe.execute()
+        return raw and json.loads(raw), peaks
@@ -4,23 +4,39 @@
 #
 from __future__ import unicode_literals
 
+import os
+import re
 import json
 from oggweed import settings
 from flask import (
     Blueprint,
+    Response,
     render_template,
     session,
     url_for,
     request,
     redirect,
+    safe_join,
 )
-from lineup.backends.redis import JSONRedisBackend
-from oggweed.workers import OggPipeline
+from oggweed.workers import connections
+from oggweed.workers.storage import LocalStorage
+from oggweed.scheduling import SongScheduler, estimate_cost_by_size
+from oggweed.staging import StagingArea
+from oggweed.waveform import WaveformStore
+from oggweed.framework.http import json_response
+from oggweed.framework.http.uploads import save_upload
+from oggweed.framework.http.files import send_file_range, send_asset
+from oggweed.framework.http.assets import static_url
 from werkzeug.utils import secure_filename
 from oggweed.web.models import Song
+from oggweed.web.events import get_song_events
 
 module = Blueprint('web.controllers', __name__)
 
+# keys of the files that browsers upload straight to the bucket
+DIRECT_UPLOAD_KEY = 'uploads/{token}/{filename}'
+DIRECT_UPLOAD_KEY_REGEX = re.compile(r'^uploads/(?P<token>[0-9a-f]{40})/(?P<filename>[^/]+)$')
+
 
 @module.context_processor
 def inject_basics():
@@ -36,10 +52,7 @@ def inject_basics():
         ssl_full_url_for=lambda *args, **kw: settings.sslabsurl(
             url_for(*args, **kw)
         ),
-        static_url=lambda path: "{0}/{1}".format(
-            settings.STATIC_BASE_URL.rstrip('/'),
-            path.lstrip('/')
-        ),
+        static_url=static_url,
     )
 
 
@@ -50,21 +63,98 @@ def index():
 
 @module.route('/upload', methods=['POST'])
 def upload():
-    file = request.files['file']
-    filename = secure_filename(file.filename)
-    destination = settings.UPLOADED_FILE(filename)
-    file.save(destination)
+    staging = StagingArea()
+    if not staging.accepts(request.content_length):
+        staging.evict()
 
-    song = Song.from_filename(destination)
+    if not staging.accepts(request.content_length):
+        return Response("The server is out of space for new uploads, "
+                        "please try again later",
+                        status=507, mimetype='text/plain',
+                        headers={'Retry-After': 60})
+
+    file = request.files['file']
+    song = Song.from_upload(secure_filename(file.filename))
+    source_sha1, source_size = save_upload(file, song.filename)
+    staging.add(song.token, [song.filename])
     song.save()
 
-    pipeline = OggPipeline(JSONRedisBackend)
-    pipeline.input.put(song.as_dict())
+    # the worker moves it to the pipeline when its turn comes
+    job = song.as_dict()
+    job['source_sha1'] = source_sha1
+    job['source_size'] = source_size
+    SongScheduler().push(job)
 
     return redirect(url_for('.song',
                             token=song.token))
 
 
+@module.route('/upload/initiate', methods=['POST'])
+def initiate_upload():
+    """Returns a presigned POST that lets the browser send the file
+    straight to the bucket, the web tier never sees its bytes"""
+    data = request.get_json(force=True, silent=True) or {}
+    filename = secure_filename(data.get('filename') or '')
+    if not filename:
+        return json_response({'error': 'missing filename'}, 400, {})
+
+    song = Song.from_upload(filename)
+    key_name = DIRECT_UPLOAD_KEY.format(token=song.token, filename=filename)
+    form = connections.get_connection().build_post_form_args(
+        settings.S3_BUCKET, key_name,
+        expires_in=settings.DIRECT_UPLOAD_EXPIRATION,
+        max_content_length=settings.MAX_UPLOAD_SIZE,
+        http_method='https' if settings.S3_SECURE else 'http')
+
+    return json_response({
+        'token': song.token,
+        'key': key_name,
+        'action': form['action'],
+        'fields': form['fields'],
+    }, 200, {})
+
+
+@module.route('/upload/complete', methods=['POST'])
+def complete_upload():
+    """Called by the browser once its direct upload finished: creates
+    the song and schedules it, `FetchFromS3` downloads the source.
+    Calling it again for the same upload changes nothing"""
+    data = request.get_json(force=True, silent=True) or {}
+    found = DIRECT_UPLOAD_KEY_REGEX.match(data.get('key') or '')
+    if not found:
+        return json_response({'error': 'invalid key'}, 400, {})
+
+    key_name = found.group(0)
+    key = connections.get_bucket(settings.S3_BUCKET).get_key(key_name)
+    if key is None:
+        return json_response({'error': 'upload not found'}, 404, {})
+
+    token = found.group('token')
+    raw, _ = Song.get_record(token)
+    if raw:
+        # the browser retried the callback, the song is scheduled
+        # or converted already
+        return json_response({
+            'token': token,
+            'url': url_for('.song', token=token),
+        }, 200, {})
+
+    song = Song.from_upload(found.group('filename'), token=token)
+    song.save()
+
+    job = song.as_dict()
+    job['source_key'] = key_name
+    job['source_size'] = key.size
+    # the file is not on this host, probing it would keep the request
+    # waiting on S3: its size is enough to order the songs
+    SongScheduler().push(job, cost=estimate_cost_by_size(key.size))
+
+    return json_response({
+        'token': song.token,
+        'url': url_for('.song', token=song.token),
+    }, 201, {})
+
+
 @module.route('/song/<token>')
 def song(token):
     try:
@@ -73,3 +163,72 @@ def song(token):
         return redirect('/')
 
     return render_template('song.html', song=song)
+
+
+@module.route('/song/<token>/events')
+def song_events(token):
+    """Streams the progress of a song as Server-Sent Events until it
+    is finalized, see `oggweed.web.events`"""
+    events = get_song_events()
+    queue = events.subscribe(token)
+    try:
+        song = Song.from_token(token)
+    except:
+        events.unsubscribe(token, queue)
+        return Response("Not found", status=404, mimetype='text/plain')
+
+    return Response(events.stream(song, queue), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # nginx would buffer the stream otherwise
+        'X-Accel-Buffering': 'no',
+    })
+
+
+@module.route('/media/<path:key_name>')
+def media(key_name):
+    """Serves the songs published to the local storage, see
+    `oggweed.workers.storage.LocalStorage`"""
+    path = LocalStorage().get_path(key_name)
+    if path is None or not os.path.isfile(path):
+        return Response("Not found", status=404, mimetype='text/plain')
+
+    return send_file_range(path, 'audio/ogg')
+
+
+@module.route('/assets/<path:filename>')
+def assets(filename):
+    """Serves the fingerprinted static files written by the
+    `build-static` command"""
+    path = safe_join(settings.STATIC_BUILD_ROOT, filename)
+    if not os.path.isfile(path):
+        return Response("Not found", status=404, mimetype='text/plain')
+
+    return send_asset(path, max_age=settings.STATIC_MAX_AGE)
+
+
+@module.route('/song/<token>/waveform')
+def waveform(token):
+    """Describes the zoom levels of the waveform of a song"""
+    description = WaveformStore().describe(token)
+    if description is None:
+        return json_response({'error': 'waveform not found'}, 404, {})
+
+    return json_response(description, 200, {})
+
+
+@module.route('/song/<token>/waveform/<int:zoom>')
+def waveform_peaks(token, zoom):
+    """Serves the `min, max` pairs of one zoom level as signed integers
+    of `X-Waveform-Bits` bits, little-endian"""
+    description, peaks = WaveformStore().get(token, zoom)
+    if description is None or peaks is None:
+        return Response("No waveform for this zoom level",
+                        status=404, mimetype='text/plain')
+
+    level = description['levels'][zoom]
+    return Response(peaks, mimetype='application/octet-stream', headers={
+        'X-Waveform-Bits': description['bits'],
+        'X-Waveform-Sample-Rate': description['sample_rate'],
+        'X-Waveform-Samples-Per-Peak': level['samples_per_peak'],
+        'Cache-Control': 'public, max-age=3600',
+    })
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2013 OggWeed LLC
+#
+"""
+oggweed.web.events
+~~~~~~~~~~~~~~~~~~
+
+Streams the events that the workers publish about each song to the
+browsers as Server-Sent Events.
+
+Every web process keeps a single pattern subscription to the channels
+of all the songs and hands each event to the clients waiting on that
+song, so a waiting client costs a queue rather than a redis connection.
+"""
+from __future__ import unicode_literals
+import json
+import time
+import threading
+from Queue import Queue, Empty, Full
+from collections import defaultdict
+
+from oggweed import settings
+from oggweed.framework.db import get_redis_pubsub
+from oggweed.framework.log import get_logger
+from oggweed.web.models import SONG_EVENTS_CHANNEL
+
+
+logger = get_logger('oggweed.web.events')
+
+# the song will not change anymore after these
+FINAL_STAGES = ('finalized', 'failed')
+
+
+def format_event(name, data):
+    """Returns a Server-Sent Event carrying `data` as json"""
+    return "event: {0}\ndata: {1}\n\n".format(name, json.dumps(data))
+
+
+def get_event_name(event):
+    stage = event.get('stage')
+    if stage in FINAL_STAGES:
+        return stage
+
+    return 'progress'
+
+
+class SongEvents(object):
+    pattern = SONG_EVENTS_CHANNEL.format('*')
+
+    def __init__(self, keepalive=None, backlog=None, reconnect_delay=1):
+        self.keepalive = keepalive or settings.SONG_EVENTS_KEEPALIVE
+        self.backlog = backlog or settings.SONG_EVENTS_BACKLOG
+        self.reconnect_delay = reconnect_delay
+        self.listeners = defaultdict(set)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def subscribe(self, token):
+        """Returns the queue that receives the events of the song"""
+        queue = Queue(self.backlog)
+        with self.lock:
+            self.listeners[token].add(queue)
+
+        return queue
+
+    def unsubscribe(self, token, queue):
+        with self.lock:
+            queues = self.listeners.get(token, set())
+            queues.discard(queue)
+            if not queues:
+                self.listeners.pop(token, None)
+
+    def dispatch(self, message):
+        """Hands a pub/sub message to the clients of its song"""
+        if message['type'] != 'pmessage':
+            return
+
+        token = message['channel'].split(':')[1]
+        with self.lock:
+            queues = list(self.listeners.get(token, ()))
+
+        if not queues:
+            return
+
+        event = json.loads(message['data'])
+        for queue in queues:
+            try:
+                queue.put_nowait(event)
+            except Full:
+                logger.warning("dropping an event of %s, the client fell behind", token)
+
+    def listen(self):
+        pubsub = get_redis_pubsub()
+        pubsub.psubscribe(self.pattern)
+        for message in pubsub.listen():
+            self.dispatch(message)
+
+    def listen_forever(self):
+        while True:
+            try:
+                self.listen()
+            except Exception:
+                logger.exception("lost the song events subscription, reconnecting")
+                time.sleep(self.reconnect_delay)
+
+    def start(self):
+        """Subscribes in a daemon thread, a greenlet once gevent patched
+        the threading module"""
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.listen_forever,
+                                               name='song-events')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def stream(self, song, queue):
+        """Yields the events of a song until it is finalized or failed.
+
+        The queue must be subscribed before the song is read, otherwise
+        the song could be finalized in between and the client would
+        wait forever.
+        """
+        try:
+            yield "retry: {0}\n\n".format(int(self.keepalive * 1000))
+
+            # the song was finalized before the client connected
+            if song.finalized_at:
+                yield format_event('finalized', {
+                    'stage': 'finalized',
+                    'url': song.url,
+                    'finalized_at': song.finalized_at,
+                })
+                return
+
+            while True:
+                try:
+                    event = queue.get(timeout=self.keepalive)
+                except Empty:
+                    yield ": keepalive\n\n"
+                    continue
+
+                name = get_event_name(event)
+                yield format_event(name, event)
+                if name in FINAL_STAGES:
+                    return
+        finally:
+            self.unsubscribe(song.token, queue)
+
+
+song_events = None
+song_events_lock = threading.Lock()
+
+
+def get_song_events():
+    """The `SongEvents` shared by every request of this process, its
+    subscription starts with the first client"""
+    global song_events
+    with song_events_lock:
+        if song_events is None:
+            song_events = SongEvents()
+
+    song_events.start()
+    return song_events
@@ -3,6 +3,7 @@
 #
 from __future__ import unicode_literals
 import time
+from uuid import uuid4
 from datetime import datetime
 from hashlib import sha1
 
@@ -20,6 +21,9 @@ from oggweed.framework.handy.functions import now
 
 logger = get_logger('oggweed.web.models')
 
+# pub/sub channel where the workers publish the progress of each song
+SONG_EVENTS_CHANNEL = "song:{0}:events"
+
 
 class User(Model):
     table = db.Table(
@@ -83,6 +87,20 @@ class Song(object):
         new = cls(**song_data)
         return new
 
+    @classmethod
+    def from_upload(cls, filename, token=None):
+        """A song whose upload goes to `UPLOADED_FILE(token, filename)`,
+        so two uploads with the same name never overwrite each other.
+        Direct uploads already got their token from `initiate_upload`"""
+        if token is None:
+            # the token of `from_filename` is the same for every upload
+            # of a name on a given day
+            token = sha1(uuid4().hex + filename).hexdigest()
+
+        song = cls.from_filename(settings.UPLOADED_FILE(token, filename))
+        song.token = token
+        return song
+
     def __init__(self, **kw):
         self.__data__ = {}
         for key in self.keys:
@@ -102,23 +120,94 @@ class Song(object):
     def as_json(self):
         return json.dumps(self.as_dict())
 
+    @classmethod
+    def index_key(cls, name):
+        """Returns the key of the sorted set that indexes the songs by
+        status (`all`, `pending`, `ready`) or by day"""
+        return "index:songs:{0}".format(name)
+
+    def write_to(self, pipe):
+        """Queues the commands that persist this song in the given
+        redis pipeline.
+
+        The indexes are sorted sets, so saving a song more than once
+        never duplicates its token.
+        """
+        uploaded_at = self.uploaded_at or time.time()
+        pipe.zadd(self.index_key('all'), uploaded_at, self.token)
+        if self.day:
+            pipe.zadd(self.index_key(self.day), uploaded_at, self.token)
+
+        if self.finalized_at:
+            pipe.zrem(self.index_key('pending'), self.token)
+            pipe.zadd(self.index_key('ready'), self.finalized_at, self.token)
+        else:
+            pipe.zadd(self.index_key('pending'), uploaded_at, self.token)
+
+        pipe.set("song:{0}".format(self.token), self.as_json())
+
+        # published after the SET, browsers waiting on the song
+        # events can fetch it right away
+        if self.finalized_at:
+            pipe.publish(SONG_EVENTS_CHANNEL.format(self.token), json.dumps({
+                'stage': 'finalized',
+                'url': self.url,
+                'finalized_at': self.finalized_at,
+            }))
+
     def save(self):
+        self.save_many([self])
+
+    @classmethod
+    def save_many(cls, songs):
+        """Persists all the given songs in a single MULTI/EXEC"""
         redis = get_redis_connection()
+        pipe = redis.pipeline(transaction=True)
+        for song in songs:
+            song.write_to(pipe)
 
-        if not self.finalized_at:
-            keys_to_push = [
-                "list:songs:all",
-                "list:songs:{0}".format(self.day)
-            ]
-        else:
-            keys_to_push = [
-                "list:songs:ready",
-            ]
+        pipe.execute()
 
-        for key in keys_to_push:
-            redis.rpush(key, "song:{0}".format(self.token))
+    @classmethod
+    def list(cls, status='all', cursor=None, limit=20):
+        """Returns a page of songs with the given status, newest first,
+        and the cursor of the next page or None when it is the last.
+
+        `ready` songs are sorted by `finalized_at`, the other indexes
+        by `uploaded_at`. The cursor is `<score>:<skip>`, the last
+        score seen and how many songs with that very score were seen
+        already, so songs sharing a score are never skipped.
+        """
+        redis = get_redis_connection()
+        maximum, skip = '+inf', 0
+        if cursor and ':' in cursor:
+            maximum, skip = cursor.split(':', 1)
+            skip = int(skip)
+        elif cursor:
+            # cursors handed out before ties were counted
+            maximum = '({0}'.format(cursor)
+
+        entries = redis.zrevrangebyscore(
+            cls.index_key(status), maximum, '-inf',
+            start=skip, num=limit, withscores=True)
+
+        if not entries:
+            return [], None
+
+        keys = ["song:{0}".format(token) for token, score in entries]
+        songs = [cls(**json.loads(raw)) for raw in redis.mget(keys) if raw]
 
-        redis.set("song:{0}".format(self.token), self.as_json())
+        next_cursor = None
+        if len(entries) == limit:
+            last = entries[-1][1]
+            ties = len([score for token, score in entries if score == last])
+            if ties == len(entries) and maximum == repr(last):
+                # the whole page shares the score of the cursor
+                ties += skip
+
+            next_cursor = '{0!r}:{1}'.format(last, ties)
+
+        return songs, next_cursor
 
     @classmethod
     def from_token(cls, token):
@@ -126,3 +215,14 @@ class Song(object):
         raw = redis.get("song:{0}".format(token))
         data = json.loads(raw)
         return cls(**data)
+
+    @classmethod
+    def get_record(cls, token):
+        """Returns the json of the song as stored, None for unknown
+        songs, and whether it was finalized in a single round trip"""
+        redis = get_redis_connection()
+        pipe = redis.pipeline(transaction=False)
+        pipe.get("song:{0}".format(token))
+        pipe.zscore(cls.index_key('ready'), token)
+        raw, finalized_at = pipe.execute()
+        return raw, finalized_at is not None
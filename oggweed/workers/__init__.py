@@ -0,0 +1,1390 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import re
+import os
+import json
+import fcntl
+import shutil
+
+import time
+import logging
+import threading
+import traceback
+
+
+import subprocess
+from io import BytesIO
+from hashlib import sha1
+from copy import deepcopy
+from functools import partial
+from collections import OrderedDict
+from lineup.steps import Step
+from lineup.framework import Pipeline
+from plant import Node
+from oggweed import settings
+from oggweed.framework.db import get_redis_connection
+from oggweed.framework.http.uploads import StagedUpload, make_folder
+from oggweed.web.models import Song, SONG_EVENTS_CHANNEL
+from oggweed.coordination import JobLeases
+from oggweed.staging import StagingArea
+from oggweed.metrics import StepTimer
+from oggweed.waveform import PeakBuilder, Waveform, WaveformStore, spawn_lock
+from oggweed.workers.storage import (
+    connections,
+    refreshing_connection,
+    get_storage,
+)
+
+current_dir = Node(__file__).parent
+
+
+log = logging.getLogger('goloka:workers:s3')
+
+# vorbis arguments of each rendition, `settings.ENCODING_PROFILES`
+# picks which ones are produced
+ENCODING_PROFILES = OrderedDict([
+    ('high', ['-ab', '450k', '-q', '10']),
+    ('standard', ['-ab', '160k', '-q', '5']),
+    ('mobile', ['-ab', '64k', '-q', '1', '-ar', '32000']),
+])
+
+# vorbis sources with more channels than this are always encoded again
+MAX_COPY_CHANNELS = 2
+
+class ConversionSlots(object):
+    """Runs up to `size` callables at the same time, each in its own
+    thread.
+
+    `submit` blocks while all the slots are busy, so the step calling
+    it stops pulling instructions from its lineup queue until a slot
+    is released: pending songs stay in redis instead of piling up in
+    memory.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.semaphore = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.busy = 0
+        self.submitted = 0
+
+    def submit(self, target, *args):
+        self.semaphore.acquire()
+        with self.lock:
+            self.busy += 1
+            self.submitted += 1
+            self.changed.notify_all()
+
+        thread = threading.Thread(target=self.run, args=(target, ) + args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def run(self, target, *args):
+        try:
+            target(*args)
+        finally:
+            with self.lock:
+                self.busy -= 1
+                self.changed.notify_all()
+
+            self.semaphore.release()
+
+    def wait_until(self, ready, timeout=None):
+        """Blocks until `ready()` is true, re-checking it every time a
+        callable is submitted or finishes. Returns False when
+        `timeout` seconds went by first"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.lock:
+            while not ready():
+                if deadline is None:
+                    self.changed.wait()
+                    continue
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+
+                self.changed.wait(remaining)
+
+            return True
+
+    def wait_for_free_slot(self, timeout=None):
+        return self.wait_until(lambda: self.busy < self.size, timeout)
+
+    def wait_for_submission(self, after, timeout=None):
+        return self.wait_until(lambda: self.submitted > after, timeout)
+
+    def join(self):
+        """Blocks until every running callable is done"""
+        for _ in range(self.size):
+            self.semaphore.acquire()
+
+        for _ in range(self.size):
+            self.semaphore.release()
+
+
+class InstrumentedStep(Step):
+    """Base of the pipeline steps: times every song from the moment it
+    is taken from the queue until it is produced to the next one, see
+    `StepTimer`, and sends failed songs to the retry queue"""
+    timers = None
+
+    def get_step_name(self):
+        return self.__class__.__name__
+
+    def get_timers(self):
+        if self.timers is None:
+            self.timers = {}
+
+        return self.timers
+
+    def start_timer(self, instructions):
+        timer = StepTimer(self.get_step_name(), instructions)
+        self.get_timers()[instructions.get('token')] = timer
+        return timer
+
+    def get_step_timings(self, instructions):
+        """Where a step records its own durations, like `ffmpeg`"""
+        timings = instructions.setdefault('timings', {})
+        return timings.setdefault(self.get_step_name(), {})
+
+    def produce(self, instructions):
+        timer = self.get_timers().pop(instructions.get('token'), None)
+        if timer:
+            timer.stop()
+
+        instructions['enqueued_at'] = time.time()
+        return super(InstrumentedStep, self).produce(instructions)
+
+    def rollback(self, instructions):
+        self.get_timers().pop(instructions.get('token'), None)
+        retry_later(instructions)
+
+
+conversion_slots = None
+conversion_slots_lock = threading.Lock()
+
+
+def get_conversion_slots():
+    """The `ConversionSlots` shared by every concurrent step of this
+    process, sized after `settings.CONVERSION_SLOTS` the first time it
+    is needed"""
+    global conversion_slots
+    with conversion_slots_lock:
+        if conversion_slots is None:
+            conversion_slots = ConversionSlots(settings.CONVERSION_SLOTS)
+
+        return conversion_slots
+
+
+fetch_slots = None
+fetch_slots_lock = threading.Lock()
+
+
+def get_fetch_slots():
+    """The `ConversionSlots` of the downloads, sized after
+    `settings.FETCH_SLOTS`: they wait on the network rather than the
+    cpu, so they never take a conversion slot"""
+    global fetch_slots
+    with fetch_slots_lock:
+        if fetch_slots is None:
+            fetch_slots = ConversionSlots(settings.FETCH_SLOTS)
+
+        return fetch_slots
+
+
+class ConcurrentStep(InstrumentedStep):
+    """A lineup step that processes up to `settings.CONVERSION_SLOTS`
+    instructions at the same time. Subclasses implement `process`
+    rather than `consume`"""
+    slots = None
+
+    def get_slots(self):
+        if self.slots is None:
+            self.slots = get_conversion_slots()
+
+        return self.slots
+
+    def consume(self, instructions):
+        timer = self.start_timer(instructions)
+        self.get_slots().submit(self.process_safely, instructions, timer)
+
+    def process_safely(self, instructions, timer=None):
+        # exceptions raised here happen outside of the lineup thread,
+        # so the rollback must be called by hand
+        try:
+            if timer:
+                timer.start()
+            claim_lease(instructions)
+            self.process(instructions)
+        except Exception:
+            instructions['__lineup__error__'] = {
+                'traceback': traceback.format_exc(),
+            }
+            self.rollback(instructions)
+
+    def process(self, instructions):
+        raise NotImplementedError
+
+
+class ProgressReporter(object):
+    """Coalesces the progress updates of one stage of a song.
+
+    The progress is written as json to `song:<token>:<stage>:progress`,
+    with the extra fields of the stage like the `speed` and `bitrate`
+    of ffmpeg, and published to the song events channel in a single
+    round trip, at
+    most once every `interval` seconds and only when it advanced at
+    least `step` percent. When the total is unknown only the interval
+    applies. Call `flush` at the end to write the last update.
+    """
+    def __init__(self, token, stage, redis=None, interval=None, step=None):
+        self.redis = redis or get_redis_connection()
+        self.stage = stage
+        self.key = "song:{0}:{1}:progress".format(token, stage)
+        self.channel = SONG_EVENTS_CHANNEL.format(token)
+        self.interval = settings.PROGRESS_INTERVAL if interval is None else interval
+        self.step = settings.PROGRESS_STEP if step is None else step
+        self.lock = threading.Lock()
+        self.pending = None
+        self.last_percent = None
+        self.last_written_at = None
+        self.writes = 0
+
+    def get_percent(self, done, total):
+        if total:
+            return done * 100 / total
+
+    def should_write(self, done, total, now):
+        if self.last_written_at is None:
+            return True
+
+        if total and done >= total:
+            return True
+
+        if now - self.last_written_at < self.interval:
+            return False
+
+        percent = self.get_percent(done, total)
+        if percent is None:
+            return True
+
+        return percent - self.last_percent >= self.step
+
+    def update(self, done, total, **extra):
+        now = time.time()
+        with self.lock:
+            self.pending = (done, total, extra)
+            if self.should_write(done, total, now):
+                self.write(now)
+
+    def flush(self):
+        with self.lock:
+            self.write(time.time())
+
+    def write(self, now):
+        if self.pending is None:
+            return
+
+        done, total, extra = self.pending
+        event = json.dumps(dict(extra, stage=self.stage, done=done, total=total))
+
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.set(self.key, event)
+        pipe.publish(self.channel, event)
+        pipe.execute()
+
+        self.pending = None
+        self.last_percent = self.get_percent(done, total) or 0
+        self.last_written_at = now
+        self.writes += 1
+
+
+class SongBatch(object):
+    """Collects finished songs and saves them with `Song.save_many`
+    once `size` songs are pending or the oldest of them waited
+    `max_wait` seconds. `on_saved` is then called with the saved
+    songs"""
+    def __init__(self, size, max_wait, on_saved=None):
+        self.size = size
+        self.max_wait = max_wait
+        self.on_saved = on_saved
+        self.lock = threading.Lock()
+        self.songs = []
+        self.timer = None
+
+    def add(self, song):
+        with self.lock:
+            self.songs.append(song)
+            if len(self.songs) >= self.size:
+                self.flush_pending()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.max_wait, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            self.flush_pending()
+
+    def flush_pending(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        songs, self.songs = self.songs, []
+        if songs:
+            Song.save_many(songs)
+            if self.on_saved:
+                self.on_saved(songs)
+
+
+def claim_lease(instructions):
+    """Tells the other nodes that this one is now working on the song"""
+    if instructions.get('leased'):
+        JobLeases().claim(instructions)
+
+
+def release_leases(songs):
+    # the leases only go away once the finished songs are saved, a
+    # node dying before that gets them delivered again
+    JobLeases().release_many([song.token for song in songs])
+
+
+def release_songs(songs):
+    release_leases(songs)
+    # their local files are not needed anymore
+    StagingArea().finalize([song.token for song in songs])
+
+
+finished_songs = SongBatch(settings.SONG_BATCH_SIZE, settings.SONG_BATCH_MAX_WAIT,
+                           on_saved=release_songs)
+
+
+class S3Worker(InstrumentedStep):
+    @property
+    def conn(self):
+        return self.get_connection()
+
+    def get_connection(self):
+        return connections.get_connection()
+
+    def refreshing_connection(self, method, *args, **kw):
+        return refreshing_connection(method, *args, **kw)
+
+index_html = """
+<html>
+  <head><title>Index for {repository[full_name]}</title>
+<link href='http://fonts.googleapis.com/css?family=Share+Tech+Mono' rel='stylesheet' type='text/css'>
+<style type="text/css">
+* font-family: "Share Tech Mono";
+</style>
+  </head>
+  <body><h2>Welcome to {repository[full_name]}</h2>
+  <footer>goloka</footer>
+  </body>
+</html>"""
+
+error_html = """
+<html>
+  <head><title>Error</title>
+<link href='http://fonts.googleapis.com/css?family=Share+Tech+Mono' rel='stylesheet' type='text/css'>
+<style type="text/css">
+* font-family: "Share Tech Mono";
+</style>
+  </head>
+  <body><h2>Error in {repository[full_name]}</h2>
+  <footer>goloka</footer>
+  </body>
+</html>"""
+
+
+class StoreSong(InstrumentedStep):
+    """Publishes the converted files of a song to the storage backend
+    picked by `settings.STORAGE_BACKEND`, see `oggweed.workers.storage`.
+
+    Whatever the backend, the upload progress keeps its `s3` stage, so
+    clients still poll `song:<token>:s3:progress`.
+    """
+    storage = None
+
+    def get_storage(self):
+        if self.storage is None:
+            self.storage = get_storage()
+
+        return self.storage
+
+    def get_filename(self, instructions):
+        filename = instructions['filename']
+        return os.path.split(filename)[-1]
+
+    def get_key_name(self, instructions, local_path):
+        key_local_path = os.path.split(local_path)[-1]
+        return '{0}:{1}'.format(instructions['token'], key_local_path)
+
+    def get_progress_reporter(self, instructions, stage='s3'):
+        return ProgressReporter(instructions['token'], stage)
+
+    def publish(self, instructions, key_name, url):
+        instructions['url'] = url
+        instructions['finalized_at'] = time.time()
+        instructions['metadata'].update({
+            'key_name': key_name,
+        })
+        return instructions
+
+    def store_file(self, instructions):
+        metadata = instructions['metadata']
+        key_name, url = self.upload_file(instructions, metadata['final_path'])
+
+        for profile, rendition in metadata.get('renditions', {}).items():
+            if rendition['final_path'] == metadata['final_path']:
+                rendition_key_name, rendition_url = key_name, url
+            else:
+                rendition_key_name, rendition_url = self.upload_file(
+                    instructions, rendition['final_path'],
+                    stage='s3:{0}'.format(profile))
+
+            rendition.update({
+                'key_name': rendition_key_name,
+                'url': rendition_url,
+            })
+
+        return self.publish(instructions, key_name, url)
+
+    def upload_file(self, instructions, local_source_path, stage='s3'):
+        """Returns the key name and the url of the stored file"""
+        key_name = self.get_key_name(instructions, local_source_path)
+        progress = self.get_progress_reporter(instructions, stage)
+        url = self.get_storage().store_file(
+            key_name, local_source_path, progress=progress.update)
+
+        progress.flush()
+        return key_name, url
+
+    def store_stream(self, instructions, chunks):
+        """Stores the given iterable of byte chunks under the key named
+        after the `.ogg` file that `OggConverter.convert` would have
+        written to the disk"""
+        final_path = instructions['filename'] + b'.ogg'
+        key_name = self.get_key_name(instructions, final_path)
+
+        progress = self.get_progress_reporter(instructions)
+        url = self.get_storage().store_stream(key_name, chunks, progress=progress.update)
+
+        progress.flush()
+        return self.publish(instructions, key_name, url)
+
+    def consume(self, instructions):
+        self.start_timer(instructions).start()
+        claim_lease(instructions)
+        if instructions['metadata'].get('cached'):
+            # AnythingToOgg found this audio in the transcode cache,
+            # the url already points to an existing key
+            self.produce(instructions)
+            return
+
+        checkpoint = get_checkpoint(instructions, 'store')
+        if checkpoint:
+            instructions.update(checkpoint)
+        else:
+            storage = self.get_storage()
+            setups = storage.setups
+            started_at = time.time()
+            storage.with_connection(self.store_file, instructions)
+            self.get_step_timings(instructions)['upload'] = time.time() - started_at
+            instructions['metadata']['storage_setups'] = storage.setups - setups
+            save_checkpoint(instructions, 'store',
+                            url=instructions['url'],
+                            finalized_at=instructions['finalized_at'],
+                            metadata=instructions['metadata'])
+
+        finished_songs.add(Song(**instructions))
+        TranscodeCache().store(instructions)
+        self.produce(instructions)
+
+
+class TranscodeCache(object):
+    """Remembers the stored key and metadata of every conversion, indexed
+    by the hash of the source audio plus the ffmpeg arguments used to
+    encode it, so that uploading the same file twice converts and
+    uploads it only once.
+    """
+    prefix = 'cache:transcode'
+
+    def __init__(self, redis=None):
+        self.redis = redis or get_redis_connection()
+
+    def make_key(self, digest):
+        return ":".join([self.prefix, digest])
+
+    def get(self, digest):
+        raw = self.redis.get(self.make_key(digest))
+        if raw:
+            return json.loads(raw)
+
+    def set(self, digest, data):
+        self.redis.set(self.make_key(digest), json.dumps(data))
+
+    def lookup(self, instructions, audio):
+        """Fills the instructions with the result of a previous
+        conversion of the same audio and returns True, or just records
+        the digest for `store` and returns False. The digest is kept
+        out of the metadata, which is saved with the song"""
+        digest = audio.get_digest()
+        cached = self.get(digest)
+        metadata = instructions.get('metadata') or {}
+        instructions['metadata'] = metadata
+        if not cached:
+            instructions['transcode_digest'] = digest
+            return False
+
+        now = time.time()
+        instructions['url'] = cached['url']
+        metadata.update(cached['metadata'])
+        metadata['cached'] = True
+        self.copy_waveform(cached, instructions)
+        instructions['converted_at'] = now
+        instructions['finalized_at'] = now
+        return True
+
+    def copy_waveform(self, cached, instructions):
+        """The song is saved right away, so it gets the peaks of the
+        first conversion rather than decoding the audio again"""
+        metadata = instructions['metadata']
+        metadata.pop('waveform', None)
+        if not cached.get('token'):
+            return
+
+        description = WaveformStore(self.redis).copy(cached['token'], instructions['token'])
+        if description:
+            metadata['waveform'] = description
+
+    def store(self, instructions):
+        digest = instructions.get('transcode_digest')
+        if not digest:
+            return
+
+        metadata = dict(instructions['metadata'])
+        # the converted files live in the disk of the worker that
+        # first converted them
+        metadata.pop('final_path', None)
+        if 'renditions' in metadata:
+            metadata['renditions'] = dict(
+                (profile, dict((k, v) for k, v in rendition.items() if k != 'final_path'))
+                for profile, rendition in metadata['renditions'].items())
+        self.set(digest, {
+            'token': instructions['token'],
+            'url': instructions['url'],
+            'metadata': metadata,
+        })
+
+
+def file_sha1(path, chunk_size=1024 * 1024):
+    digest = sha1()
+    with open(path, 'rb') as fd:
+        for chunk in iter(partial(fd.read, chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+# the stages whose checkpoint was renamed, songs that failed before
+# the rename wait in the retry queue with the old name
+RENAMED_CHECKPOINTS = {
+    'store': 's3',
+}
+
+
+def get_checkpoint(instructions, stage):
+    checkpoints = instructions.get('checkpoints') or {}
+    old_name = RENAMED_CHECKPOINTS.get(stage)
+    if stage not in checkpoints and old_name in checkpoints:
+        checkpoints[stage] = checkpoints.pop(old_name)
+
+    return checkpoints.get(stage)
+
+
+def save_checkpoint(instructions, stage, **data):
+    """Records on the instructions that `stage` is done, so that a
+    retried song resumes at the first stage without a checkpoint"""
+    if not instructions.get('checkpoints'):
+        instructions['checkpoints'] = {}
+
+    instructions['checkpoints'][stage] = data
+    return data
+
+
+def get_converted_paths(metadata):
+    paths = set([metadata['final_path']])
+    for rendition in metadata.get('renditions', {}).values():
+        paths.add(rendition['final_path'])
+
+    return paths
+
+
+def checkpoint_conversion(instructions):
+    """Remembers the converted files with their sha1, the retried song
+    only skips ffmpeg if they are still intact on this worker"""
+    metadata = instructions['metadata']
+    paths = get_converted_paths(metadata)
+
+    return save_checkpoint(
+        instructions, 'convert',
+        files=dict((path, file_sha1(path)) for path in paths),
+        metadata=deepcopy(metadata),
+        converted_at=instructions['converted_at'])
+
+
+def resume_conversion(instructions):
+    """Restores the result of a previous conversion and returns True
+    when its files still exist and match their hashes"""
+    checkpoint = get_checkpoint(instructions, 'convert')
+    if not checkpoint:
+        return False
+
+    for path, digest in checkpoint['files'].items():
+        if not os.path.exists(path) or file_sha1(path) != digest:
+            log.warning("converted file %s is gone or changed, converting %s again",
+                        path, instructions['token'])
+            return False
+
+    instructions['metadata'] = checkpoint['metadata']
+    instructions['converted_at'] = checkpoint['converted_at']
+    return True
+
+
+class RetryQueue(object):
+    """Failed songs wait in a sorted set scored by the time of their
+    next attempt, with an exponential backoff. Songs that failed
+    `max_attempts` times go to a dead-letter list instead.
+
+    The instructions keep their checkpoints, so a retried song skips
+    the stages it already went through.
+    """
+    key = 'retry:songs'
+    dead_letter_key = 'deadletter:songs'
+
+    def __init__(self, redis=None, max_attempts=None, base_delay=None,
+                 max_delay=None):
+        self.redis = redis or get_redis_connection()
+        self.max_attempts = max_attempts or settings.RETRY_MAX_ATTEMPTS
+        self.base_delay = base_delay or settings.RETRY_BASE_DELAY
+        self.max_delay = max_delay or settings.RETRY_MAX_DELAY
+
+    def get_delay(self, attempts):
+        return min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+
+    def fail(self, instructions, now=None):
+        """Schedules another attempt of a failed song, returns when it
+        will happen or None if the song went to the dead-letter list"""
+        now = time.time() if now is None else now
+        error = instructions.pop('__lineup__error__', None) or {}
+        instructions['attempts'] = instructions.get('attempts', 0) + 1
+        instructions['last_error'] = error.get('traceback')
+
+        # the retry queue keeps the song from now on
+        if instructions.pop('leased', None):
+            JobLeases(redis=self.redis).release(instructions['token'])
+
+        if instructions['attempts'] >= self.max_attempts:
+            log.error("giving up on %s after %d attempts",
+                      instructions['token'], instructions['attempts'])
+            self.redis.lpush(self.dead_letter_key, json.dumps(instructions))
+            # its files would count against the staging quota forever
+            StagingArea(redis=self.redis).finalize([instructions['token']], now=now)
+            self.redis.publish(SONG_EVENTS_CHANNEL.format(instructions['token']),
+                               json.dumps({'stage': 'failed',
+                                           'attempts': instructions['attempts']}))
+            return None
+
+        retry_at = now + self.get_delay(instructions['attempts'])
+        self.redis.zadd(self.key, retry_at, json.dumps(instructions))
+        return retry_at
+
+    def due(self, now=None):
+        """Removes and returns the songs whose retry time has come"""
+        now = time.time() if now is None else now
+        jobs = []
+        for raw in self.redis.zrangebyscore(self.key, '-inf', now):
+            # another worker host might be pumping the same songs
+            if self.redis.zrem(self.key, raw):
+                jobs.append(json.loads(raw))
+
+        return jobs
+
+    def pump(self, scheduler, now=None):
+        """Hands the due songs back to the `SongScheduler`"""
+        jobs = self.due(now)
+        for job in jobs:
+            scheduler.push_again(job)
+
+        return jobs
+
+    def pump_forever(self, scheduler):
+        while True:
+            try:
+                self.pump(scheduler)
+            except Exception:
+                log.exception("failed to pump the retry queue")
+
+            time.sleep(settings.SCHEDULER_POLL_INTERVAL)
+
+    def dead_letters(self):
+        return [json.loads(raw) for raw in self.redis.lrange(self.dead_letter_key, 0, -1)]
+
+
+def retry_later(instructions):
+    print ("\033[1;31m",
+           instructions['__lineup__error__']['traceback'],
+           "\033[0m")
+    RetryQueue().fail(instructions)
+
+
+class ConversionError(Exception):
+    pass
+
+
+def parse_timestamp(value):
+    """Turns the `HH:MM:SS.ms` timestamps printed by ffmpeg into
+    seconds"""
+    seconds = 0.0
+    for part in value.strip().split(':'):
+        seconds = seconds * 60 + float(part)
+
+    return seconds
+
+
+def kill_process(process):
+    try:
+        process.kill()
+    except OSError:
+        # it exited in the meantime
+        pass
+
+
+def probe(filename, timeout=None):
+    """Reads the container and stream headers of `filename` with
+    ffprobe, no audio gets decoded. ffprobe is killed after `timeout`
+    seconds, `settings.PROBE_TIMEOUT` by default"""
+    command = [
+        settings.FFPROBE_BIN,
+        '-v', 'error',
+        '-print_format', 'json',
+        '-show_format',
+        '-show_streams',
+        filename,
+    ]
+    with spawn_lock:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE)
+
+    timer = threading.Timer(timeout or settings.PROBE_TIMEOUT, kill_process, (process, ))
+    timer.start()
+    try:
+        output = process.communicate()[0]
+    finally:
+        timer.cancel()
+
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command, output)
+
+    return json.loads(output)
+
+
+def format_timestamp(seconds):
+    """The opposite of `parse_timestamp`"""
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return '{0:02d}:{1:02d}:{2:05.2f}'.format(hours, minutes, seconds)
+
+
+def parse_bitrate(value):
+    """Turns ffmpeg bitrates like `450k` into bits per second"""
+    value = value.lower()
+    multiplier = {'k': 1000, 'm': 1000000}.get(value[-1:], 1)
+    return int(float(value.rstrip('km')) * multiplier)
+
+
+def get_profile_option(profile, name):
+    args = ENCODING_PROFILES[profile]
+    if name in args:
+        return args[args.index(name) + 1]
+
+
+class FFmpegProgress(object):
+    """Parses the stderr of ffmpeg line by line while it runs.
+
+    ffmpeg is called with `-progress pipe:2`, so its stderr mixes the
+    regular log with blocks of `key=value` lines, each block ending
+    with a `progress=` line. The log lines are kept in `output` and
+    every block is given to `callback(out_time, duration, **extra)`.
+    """
+    regex = re.compile(br'^(\w+)=\s*(\S*)$')
+    duration_regex = re.compile(br'Duration: ([\d:.]+)')
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.lines = []
+        self.current = {}
+        self.duration = None
+        self.out_time = 0.0
+        self.speed = None
+        self.bitrate = None
+
+    @property
+    def output(self):
+        return b''.join(self.lines)
+
+    def feed(self, line):
+        found = self.regex.match(line.strip())
+        if not found:
+            self.lines.append(line)
+            self.parse_duration(line)
+            return
+
+        key, value = found.groups()
+        self.current[key] = value
+        if key == b'progress':
+            self.parse_block(self.current)
+            self.current = {}
+
+    def parse_duration(self, line):
+        found = self.duration_regex.search(line)
+        if found and self.duration is None:
+            self.duration = parse_timestamp(found.group(1))
+
+    def parse_block(self, block):
+        if block.get(b'out_time'):
+            self.out_time = parse_timestamp(block[b'out_time'])
+
+        speed = block.get(b'speed', b'').rstrip(b'x')
+        self.speed = speed and speed != b'N/A' and float(speed) or None
+        self.bitrate = block.get(b'bitrate')
+
+        if self.callback:
+            self.callback(self.out_time, self.duration,
+                          speed=self.speed, bitrate=self.bitrate)
+
+
+class OggConverter(object):
+    chunk_size = 64 * 1024
+    watch_interval = 1
+
+    def __init__(self, source_filename, progress=None, profiles=None,
+                 source_digest=None, waveform=None):
+        self.source_filename = source_filename
+        self.source_digest = source_digest
+        self.progress = progress
+        self.profiles = profiles or settings.ENCODING_PROFILES
+        self.waveform = waveform
+        self.waveform_levels = None
+        self.peaks = None
+        self.pcm_reader = None
+        self.output = None
+        self.too_slow = False
+        self.stalled = 0
+        self.stalled_at = None
+        self.stall_lock = threading.Lock()
+        self.source = None
+        self.copies = set()
+
+    def get_encoding_args(self, profile=None):
+        return [
+            '-strict', '-2', '-acodec', 'vorbis',
+        ] + ENCODING_PROFILES[profile or self.profiles[0]] + [
+            # the container can't be guessed when writing to `pipe:1`
+            '-f', 'ogg',
+        ]
+
+    def get_input_args(self):
+        return [
+            settings.FFMPEG_BIN,
+            '-loglevel', 'info',
+            '-nostats', '-progress', 'pipe:2',
+            '-y', '-i', self.source_filename,
+        ]
+
+    def get_args(self, final_path, profile=None):
+        return self.get_multi_args([(profile or self.profiles[0], final_path)])
+
+    def get_multi_args(self, outputs):
+        """Takes a list of (profile, path) and returns the arguments
+        that make ffmpeg decode the source once and encode it for
+        every output"""
+        args = self.get_input_args()
+        for profile, path in outputs:
+            args.extend(['-map', '0:a'])
+            if profile in self.copies:
+                args.extend(['-acodec', 'copy', '-f', 'ogg'])
+            else:
+                args.extend(self.get_encoding_args(profile))
+            args.append(path)
+
+        return args
+
+    def probe_source(self):
+        """Returns the container, codec, channels, sample rate and
+        bitrate of the source, or None when ffprobe can't read it"""
+        try:
+            info = probe(self.source_filename)
+            streams = info.get('streams', [])
+            audio = [s for s in streams if s.get('codec_type') == 'audio'][0]
+            container = info.get('format', {})
+            return {
+                'format_name': container.get('format_name'),
+                'streams': len(streams),
+                'codec_name': audio.get('codec_name'),
+                'channels': int(audio.get('channels') or 0),
+                'sample_rate': int(audio.get('sample_rate') or 0),
+                'bit_rate': int(audio.get('bit_rate') or container.get('bit_rate') or 0),
+                'duration': float(container.get('duration') or 0),
+            }
+        except Exception:
+            log.warning("could not probe %s, encoding it anyway",
+                        self.source_filename, exc_info=True)
+
+    def can_copy(self, profile):
+        """Whether the source audio can be used as is for the given
+        profile: it is vorbis already, at or below the profile's
+        bitrate and with the same sample rate, if the profile sets one"""
+        source = self.source
+        if not source or source['codec_name'] != 'vorbis' or not source['bit_rate']:
+            return False
+
+        if source['channels'] > MAX_COPY_CHANNELS:
+            return False
+
+        bitrate = get_profile_option(profile, '-ab')
+        if bitrate and source['bit_rate'] > parse_bitrate(bitrate):
+            return False
+
+        sample_rate = get_profile_option(profile, '-ar')
+        if sample_rate and source['sample_rate'] != int(sample_rate):
+            return False
+
+        return True
+
+    def plan(self, outputs):
+        """Probes the source and returns the encode path:
+
+        * `passthrough`: the source is an ogg file with nothing but
+          vorbis audio that suits every profile, it is used as is
+        * `remux`: the vorbis audio suits every profile but lives in
+          another container, ffmpeg copies it without encoding
+        * `transcode`: at least one profile is encoded, the others
+          are copied
+        """
+        self.source = self.probe_source()
+        self.copies = set(p for p, _ in outputs if self.can_copy(p))
+
+        if len(self.copies) < len(outputs):
+            return 'transcode'
+
+        if self.source['format_name'] == 'ogg' and self.source['streams'] == 1:
+            return 'passthrough'
+
+        return 'remux'
+
+    def get_source_metadata(self):
+        """The same metadata that `parse_metadata` finds in the ffmpeg
+        output, built from the probe"""
+        return {
+            'duration': format_timestamp(self.source['duration']),
+            'bitrate': '{0} kb/s'.format(self.source['bit_rate'] // 1000),
+        }
+
+    def describe(self, metadata, encode_path):
+        metadata['encode_path'] = encode_path
+        metadata['source'] = self.source
+        return metadata
+
+    def get_outputs(self, final_path):
+        """The first profile is written to `final_path`, the other
+        ones next to it as `<name>.<profile>.ogg`"""
+        base = os.path.splitext(final_path)[0]
+        outputs = [(self.profiles[0], final_path)]
+        for profile in self.profiles[1:]:
+            outputs.append((profile, '{0}.{1}.ogg'.format(base, profile)))
+
+        return outputs
+
+    def get_digest(self):
+        """Returns a sha1 of the encoding arguments and of the sha1 of
+        the source audio, it changes whenever either would produce a
+        different output. The source is only read when its sha1 was
+        not computed during the upload"""
+        encoding = [self.get_encoding_args(p) for p in self.profiles]
+        digest = sha1(json.dumps(encoding))
+        digest.update(self.source_digest or
+                      file_sha1(self.source_filename, self.chunk_size))
+        return digest.hexdigest()
+
+    def add_waveform_output(self, command):
+        """Makes ffmpeg also write the pcm of the `waveform` to a pipe,
+        the source is decoded once for the renditions and the peaks.
+        Returns both ends of the pipe and the new command"""
+        read_fd, write_fd = os.pipe()
+        fcntl.fcntl(read_fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        position = len(self.get_input_args())
+        output = self.waveform.get_output_args('pipe:{0}'.format(write_fd))
+        return read_fd, write_fd, command[:position] + output + command[position:]
+
+    def start(self, command, **kw):
+        """Starts ffmpeg along with a thread that parses its stderr,
+        another one that kills it when it runs too slowly and, when a
+        `waveform` is wanted, one that computes the peaks of its pcm"""
+        self.parser = FFmpegProgress(self.progress)
+        self.started_at = time.time()
+
+        with spawn_lock:
+            if self.waveform:
+                pcm_fd, write_fd, command = self.add_waveform_output(command)
+
+            try:
+                process = subprocess.Popen(command, stderr=subprocess.PIPE, **kw)
+            except Exception:
+                if self.waveform:
+                    os.close(pcm_fd)
+                raise
+            finally:
+                if self.waveform:
+                    os.close(write_fd)
+
+        if self.waveform:
+            self.pcm_reader = threading.Thread(
+                target=self.read_pcm, args=(os.fdopen(pcm_fd, 'rb'), ))
+            self.pcm_reader.daemon = True
+            self.pcm_reader.start()
+
+        self.reader = threading.Thread(target=self.read_stderr, args=(process, ))
+        self.reader.daemon = True
+        self.reader.start()
+
+        watchdog = threading.Thread(target=self.watch, args=(process, ))
+        watchdog.daemon = True
+        watchdog.start()
+        return process
+
+    def read_stderr(self, process):
+        for line in iter(process.stderr.readline, b''):
+            self.parser.feed(line)
+
+    def read_pcm(self, pcm):
+        builder = PeakBuilder(self.waveform.samples_per_peak)
+        failed = False
+        try:
+            # drained until the end even after a failure, ffmpeg would
+            # block writing to it otherwise
+            for chunk in iter(partial(pcm.read, self.chunk_size), b''):
+                if failed:
+                    continue
+
+                try:
+                    builder.feed(chunk)
+                except Exception:
+                    log.warning("could not compute the peaks of %s",
+                                self.source_filename, exc_info=True)
+                    failed = True
+        finally:
+            pcm.close()
+
+        if not failed:
+            self.peaks = builder.finish()
+
+    def finish_waveform(self):
+        """The peaks of every zoom level, or None when the song has no
+        waveform: it is still published without one"""
+        if self.pcm_reader is None:
+            return None
+
+        self.pcm_reader.join()
+        if not self.peaks:
+            return None
+
+        return self.waveform.get_levels(self.peaks)
+
+    def decode_waveform(self):
+        """Sources that are passed through never go through ffmpeg,
+        their pcm is decoded on its own"""
+        if not self.waveform:
+            return None
+
+        try:
+            return self.waveform.compute()
+        except Exception:
+            log.warning("could not compute the waveform of %s",
+                        self.source_filename, exc_info=True)
+
+    def stall(self, now=None):
+        """Stops counting time towards the speed of the conversion:
+        while the consumer of `stream` holds a chunk, ffmpeg is blocked
+        writing to its stdout rather than slow"""
+        with self.stall_lock:
+            self.stalled_at = time.time() if now is None else now
+
+    def resume(self, now=None):
+        now = time.time() if now is None else now
+        with self.stall_lock:
+            if self.stalled_at is not None:
+                self.stalled += now - self.stalled_at
+                self.stalled_at = None
+
+    def get_running_time(self, now):
+        """Seconds since ffmpeg started, minus the time its output
+        waited on the consumer"""
+        with self.stall_lock:
+            stalled = self.stalled
+            if self.stalled_at is not None:
+                stalled += max(0, now - self.stalled_at)
+
+        return now - self.started_at - stalled
+
+    def is_too_slow(self, now):
+        elapsed = self.get_running_time(now)
+        if elapsed < settings.FFMPEG_SPEED_GRACE:
+            return False
+
+        return self.parser.out_time / elapsed < settings.FFMPEG_MIN_SPEED
+
+    def watch(self, process):
+        while process.poll() is None:
+            time.sleep(self.watch_interval)
+            if process.poll() is None and self.is_too_slow(time.time()):
+                log.warning("Killing ffmpeg for %s, it converted %ss in %ss",
+                            self.source_filename, self.parser.out_time,
+                            time.time() - self.started_at)
+                self.too_slow = True
+                process.kill()
+
+    def finish(self, process):
+        failed = process.wait()
+        self.reader.join()
+        self.waveform_levels = self.finish_waveform()
+
+        if self.too_slow:
+            raise ConversionError(
+                "ffmpeg was slower than {0}x realtime converting {1}".format(
+                    settings.FFMPEG_MIN_SPEED, self.source_filename))
+
+        if failed:
+            raise ConversionError(self.parser.output)
+
+        return self.parse_metadata(BytesIO(self.parser.output))
+
+    def convert(self, final_path=None):
+        final_path = final_path or self.source_filename + b'.ogg'
+        outputs = self.get_outputs(final_path)
+        encode_path = self.plan(outputs)
+
+        if encode_path == 'passthrough':
+            # every rendition would be identical to the source
+            shutil.copyfile(self.source_filename, final_path)
+            metadata = self.get_source_metadata()
+            self.waveform_levels = self.decode_waveform()
+            outputs = [(profile, final_path) for profile, _ in outputs]
+        else:
+            process = self.start(self.get_multi_args(outputs))
+            metadata = self.finish(process)
+
+        metadata['final_path'] = final_path
+        metadata['renditions'] = dict(
+            (profile, {
+                'final_path': path,
+                'encode_path': 'copy' if profile in self.copies else 'encode',
+            }) for profile, path in outputs)
+        return self.describe(metadata, encode_path)
+
+    def stream(self, chunk_size=None):
+        """Runs ffmpeg with its output going to stdout and yields the
+        encoded audio in chunks of `chunk_size` bytes while the
+        conversion is still running.
+
+        The parsed metadata is available at `self.output` once the
+        generator is exhausted.
+        """
+        chunk_size = chunk_size or self.chunk_size
+        encode_path = self.plan([(self.profiles[0], 'pipe:1')])
+        if encode_path == 'passthrough':
+            with open(self.source_filename, 'rb') as source:
+                for chunk in iter(partial(source.read, chunk_size), b''):
+                    yield chunk
+
+            self.waveform_levels = self.decode_waveform()
+            self.output = self.describe(self.get_source_metadata(), encode_path)
+            return
+
+        process = self.start(self.get_args('pipe:1'), stdout=subprocess.PIPE)
+
+        read = partial(process.stdout.read, chunk_size)
+        try:
+            for chunk in iter(read, b''):
+                # the storage may take a while to send a whole part
+                self.stall()
+                yield chunk
+                self.resume()
+        finally:
+            process.stdout.close()
+            process.wait()
+
+        self.output = self.describe(self.finish(process), encode_path)
+
+    def parse_metadata(self, output):
+        output.seek(0)
+        # Duration: 00:07:58.00, start: 0.000000, bitrate: 1411 kb/s
+        regex = re.compile(b'Duration: ([\d:]+).*bitrate:\s*(.*[/]s)')
+        found = regex.search(output.read())
+        if found:
+            duration = found.group(1)
+            bitrate = found.group(2)
+            return {
+                'duration': duration,
+                'bitrate': bitrate,
+            }
+        else:
+            return {}
+
+
+class FetchFromS3(ConcurrentStep, S3Worker):
+    """Downloads the sources that browsers uploaded straight to the
+    bucket, see `web.controllers.initiate_upload`, up to
+    `settings.FETCH_SLOTS` at the same time. Songs uploaded through
+    the web tier already have their file and pass through"""
+
+    def get_slots(self):
+        if self.slots is None:
+            self.slots = get_fetch_slots()
+
+        return self.slots
+
+    def get_bucket(self, instructions):
+        return connections.get_bucket(settings.S3_BUCKET)
+
+    def is_fetched(self, instructions):
+        return bool(get_checkpoint(instructions, 'fetch') and
+                    os.path.exists(instructions['filename']))
+
+    def fetch(self, instructions):
+        key = self.get_bucket(instructions).get_key(instructions['source_key'])
+        if key is None:
+            raise IOError("{0} is not in the bucket".format(instructions['source_key']))
+
+        progress = ProgressReporter(instructions['token'], 'fetch')
+        folder = os.path.dirname(instructions['filename'])
+        make_folder(folder)
+        staged = StagedUpload(folder, chunk_size=settings.UPLOAD_CHUNK_SIZE)
+        try:
+            key.get_contents_to_file(staged, cb=progress.update, num_cb=-1)
+            staged.move_to(instructions['filename'])
+        finally:
+            staged.close()
+
+        progress.flush()
+        instructions['source_sha1'] = staged.hexdigest()
+        instructions['source_size'] = staged.size
+
+    def consume(self, instructions):
+        if instructions.get('source_key') and not self.is_fetched(instructions):
+            return super(FetchFromS3, self).consume(instructions)
+
+        self.start_timer(instructions).start()
+        claim_lease(instructions)
+        self.produce(instructions)
+
+    def process(self, instructions):
+        self.refreshing_connection(self.fetch, instructions)
+        StagingArea().add(instructions['token'], [instructions['filename']])
+        save_checkpoint(instructions, 'fetch',
+                        source_sha1=instructions['source_sha1'])
+        self.produce(instructions)
+
+
+def store_waveform(instructions, audio):
+    """Stores the min/max peaks that `audio` computed from the pcm of
+    the conversion, see `oggweed.waveform`. A song whose waveform
+    could not be computed is still published, just without one"""
+    if audio.waveform_levels is None:
+        return
+
+    instructions['metadata']['waveform'] = WaveformStore().store(
+        instructions['token'], audio.waveform, audio.waveform_levels)
+
+
+class AnythingToOgg(ConcurrentStep):
+    def process(self, instructions):
+        source_filename = instructions['filename']
+        progress = ProgressReporter(instructions['token'], 'convert')
+        audio = OggConverter(source_filename, progress=progress.update,
+                             source_digest=instructions.get('source_sha1'),
+                             waveform=Waveform(source_filename))
+
+        if resume_conversion(instructions):
+            self.produce(instructions)
+            return
+
+        if TranscodeCache().lookup(instructions, audio):
+            finished_songs.add(Song(**instructions))
+            self.produce(instructions)
+            return
+
+        started_at = time.time()
+        metadata = audio.convert()
+        self.get_step_timings(instructions)['ffmpeg'] = time.time() - started_at
+        progress.flush()
+
+        instructions['metadata'].update(metadata)
+        store_waveform(instructions, audio)
+        instructions['converted_at'] = time.time()
+        StagingArea().add(instructions['token'], get_converted_paths(metadata))
+        checkpoint_conversion(instructions)
+        self.produce(instructions)
+
+
+class StreamToStorage(ConcurrentStep, StoreSong):
+    """Converts the uploaded file and sends the encoded audio to the
+    storage while ffmpeg is still running, the `.ogg` file never
+    touches the local disk"""
+
+    def process(self, instructions):
+        source_filename = instructions['filename']
+        progress = ProgressReporter(instructions['token'], 'convert')
+        audio = OggConverter(source_filename, progress=progress.update,
+                             source_digest=instructions.get('source_sha1'),
+                             waveform=Waveform(source_filename))
+
+        cache = TranscodeCache()
+        if cache.lookup(instructions, audio):
+            finished_songs.add(Song(**instructions))
+            self.produce(instructions)
+            return
+
+        storage = self.get_storage()
+        setups = storage.setups
+        self.store_stream(instructions, audio.stream())
+        progress.flush()
+
+        instructions['metadata'].update(audio.output)
+        instructions['metadata']['storage_setups'] = storage.setups - setups
+        store_waveform(instructions, audio)
+        instructions['converted_at'] = instructions['finalized_at']
+        finished_songs.add(Song(**instructions))
+        cache.store(instructions)
+        self.produce(instructions)
+
+
+class OggPipeline(Pipeline):
+    steps = [FetchFromS3, AnythingToOgg, StoreSong]
+
+
+class StreamingOggPipeline(Pipeline):
+    steps = [FetchFromS3, StreamToStorage]
+
+
+def get_pipeline_class():
+    """Returns the pipeline that should receive new songs, according
+    to `settings.STREAMING_TRANSCODE`"""
+    if settings.STREAMING_TRANSCODE:
+        return StreamingOggPipeline
+
+    return OggPipeline
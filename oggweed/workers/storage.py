@@ -0,0 +1,435 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+oggweed.workers.storage
+~~~~~~~~~~~~~~~~~~~~~~~
+
+Where the converted songs are published. `settings.STORAGE_BACKEND`
+picks one of `STORAGE_BACKENDS`: S3, or a folder of the local
+filesystem that the web app serves itself, see `web.controllers.media`.
+"""
+from __future__ import unicode_literals
+import os
+import abc
+import boto
+import socket
+import logging
+import threading
+from io import BytesIO
+from urllib import quote
+from hashlib import md5
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+from boto.s3.connection import Location, OrdinaryCallingFormat
+from boto.s3.key import Key
+from boto.exception import S3ResponseError
+
+from oggweed import settings
+
+log = logging.getLogger('goloka:workers:s3')
+
+# S3 answers with these when the credentials or the endpoint of a
+# cached connection are no longer valid
+REFRESH_STATUSES = (301, 307, 400, 403)
+
+
+class S3Connections(object):
+    """Keeps one boto connection and the bucket handles looked up
+    through it for the whole process, they are only created again
+    after `reset` or after a fork.
+
+    `setups` counts how many connections and bucket lookups were made,
+    which is what S3 charges us a round trip for, and
+    `get_thread_setups` how many of them the calling thread made.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.setups = 0
+        self.reset()
+
+    def count_setup(self):
+        self.setups += 1
+        self.local.setups = self.get_thread_setups() + 1
+
+    def get_thread_setups(self):
+        """A song is stored by a single thread, so the difference of
+        this count is the cost of that song alone even while other
+        threads store theirs"""
+        return getattr(self.local, 'setups', 0)
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.connection = None
+        self.buckets = {}
+
+    def check_pid(self):
+        # a forked process must never share the parent's sockets
+        if self.pid != os.getpid():
+            self.reset()
+
+    def get_connection_kwargs(self):
+        if not settings.S3_HOST:
+            return {}
+
+        return {
+            'host': settings.S3_HOST,
+            'port': settings.S3_PORT,
+            'is_secure': settings.S3_SECURE,
+            'calling_format': OrdinaryCallingFormat(),
+        }
+
+    def get_connection(self):
+        with self.lock:
+            self.check_pid()
+            if self.connection is None:
+                self.connection = boto.connect_s3(**self.get_connection_kwargs())
+                self.count_setup()
+
+            return self.connection
+
+    def get_bucket(self, bucket_name):
+        connection = self.get_connection()
+        with self.lock:
+            bucket = self.buckets.get(bucket_name)
+            if bucket is None:
+                bucket = connection.lookup(bucket_name)
+                self.count_setup()
+
+            if bucket is not None:
+                self.buckets[bucket_name] = bucket
+
+            return bucket
+
+
+connections = S3Connections()
+
+
+def refreshing_connection(method, *args, **kw):
+    """Calls the given method, if it fails because of the cached
+    connection then it is called once more with a new one"""
+    try:
+        return method(*args, **kw)
+    except (S3ResponseError, socket.error) as e:
+        status = getattr(e, 'status', None)
+        if isinstance(e, S3ResponseError) and status not in REFRESH_STATUSES:
+            raise
+
+        log.warning("Reconnecting to S3 after %r", e)
+        connections.reset()
+        return method(*args, **kw)
+
+
+class MultipartUpload(object):
+    """Buffers chunks of any size and sends them to S3 as the parts
+    of a multipart upload as soon as `part_size` bytes are available,
+    so that the data can be uploaded before its total size is known.
+    """
+    minimum_part_size = 5 * 1024 * 1024
+
+    def __init__(self, bucket, key_name, part_size=None, callback=None):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.part_size = max(part_size or 0, self.minimum_part_size)
+        self.callback = callback
+        self.buffer = BytesIO()
+        self.part_number = 0
+        self.sent = 0
+        self.multipart = bucket.initiate_multipart_upload(key_name)
+
+    def write(self, chunk):
+        self.buffer.write(chunk)
+        if self.buffer.tell() >= self.part_size:
+            self.flush()
+
+    def flush(self):
+        size = self.buffer.tell()
+        if not size:
+            return
+
+        self.part_number += 1
+        self.buffer.seek(0)
+        self.multipart.upload_part_from_file(
+            self.buffer, self.part_number, size=size)
+
+        self.buffer = BytesIO()
+        self.sent += size
+        if self.callback:
+            self.callback(self.sent, None)
+
+    def close(self):
+        # the last part is the only one allowed to be smaller than
+        # `minimum_part_size`
+        self.flush()
+        return self.multipart.complete_upload()
+
+    def cancel(self):
+        return self.multipart.cancel_upload()
+
+
+class ResumableUpload(object):
+    """Sends a local file to S3 as a multipart upload with up to
+    `concurrency` parts in flight.
+
+    An unfinished multipart upload of the same key is resumed rather
+    than started over: parts whose size and md5 match the local file
+    are not sent again. Failed uploads are left unfinished on purpose,
+    so that the next attempt can pick them up.
+    """
+    minimum_part_size = MultipartUpload.minimum_part_size
+
+    def __init__(self, bucket, key_name, filename, part_size=None,
+                 concurrency=1, retries=None, callback=None):
+        self.bucket = bucket
+        self.key_name = key_name
+        self.filename = filename
+        self.part_size = max(part_size or 0, self.minimum_part_size)
+        self.concurrency = concurrency
+        self.retries = retries or settings.S3_PART_RETRIES
+        self.callback = callback
+        self.total = os.path.getsize(filename)
+        self.sent = 0
+        self.lock = threading.Lock()
+
+    def get_multipart(self):
+        """Returns the unfinished upload of this key or a new one"""
+        existing = self.bucket.get_all_multipart_uploads(prefix=self.key_name)
+        for multipart in existing:
+            if multipart.key_name == self.key_name:
+                log.info("Resuming upload %s of %s", multipart.id, self.key_name)
+                return multipart
+
+        return self.bucket.initiate_multipart_upload(self.key_name)
+
+    def get_parts(self):
+        """Returns a list of (part_number, offset, size)"""
+        parts = []
+        for number, offset in enumerate(range(0, self.total, self.part_size), 1):
+            size = min(self.part_size, self.total - offset)
+            parts.append((number, offset, size))
+
+        return parts
+
+    def read_part(self, offset, size):
+        with open(self.filename, 'rb') as source:
+            source.seek(offset)
+            return source.read(size)
+
+    def is_uploaded(self, part, offset, size):
+        if part is None or part.size != size:
+            return False
+
+        checksum = md5(self.read_part(offset, size)).hexdigest()
+        return part.etag.strip('"') == checksum
+
+    def report(self, size):
+        with self.lock:
+            self.sent += size
+            sent = self.sent
+
+        if self.callback:
+            self.callback(sent, self.total)
+
+    def upload_part(self, multipart, number, offset, size):
+        for attempt in range(1, self.retries + 1):
+            try:
+                data = BytesIO(self.read_part(offset, size))
+                multipart.upload_part_from_file(data, number, size=size)
+                break
+            except Exception:
+                log.exception("Failed to upload part %s of %s (attempt %s)",
+                              number, self.key_name, attempt)
+                if attempt == self.retries:
+                    raise
+
+        self.report(size)
+
+    def run(self):
+        multipart = self.get_multipart()
+        uploaded = dict((part.part_number, part) for part in multipart)
+
+        pending = []
+        for number, offset, size in self.get_parts():
+            if self.is_uploaded(uploaded.get(number), offset, size):
+                self.report(size)
+            else:
+                pending.append((number, offset, size))
+
+        pool = ThreadPool(max(1, min(self.concurrency, len(pending))))
+        try:
+            pool.map(lambda part: self.upload_part(multipart, *part), pending)
+        finally:
+            pool.close()
+            pool.join()
+
+        return multipart.complete_upload()
+
+
+class Storage(object):
+    """Keeps the converted files under a key name and tells the url
+    they are published at. Backends implement the abstract methods.
+
+    The `progress` callbacks are called with the bytes sent so far
+    and the total, or None when it is not known yet.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    # how many connections or lookups the calling thread paid for so far
+    setups = 0
+
+    @abc.abstractmethod
+    def get_url(self, key_name):
+        """Returns the public url of a stored key"""
+
+    @abc.abstractmethod
+    def store_file(self, key_name, local_path, progress=None):
+        """Stores a local file and returns its public url"""
+
+    @abc.abstractmethod
+    def store_stream(self, key_name, chunks, progress=None):
+        """Stores an iterable of byte chunks of unknown total size and
+        returns its public url"""
+
+    def with_connection(self, method, *args, **kw):
+        """Runs a method that stores files, backends that keep
+        connections retry it when they went stale"""
+        return method(*args, **kw)
+
+
+class S3Storage(Storage):
+    """Publishes the songs as public keys of `settings.S3_BUCKET`"""
+
+    def __init__(self, bucket_name=None):
+        self.bucket_name = bucket_name or settings.S3_BUCKET
+
+    @property
+    def setups(self):
+        return connections.get_thread_setups()
+
+    def get_bucket(self):
+        bucket = connections.get_bucket(self.bucket_name)
+        log.info("Bucket lookup: %s %s", self.bucket_name, bucket)
+        return bucket
+
+    def get_or_create_bucket(self):
+        bucket = self.get_bucket()
+        if not bucket:
+            bucket = connections.get_connection().create_bucket(
+                self.bucket_name,
+                location=Location.USWest,
+                policy='public-read')
+            log.info("Bucket created: %s", bucket)
+
+        bucket.make_public(recursive=True)
+        return bucket
+
+    def publish(self, key):
+        key.make_public()
+        return key.generate_url(0, query_auth=False, force_http=True)
+
+    def get_url(self, key_name):
+        return Key(self.get_bucket(), key_name).generate_url(
+            0, query_auth=False, force_http=True)
+
+    def store_file(self, key_name, local_path, progress=None):
+        bucket = self.get_bucket()
+        key = Key(bucket, key_name)
+
+        if os.path.getsize(local_path) > settings.S3_PART_SIZE:
+            upload = ResumableUpload(
+                bucket, key_name, local_path,
+                part_size=settings.S3_PART_SIZE,
+                concurrency=settings.S3_UPLOAD_CONCURRENCY,
+                callback=progress)
+            upload.run()
+        else:
+            key.set_contents_from_filename(local_path, cb=progress)
+
+        return self.publish(key)
+
+    def store_stream(self, key_name, chunks, progress=None):
+        """Sends the chunks as a multipart upload"""
+        bucket = self.get_bucket()
+        upload = MultipartUpload(
+            bucket, key_name,
+            part_size=settings.S3_PART_SIZE,
+            callback=progress)
+
+        try:
+            for chunk in chunks:
+                upload.write(chunk)
+            upload.close()
+        except Exception:
+            upload.cancel()
+            raise
+
+        return self.publish(Key(bucket, key_name))
+
+    def with_connection(self, method, *args, **kw):
+        return refreshing_connection(method, *args, **kw)
+
+
+class LocalStorage(Storage):
+    """Keeps the songs in a folder of this host, the web app serves
+    them from `settings.LOCAL_STORAGE_URL` with support for ranges.
+
+    Meant for single host deployments, tests and benchmarks: the
+    workers and the web app must share the folder.
+    """
+    chunk_size = 1024 * 1024
+
+    def __init__(self, root=None, base_url=None):
+        self.root = os.path.abspath(root or settings.LOCAL_STORAGE_ROOT)
+        self.base_url = base_url or settings.LOCAL_STORAGE_URL
+
+    def get_path(self, key_name):
+        """Returns the local path of a key, or None for names that
+        would escape the storage folder"""
+        path = os.path.abspath(os.path.join(self.root, key_name))
+        if not path.startswith(self.root + os.sep):
+            return None
+
+        return path
+
+    def get_url(self, key_name):
+        return '{0}/{1}'.format(self.base_url.rstrip('/'),
+                                quote(key_name.encode('utf-8')))
+
+    def store_file(self, key_name, local_path, progress=None):
+        with open(local_path, 'rb') as source:
+            chunks = iter(partial(source.read, self.chunk_size), b'')
+            return self.store_stream(key_name, chunks, progress)
+
+    def store_stream(self, key_name, chunks, progress=None):
+        path = self.get_path(key_name)
+        if path is None:
+            raise ValueError("invalid key name {0!r}".format(key_name))
+
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        # readers never see a partial file
+        partial_path = '{0}.part'.format(path)
+        written = 0
+        with open(partial_path, 'wb') as output:
+            for chunk in chunks:
+                output.write(chunk)
+                written += len(chunk)
+                if progress:
+                    progress(written, None)
+
+        os.rename(partial_path, path)
+        return self.get_url(key_name)
+
+
+STORAGE_BACKENDS = {
+    's3': S3Storage,
+    'local': LocalStorage,
+}
+
+
+def get_storage(name=None):
+    """Returns the backend named by `settings.STORAGE_BACKEND`"""
+    return STORAGE_BACKENDS[name or settings.STORAGE_BACKEND]()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2013 OggWeed LLC
+#
+from __future__ import unicode_literals
+
+"""
+tests.benchmarks.bench_conversion_slots
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Converts the same local corpus with an increasing number of
+`ConversionSlots` and prints the throughput of each run.
+
+Usage:
+
+    FFMPEG_BIN=`which ffmpeg` python -m tests.benchmarks.bench_conversion_slots
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from oggweed import settings
+from oggweed.workers import OggConverter, ConversionSlots
+from tests.benchmarks.fixtures import generate_corpus
+
+
+def convert_corpus(paths, slots):
+    pool = ConversionSlots(slots)
+    started = time.time()
+    for path in paths:
+        pool.submit(OggConverter(path).convert)
+
+    pool.join()
+    return time.time() - started
+
+
+def main(max_slots=None, copies=4):
+    # every copy is a separate file, so that concurrent conversions
+    # never write to the same `.ogg`
+    max_slots = max_slots or settings.CONVERSION_SLOTS
+    folder = tempfile.mkdtemp(prefix='oggweed-bench-')
+    try:
+        paths = generate_corpus(folder, durations=(5, 10, 20, 40) * copies)
+        sys.stdout.write("{0} files, up to {1} slots\n".format(len(paths), max_slots))
+
+        slots = 1
+        baseline = None
+        while slots <= max_slots:
+            elapsed = convert_corpus(paths, slots)
+            baseline = baseline or elapsed
+            sys.stdout.write(
+                "slots={0:<3} {1:6.2f}s {2:6.2f} songs/s speedup={3:.2f}x\n".format(
+                    slots, elapsed, len(paths) / elapsed, baseline / elapsed))
+            slots *= 2
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
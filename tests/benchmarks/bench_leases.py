@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2013 OggWeed LLC
+#
+from __future__ import unicode_literals
+
+"""
+tests.benchmarks.bench_leases
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Starts a few worker processes that share one local redis-server,
+schedules fake jobs through `SongScheduler`, kills one worker with
+SIGKILL halfway and measures how long it takes for its leased songs
+to be delivered again and finished by the survivors.
+
+The jobs just sleep, no ffmpeg nor S3 is involved. Uses redis db 15,
+which gets flushed.
+
+Usage:
+
+    python -m tests.benchmarks.bench_leases [--workers 3] [--jobs 60]
+"""
+
+import os
+import sys
+import time
+import signal
+import argparse
+import threading
+import multiprocessing
+from Queue import Queue
+
+from oggweed import settings
+from oggweed.framework.db import get_redis_connection
+from oggweed.workers import ConversionSlots
+from oggweed.scheduling import SongScheduler
+from oggweed.coordination import WorkerRegistry, JobLeases, heartbeat_forever
+
+FINISHED_KEY = 'bench:leases:finished'
+
+
+def run_worker(node, slots, job_duration):
+    redis = get_redis_connection(15)
+    leases = JobLeases(redis=redis, node=node)
+    scheduler = SongScheduler(redis=redis, leases=leases)
+    slots = ConversionSlots(slots)
+    queue = Queue()
+
+    def process(job):
+        leases.claim(job)
+        time.sleep(job_duration)
+        redis.sadd(FINISHED_KEY, job['token'])
+        leases.release(job['token'])
+
+    def consume():
+        while True:
+            slots.submit(process, queue.get())
+
+    for target, args in [(consume, ()),
+                         (scheduler.feed_forever, (queue, slots)),
+                         (heartbeat_forever, (WorkerRegistry(redis=redis, node=node),
+                                              leases, slots, scheduler))]:
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    while True:
+        time.sleep(1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--slots', type=int, default=2)
+    parser.add_argument('--jobs', type=int, default=60)
+    parser.add_argument('--job-duration', type=float, default=0.5)
+    parser.add_argument('--heartbeat', type=float, default=0.5)
+    parser.add_argument('--visibility-timeout', type=float, default=3)
+    args = parser.parse_args(argv)
+
+    settings.WORKER_HEARTBEAT_INTERVAL = args.heartbeat
+    settings.LEASE_VISIBILITY_TIMEOUT = args.visibility_timeout
+    settings.SCHEDULER_POLL_INTERVAL = 0.05
+
+    redis = get_redis_connection(15)
+    redis.flushdb()
+    scheduler = SongScheduler(redis=redis)
+    for number in range(args.jobs):
+        scheduler.push({'token': 'job-{0:04d}'.format(number)}, cost=1)
+
+    processes = []
+    for number in range(args.workers):
+        process = multiprocessing.Process(
+            target=run_worker,
+            args=('bench-{0}'.format(number), args.slots, args.job_duration))
+        process.daemon = True
+        process.start()
+        processes.append(process)
+
+    started = time.time()
+    victim = processes[0]
+    while redis.scard(FINISHED_KEY) < args.jobs // 2:
+        time.sleep(0.05)
+
+    held = redis.smembers(JobLeases.make_owned_key('bench-0'))
+    os.kill(victim.pid, signal.SIGKILL)
+    killed_at = time.time()
+    sys.stdout.write("killed bench-0 holding {0} leases after {1:.2f}s\n".format(
+        len(held), killed_at - started))
+
+    deadline = killed_at + args.visibility_timeout * 10
+    while redis.scard(FINISHED_KEY) < args.jobs and time.time() < deadline:
+        time.sleep(0.05)
+
+    finished = redis.scard(FINISHED_KEY)
+    recovered = held.issubset(redis.smembers(FINISHED_KEY))
+    sys.stdout.write("{0}/{1} jobs finished, leases of the dead node {2} "
+                     "after {3:.2f}s\n".format(
+                         finished, args.jobs,
+                         'recovered' if recovered else 'LOST',
+                         time.time() - killed_at))
+
+    for node in WorkerRegistry(redis=redis, ttl=args.heartbeat * 3).nodes():
+        sys.stdout.write("  {node} {busy}/{capacity} busy\n".format(**node))
+
+    for process in processes[1:]:
+        process.terminate()
+
+    return 0 if finished == args.jobs and recovered else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
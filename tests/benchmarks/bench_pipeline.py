@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2013 OggWeed LLC
+#
+from __future__ import unicode_literals
+
+"""
+tests.benchmarks.bench_pipeline
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Pushes a deterministic corpus of WAV and AIFF files of several lengths
+and channel counts through the conversion pipeline, end to end: lineup
+queues in redis, ffmpeg, and the uploads to an S3 compatible server
+such as `moto_server s3 -p 5000`, or to a temporary folder with
+`STORAGE_BACKEND=local`.
+
+Reports songs per second, CPU seconds (this process plus ffmpeg) per
+minute of audio, bytes uploaded, peak RSS and the median time each
+step took, and writes all of it as JSON so that runs of different
+commits can be compared with `--compare`, which exits with status 1
+when a headline number regressed by more than `--max-regression`.
+
+The redis db of `REDIS_URI` is flushed before the run, point it at a
+throwaway redis-server.
+
+Usage:
+
+    REDIS_URI=redis://localhost:6379 \\
+    S3_HOST=localhost S3_PORT=5000 S3_SECURE=false \\
+    AWS_ACCESS_KEY_ID=bench AWS_SECRET_ACCESS_KEY=bench \\
+    FFMPEG_BIN=`which ffmpeg` \\
+    python -m tests.benchmarks.bench_pipeline --output bench.json [--compare before.json]
+
+    REDIS_URI=redis://localhost:6379 STORAGE_BACKEND=local FFMPEG_BIN=`which ffmpeg` \
+    python -m tests.benchmarks.bench_pipeline --output bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import argparse
+import tempfile
+import threading
+import subprocess
+from Queue import Queue, Empty
+
+from lineup.backends.redis import JSONRedisBackend
+from oggweed import settings
+from oggweed.framework.db import get_redis_connection
+from oggweed.web.models import Song
+from oggweed.workers import (
+    connections,
+    get_pipeline_class,
+    get_conversion_slots,
+    file_sha1,
+    RetryQueue,
+)
+from oggweed.scheduling import SongScheduler
+from oggweed.workers.storage import LocalStorage, get_storage
+from tests.benchmarks.fixtures import generate_matrix
+
+# the numbers compared by `--compare`, and whether bigger is better
+HEADLINE = [
+    ('songs_per_second', True),
+    ('cpu_seconds_per_audio_minute', False),
+    ('bytes_out', False),
+    ('peak_rss_kb', False),
+]
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def cpu_seconds():
+    """CPU used by this process and by the ffmpeg processes it waited for"""
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+
+    return total
+
+
+def peak_rss_kb():
+    """Peak resident set of this process and of its biggest child,
+    linux reports them in kilobytes"""
+    return {
+        'worker': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'ffmpeg': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+
+def collect(pipeline, results):
+    while True:
+        results.put(pipeline.output.get(wait=True))
+
+
+def start_daemon(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def wait_for_results(results, expected, timeout, retries):
+    """Collects the finished songs until every song either finished or
+    went to the dead-letter list of `retries`, songs waiting for a retry
+    are still expected"""
+    finished = []
+    deadline = time.time() + timeout
+    while len(finished) + len(retries.dead_letters()) < expected:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+
+        try:
+            finished.append(results.get(
+                timeout=min(remaining, settings.SCHEDULER_POLL_INTERVAL)))
+        except Empty:
+            continue
+
+    return finished
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2] if values else None
+
+
+def summarize_timings(songs):
+    """Returns `{step: {metric: median seconds}}` from the timings the
+    steps record in the instructions of every song, see `StepTimer`"""
+    samples = {}
+    for song in songs:
+        for step, timings in (song.get('timings') or {}).items():
+            durations = dict((metric, value) for metric, value in timings.items()
+                             if not metric.endswith('_at'))
+            if 'finished_at' in timings:
+                durations['queue_wait'] = timings['dequeued_at'] - timings['enqueued_at']
+                durations['processing'] = timings['finished_at'] - timings['started_at']
+
+            for metric, value in durations.items():
+                samples.setdefault(step, {}).setdefault(metric, []).append(value)
+
+    return dict(
+        (step, dict((metric, median(values)) for metric, values in metrics.items()))
+        for step, metrics in samples.items())
+
+
+def count_bytes_out(storage, tokens):
+    """Sums the size of the files stored for the given songs"""
+    if isinstance(storage, LocalStorage):
+        return sum(os.path.getsize(os.path.join(storage.root, name))
+                   for name in os.listdir(storage.root)
+                   if name.split(':', 1)[0] in tokens)
+
+    return sum(key.size for key in storage.get_bucket().list()
+               if key.name.split(':', 1)[0] in tokens)
+
+
+def run(fixtures, slots, timeout):
+    settings.CONVERSION_SLOTS = slots
+    get_redis_connection().flushdb()
+    storage = get_storage()
+    if isinstance(storage, LocalStorage):
+        if not os.path.isdir(storage.root):
+            os.makedirs(storage.root)
+    else:
+        connections.get_connection().create_bucket(settings.S3_BUCKET)
+
+    Pipeline = get_pipeline_class()
+    pipeline = Pipeline(JSONRedisBackend)
+    pipeline._start()
+
+    # failed songs come back through the scheduler, as in `RunWorker`
+    retries = RetryQueue()
+    scheduler = SongScheduler()
+    start_daemon(scheduler.feed_forever, pipeline.input, get_conversion_slots())
+    start_daemon(retries.pump_forever, scheduler)
+
+    results = Queue()
+    start_daemon(collect, pipeline, results)
+
+    cpu = cpu_seconds()
+    started = time.time()
+    tokens = set()
+    for fixture in fixtures:
+        song = Song.from_filename(fixture['path'])
+        song.save()
+        tokens.add(song.token)
+
+        job = song.as_dict()
+        job['source_sha1'] = file_sha1(fixture['path'])
+        job['source_size'] = fixture['bytes']
+        job['enqueued_at'] = time.time()
+        pipeline.input.put(job)
+
+    songs = wait_for_results(results, len(fixtures), timeout, retries)
+    elapsed = time.time() - started
+    used = cpu_seconds() - cpu
+    audio_minutes = sum(f['seconds'] for f in fixtures) / 60.0
+
+    return {
+        'commit': get_commit(),
+        'created_at': time.time(),
+        'pipeline': Pipeline.__name__,
+        'slots': slots,
+        'profiles': settings.ENCODING_PROFILES,
+        'corpus': [dict((k, v) for k, v in f.items() if k != 'path') for f in fixtures],
+        'songs': len(songs),
+        'failed': len(fixtures) - len(songs),
+        'wall_seconds': elapsed,
+        'songs_per_second': len(songs) / elapsed,
+        'audio_minutes': audio_minutes,
+        'cpu_seconds': used,
+        'cpu_seconds_per_audio_minute': used / audio_minutes,
+        'bytes_in': sum(f['bytes'] for f in fixtures),
+        'storage': settings.STORAGE_BACKEND,
+        'bytes_out': count_bytes_out(storage, tokens),
+        'peak_rss_kb': max(peak_rss_kb().values()),
+        'peak_rss_by_process_kb': peak_rss_kb(),
+        'steps': summarize_timings(songs),
+    }
+
+
+def compare(result, previous, max_regression):
+    """Prints the change of every headline number, returns the names
+    of the ones that got worse by more than `max_regression`"""
+    worse = []
+    sys.stdout.write("compared to {0}:\n".format(previous.get('commit') or 'previous run'))
+    for name, bigger_is_better in HEADLINE:
+        before, after = previous.get(name), result.get(name)
+        if not before or after is None:
+            continue
+
+        change = (after - before) / float(before)
+        regression = -change if bigger_is_better else change
+        if regression > max_regression:
+            worse.append(name)
+
+        sys.stdout.write("    {0:<30} {1:>14.3f} -> {2:>14.3f} {3:+.1%}\n".format(
+            name, before, after, change))
+
+    return worse
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--durations', default='5,30,120',
+                        help='seconds of audio of each fixture, comma separated')
+    parser.add_argument('--channels', default='1,2,6',
+                        help='channel counts, comma separated')
+    parser.add_argument('--containers', default='wav,aiff')
+    parser.add_argument('--slots', type=int, default=settings.CONVERSION_SLOTS)
+    parser.add_argument('--timeout', type=float, default=900,
+                        help='seconds to wait for every song to finish')
+    parser.add_argument('--output', help='where to write the JSON results')
+    parser.add_argument('--compare', help='JSON results of a previous run')
+    parser.add_argument('--max-regression', type=float, default=0.1,
+                        help='exit with 1 when a headline number is this much '
+                             'worse than in the compared run')
+    args = parser.parse_args(argv)
+
+    folder = tempfile.mkdtemp(prefix='oggweed-bench-')
+    settings.LOCAL_STORAGE_ROOT = os.path.join(folder, 'media')
+    try:
+        fixtures = generate_matrix(
+            folder,
+            durations=[int(d) for d in args.durations.split(',')],
+            channel_counts=[int(c) for c in args.channels.split(',')],
+            containers=args.containers.split(','))
+        sys.stdout.write("{0} fixtures, {1} slots\n".format(len(fixtures), args.slots))
+        result = run(fixtures, args.slots, args.timeout)
+    finally:
+        shutil.rmtree(folder)
+
+    sys.stdout.write(
+        "{songs} songs in {wall_seconds:.2f}s, {songs_per_second:.3f} songs/s, "
+        "{cpu_seconds_per_audio_minute:.2f} cpu s per audio minute, "
+        "{bytes_out} bytes out, peak rss {peak_rss_kb} kB, {failed} failed\n".format(**result))
+    for step in sorted(result['steps']):
+        sys.stdout.write("    {0:<16} {1}\n".format(step, ', '.join(
+            '{0} {1:.2f}s'.format(metric, seconds)
+            for metric, seconds in sorted(result['steps'][step].items()))))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(result, output, indent=2, sort_keys=True)
+
+    worse = []
+    if args.compare:
+        with open(args.compare) as previous:
+            worse = compare(result, json.load(previous), args.max_regression)
+
+    return 1 if result['failed'] or worse else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
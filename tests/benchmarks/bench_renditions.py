@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2013 OggWeed LLC
+#
+from __future__ import unicode_literals
+
+"""
+tests.benchmarks.bench_renditions
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Compares encoding every profile of `settings.ENCODING_PROFILES` in a
+single multi-output ffmpeg run against one ffmpeg run per profile.
+
+Usage:
+
+    FFMPEG_BIN=`which ffmpeg` python -m tests.benchmarks.bench_renditions [seconds-of-audio]
+"""
+
+import sys
+import time
+import shutil
+import resource
+import tempfile
+
+from oggweed import settings
+from oggweed.workers import OggConverter
+from tests.benchmarks.fixtures import generate_corpus
+
+
+def children_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure(label, run):
+    cpu = children_cpu_time()
+    started = time.time()
+    run()
+    sys.stdout.write("{0:<24} wall {1:6.2f}s cpu {2:6.2f}s\n".format(
+        label, time.time() - started, children_cpu_time() - cpu))
+
+
+def main(seconds=120):
+    profiles = settings.ENCODING_PROFILES
+    folder = tempfile.mkdtemp(prefix='oggweed-bench-')
+    try:
+        source, = generate_corpus(folder, durations=(seconds, ))
+        sys.stdout.write("{0}s of audio, profiles: {1}\n".format(
+            seconds, ', '.join(profiles)))
+
+        measure('single pass', lambda: OggConverter(source).convert())
+
+        def separate_runs():
+            for profile in profiles:
+                audio = OggConverter(source, profiles=[profile])
+                audio.convert('{0}.{1}.ogg'.format(source, profile))
+
+        measure('{0} separate runs'.format(len(profiles)), separate_runs)
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2013 OggWeed LLC
+#
+from __future__ import unicode_literals
+
+"""
+tests.benchmarks.bench_scheduling
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Replays the same mixed workload of jingles, songs and long DJ sets
+through a simulated pool of conversion slots, once in upload order
+and once with the scores of `SongScheduler`, and prints the median
+and p99 time-to-playable of each.
+
+Exits with status 1 when shortest job first makes the p99 worse
+than FIFO by more than `--max-p99-regression`.
+
+Usage:
+
+    python -m tests.benchmarks.bench_scheduling [--max-p99-regression 0.25]
+"""
+
+import sys
+import heapq
+import random
+import argparse
+
+from oggweed import settings
+from oggweed.scheduling import SongScheduler
+
+# how many times faster than realtime a slot converts, plus the
+# fixed cost of starting ffmpeg and uploading the result
+CONVERSION_SPEED = 40.0
+JOB_OVERHEAD = 1.0
+
+
+def mixed_workload(count, slots, load=0.9, seed=42):
+    """Returns `(uploaded_at, duration)` tuples: mostly short songs
+    and a few long sets, arriving fast enough to keep `slots` busy
+    `load` of the time"""
+    rand = random.Random(seed)
+    durations = []
+    for _ in range(count):
+        kind = rand.random()
+        if kind < 0.3:
+            durations.append(rand.uniform(3, 30))
+        elif kind < 0.85:
+            durations.append(rand.uniform(120, 420))
+        else:
+            durations.append(rand.uniform(1800, 7200))
+
+    mean_service = sum(map(service_time, durations)) / count
+    rate = load * slots / mean_service
+
+    jobs = []
+    uploaded_at = 0.0
+    for duration in durations:
+        uploaded_at += rand.expovariate(rate)
+        jobs.append((uploaded_at, duration))
+
+    return jobs
+
+
+def service_time(duration):
+    return duration / CONVERSION_SPEED + JOB_OVERHEAD
+
+
+def simulate(jobs, slots, score):
+    """Runs the jobs on `slots` without preemption, always starting the
+    waiting job with the lowest `score(duration, uploaded_at)`.
+    Returns the time-to-playable of every job."""
+    free_at = [0.0] * slots
+    waiting = []
+    latencies = []
+    position = 0
+    while position < len(jobs) or waiting:
+        now = heapq.heappop(free_at)
+        if not waiting and jobs[position][0] > now:
+            now = jobs[position][0]
+
+        while position < len(jobs) and jobs[position][0] <= now:
+            uploaded_at, duration = jobs[position]
+            heapq.heappush(waiting, (score(duration, uploaded_at), position))
+            position += 1
+
+        _, chosen = heapq.heappop(waiting)
+        uploaded_at, duration = jobs[chosen]
+        finished_at = now + service_time(duration)
+        latencies.append(finished_at - uploaded_at)
+        heapq.heappush(free_at, finished_at)
+
+    return latencies
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--jobs', type=int, default=20000)
+    parser.add_argument('--slots', type=int, default=4)
+    parser.add_argument('--load', type=float, default=0.9)
+    parser.add_argument('--aging', type=float, default=settings.SCHEDULER_AGING)
+    parser.add_argument('--max-p99-regression', type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    jobs = mixed_workload(args.jobs, args.slots, args.load)
+    scheduler = SongScheduler(redis=object(), aging=args.aging)
+    policies = [
+        ('fifo', lambda duration, uploaded_at: uploaded_at),
+        ('sjf+aging', scheduler.score),
+    ]
+
+    results = {}
+    sys.stdout.write("{0} jobs, {1} slots, load={2}, aging={3}\n".format(
+        args.jobs, args.slots, args.load, args.aging))
+    for name, score in policies:
+        latencies = simulate(jobs, args.slots, score)
+        results[name] = (percentile(latencies, 0.5), percentile(latencies, 0.99))
+        sys.stdout.write("{0:<10} median={1:8.2f}s p99={2:8.2f}s max={3:8.2f}s\n".format(
+            name, results[name][0], results[name][1], max(latencies)))
+
+    fifo_p99 = results['fifo'][1]
+    sjf_p99 = results['sjf+aging'][1]
+    regression = sjf_p99 / fifo_p99 - 1
+    sys.stdout.write("median speedup={0:.2f}x p99 change={1:+.1%}\n".format(
+        results['fifo'][0] / results['sjf+aging'][0], regression))
+
+    return 1 if regression > args.max_p99_regression else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2013 OggWeed LLC
+#
+from __future__ import unicode_literals
+
+"""
+tests.benchmarks.bench_song_save
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Compares the round trips and latency of persisting songs one command
+at a time, with `Song.save` and with `Song.save_many`.
+
+Runs against the redis-server from `REDIS_URI` using db 15, which is
+flushed at the end.
+
+Usage:
+
+    python -m tests.benchmarks.bench_song_save [number-of-songs]
+"""
+
+import sys
+import time
+
+from redis.connection import Connection
+from oggweed.framework.db import get_redis_connection
+from oggweed.web.models import Song
+
+
+class RoundTrips(object):
+    """Counts every packed command sent to redis: each one is a
+    network round trip"""
+    def __init__(self):
+        self.count = 0
+        self.original = Connection.send_packed_command
+
+    def __enter__(self):
+        counter = self
+
+        def send_packed_command(connection, command):
+            counter.count += 1
+            return counter.original(connection, command)
+
+        Connection.send_packed_command = send_packed_command
+        return self
+
+    def __exit__(self, *args):
+        Connection.send_packed_command = self.original
+
+
+def save_one_command_at_a_time(song):
+    # how Song.save used to work: one round trip per command
+    redis = get_redis_connection(15)
+    for key in ["list:songs:all", "list:songs:{0}".format(song.day)]:
+        redis.rpush(key, "song:{0}".format(song.token))
+
+    redis.set("song:{0}".format(song.token), song.as_json())
+
+
+def make_songs(total):
+    return [Song(token='bench{0}'.format(n), day='2013-10-20',
+                 filename='song{0}.aiff'.format(n), metadata={})
+            for n in range(total)]
+
+
+def measure(label, total, run):
+    with RoundTrips() as trips:
+        started = time.time()
+        run()
+        elapsed = time.time() - started
+
+    sys.stdout.write(
+        "{0:<28} {1:5.2f} round trips/save {2:8.1f}us/save\n".format(
+            label, trips.count / float(total), elapsed * 1e6 / total))
+
+
+def main(total=1000, group=20):
+    import oggweed.web.models as models
+    # the benchmark must never touch the application's database
+    models.get_redis_connection = lambda: get_redis_connection(15)
+
+    songs = make_songs(total)
+    measure('one command at a time', total,
+            lambda: map(save_one_command_at_a_time, songs))
+    measure('Song.save', total,
+            lambda: [song.save() for song in songs])
+    measure('Song.save_many ({0})'.format(group), total,
+            lambda: [Song.save_many(songs[i:i + group])
+                     for i in range(0, total, group)])
+
+    get_redis_connection(15).flushdb()
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
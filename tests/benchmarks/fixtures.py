@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2013 OggWeed LLC
+#
+from __future__ import unicode_literals
+
+"""
+tests.benchmarks.fixtures
+~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Generates deterministic audio files for the benchmarks, using only the
+standard library so that every run converts exactly the same bytes.
+"""
+
+import os
+import math
+import wave
+import aifc
+import struct
+
+SAMPLE_RATE = 44100
+
+
+def sine_frames(seconds, channels=2, frequency=440.0, sample_rate=SAMPLE_RATE,
+                byteorder=b'<'):
+    """Returns the 16-bit PCM frames of a sine wave, little-endian
+    unless `byteorder` is `>`"""
+    total = int(seconds * sample_rate)
+    step = 2 * math.pi * frequency / sample_rate
+    samples = []
+    for index in range(total):
+        value = int(math.sin(index * step) * 16000)
+        samples.extend([value] * channels)
+
+    return struct.pack(byteorder + b'{0}h'.format(len(samples)), *samples)
+
+
+def write_wav(path, seconds, channels=2, frequency=440.0):
+    output = wave.open(path, b'wb')
+    output.setnchannels(channels)
+    output.setsampwidth(2)
+    output.setframerate(SAMPLE_RATE)
+    output.writeframes(sine_frames(seconds, channels, frequency))
+    output.close()
+    return path
+
+
+def write_aiff(path, seconds, channels=2, frequency=440.0):
+    output = aifc.open(path, b'wb')
+    output.setnchannels(channels)
+    output.setsampwidth(2)
+    output.setframerate(SAMPLE_RATE)
+    output.writeframes(sine_frames(seconds, channels, frequency, byteorder=b'>'))
+    output.close()
+    return path
+
+
+WRITERS = {
+    'wav': write_wav,
+    'aiff': write_aiff,
+}
+
+
+def generate_corpus(folder, durations=(5, 10, 20, 40), channels=2, container='wav'):
+    """Writes one file per duration into `folder` and returns their
+    paths"""
+    return [fixture['path'] for fixture in generate_matrix(
+        folder, durations, channel_counts=(channels, ), containers=(container, ))]
+
+
+def generate_matrix(folder, durations=(5, 10, 20, 40), channel_counts=(1, 2),
+                    containers=('wav', 'aiff')):
+    """Writes one file per combination of duration, channel count and
+    container into `folder` and returns a dict describing each one.
+
+    Every file gets its own frequency, so no two of them have the same
+    audio and the transcode cache never turns a conversion into a
+    copy."""
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    fixtures = []
+    combinations = [(container, channels, seconds)
+                    for container in containers
+                    for channels in channel_counts
+                    for seconds in durations]
+
+    for index, (container, channels, seconds) in enumerate(combinations):
+        name = 'fixture-{0:02d}-{1}s-{2}ch.{3}'.format(index, seconds, channels, container)
+        path = os.path.join(folder, name)
+        if not os.path.exists(path):
+            WRITERS[container](path, seconds, channels, frequency=220.0 * (index + 1))
+
+        fixtures.append({
+            'name': name,
+            'path': path,
+            'seconds': seconds,
+            'channels': channels,
+            'container': container,
+            'bytes': os.path.getsize(path),
+        })
+
+    return fixtures
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2013 OggWeed LLC
+#
+from __future__ import unicode_literals
+import json
+from hashlib import sha1
+from flask import Flask
+from flask.ext.restful import Api
+from mock import patch
+from oggweed.web.models import Song
+from oggweed.api.resources import SongResource
+
+RECORD = Song(token='abc', filename='/srv/oggweed/_uploads/song.aiff',
+              uploaded_at=10, finalized_at=20,
+              metadata={
+                  'final_path': '/srv/oggweed/_uploads/song.aiff.ogg',
+                  'renditions': {
+                      'high': {'final_path': '/srv/oggweed/_uploads/song.aiff.ogg',
+                               'encode_path': 'encode'},
+                      'mobile': {'final_path': '/srv/oggweed/_uploads/song.aiff.mobile.ogg',
+                                 'encode_path': 'encode'},
+                  },
+              },
+              url='http://s3/abc:song.ogg').as_json().encode('utf-8')
+ETAG = '"{0}"'.format(sha1(RECORD).hexdigest())
+
+
+def make_client():
+    app = Flask(__name__)
+    Api(app, prefix='/api').add_resource(SongResource, '/songs/<token>')
+    return app.test_client()
+
+
+@patch('oggweed.api.resources.Song.get_record')
+def test_song_resource_get(get_record):
+    ("GET /api/songs/<token> should serve the song with a strong ETag "
+     "and let caches keep finalized songs")
+
+    get_record.return_value = (RECORD, True)
+
+    response = make_client().get('/api/songs/abc')
+
+    response.status_code.should.equal(200)
+    response.headers['ETag'].should.equal(ETAG)
+    response.headers['Cache-Control'].should.equal('public, max-age=31536000')
+    data = json.loads(response.data)
+    data['url'].should.equal('http://s3/abc:song.ogg')
+    data['filename'].should.equal('song.aiff')
+    data['metadata']['final_path'].should.equal('song.aiff.ogg')
+    data['metadata']['renditions']['mobile'].should.equal({
+        'final_path': 'song.aiff.mobile.ogg',
+        'encode_path': 'encode',
+    })
+    get_record.assert_called_once_with('abc')
+
+    # And no path of the web or worker hosts is exposed
+    response.data.shouldnt.contain(b'/srv/')
+
+
+@patch('oggweed.api.resources.Song.get_record')
+def test_song_resource_pending_songs_are_revalidated(get_record):
+    ("GET /api/songs/<token> should make caches revalidate songs that "
+     "are still being converted")
+
+    get_record.return_value = (RECORD, False)
+
+    response = make_client().get('/api/songs/abc')
+
+    response.headers['Cache-Control'].should.equal('no-cache')
+
+
+@patch('oggweed.api.resources.SongResource.get_representation')
+@patch('oggweed.api.resources.Song.get_record')
+def test_song_resource_not_modified(get_record, get_representation):
+    ("GET /api/songs/<token> should answer 304 without serializing the "
+     "song when the ETag still matches")
+
+    get_record.return_value = (RECORD, True)
+
+    response = make_client().get('/api/songs/abc', headers={'If-None-Match': ETAG})
+
+    response.status_code.should.equal(304)
+    response.data.should.equal(b'')
+    response.headers['ETag'].should.equal(ETAG)
+    response.headers['Cache-Control'].should.equal('public, max-age=31536000')
+    get_representation.called.should.be.false
+
+
+@patch('oggweed.api.resources.Song.get_record')
+def test_song_resource_unknown_song(get_record):
+    ("GET /api/songs/<token> should return 404 for unknown songs")
+
+    get_record.return_value = (None, False)
+
+    response = make_client().get('/api/songs/abc')
+
+    response.status_code.should.equal(404)
+    json.loads(response.data).should.equal({'error': 'song not found'})
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2013 OggWeed LLC
+#
+from __future__ import unicode_literals
+import json
+from mock import Mock, call
+from oggweed.coordination import WorkerRegistry, JobLeases
+
+
+def test_job_leases_acquire():
+    ("JobLeases.acquire() should store the job, its deadline and its "
+     "owner in a single transaction")
+
+    redis = Mock()
+    leases = JobLeases(redis=redis, node='box1:10', visibility_timeout=60)
+
+    job = leases.acquire({'token': 'abc'}, now=100)
+
+    job.should.equal({'token': 'abc', 'leased': True})
+    redis.pipeline.assert_called_once_with(transaction=True)
+    pipe = redis.pipeline.return_value
+    pipe.zadd.assert_called_once_with('leases:songs', 160, 'abc')
+    pipe.hset.assert_has_calls([
+        call('leases:songs:payloads', 'abc', json.dumps(job)),
+        call('leases:songs:owners', 'abc', 'box1:10'),
+    ])
+    pipe.sadd.assert_called_once_with('workers:box1:10:leases', 'abc')
+
+
+def test_job_leases_claim_moves_the_lease():
+    ("JobLeases.claim() should move the lease to this node and save "
+     "the latest instructions")
+
+    redis = Mock()
+    redis.hget.return_value = 'box1:10'
+    leases = JobLeases(redis=redis, node='box2:20', visibility_timeout=60)
+    instructions = {
+        'token': 'abc',
+        'leased': True,
+        'checkpoints': {'convert': {}},
+        '__lineup__error__': {'traceback': 'boom'},
+    }
+
+    leases.claim(instructions, now=100).should.be.true
+
+    pipe = redis.pipeline.return_value
+    pipe.srem.assert_called_once_with('workers:box1:10:leases', 'abc')
+    pipe.sadd.assert_called_once_with('workers:box2:20:leases', 'abc')
+    pipe.zadd.assert_called_once_with('leases:songs', 160, 'abc')
+    payload = json.loads(pipe.hset.call_args_list[1][0][2])
+    payload.should.equal({
+        'token': 'abc',
+        'leased': True,
+        'checkpoints': {'convert': {}},
+    })
+
+
+def test_job_leases_claim_ignores_songs_without_lease():
+    ("JobLeases.claim() should not touch songs that were never leased "
+     "or whose lease is gone")
+
+    redis = Mock()
+    redis.hget.return_value = None
+    leases = JobLeases(redis=redis, node='box2:20')
+
+    leases.claim({'token': 'abc'}).should.be.false
+    leases.claim({'token': 'abc', 'leased': True}).should.be.false
+    redis.pipeline.called.should.be.false
+
+
+def test_job_leases_renew_forgets_released_songs():
+    ("JobLeases.renew() should extend the leases this node still owns")
+
+    redis = Mock()
+    redis.smembers.return_value = set(['done', 'running'])
+    pipe = redis.pipeline.return_value
+    scores = {'done': None, 'running': 150.0}
+    pipe.execute.side_effect = [
+        [scores[token] for token in list(redis.smembers.return_value)],
+        [],
+    ]
+    leases = JobLeases(redis=redis, node='box1:10', visibility_timeout=60)
+
+    leases.renew(now=100).should.equal(['running'])
+    pipe.zadd.assert_called_once_with('leases:songs', 160, 'running')
+    pipe.srem.assert_called_once_with('workers:box1:10:leases', 'done')
+
+
+def test_job_leases_redeliver_expired():
+    ("JobLeases.redeliver_expired() should hand the songs of dead "
+     "nodes back to the scheduler")
+
+    redis = Mock()
+    redis.zrangebyscore.return_value = ['abc', 'taken']
+    payload = json.dumps({'token': 'abc', 'leased': True})
+    redis.pipeline.return_value.execute.side_effect = [
+        [1, payload, 'box1:10', 1, 1],
+        [0, None, None, 0, 0],
+    ]
+    scheduler = Mock()
+    leases = JobLeases(redis=redis, node='box2:20')
+
+    jobs = leases.redeliver_expired(scheduler, now=100)
+
+    redis.zrangebyscore.assert_called_once_with('leases:songs', '-inf', 100)
+    jobs.should.equal([{'token': 'abc', 'deliveries': 2}])
+    scheduler.push_again.assert_called_once_with({'token': 'abc', 'deliveries': 2})
+    redis.srem.assert_called_once_with('workers:box1:10:leases', 'abc')
+
+
+def test_worker_registry_lists_live_nodes():
+    ("WorkerRegistry.nodes() should drop dead nodes and return the "
+     "capacity and leases of the live ones")
+
+    redis = Mock()
+    redis.zrange.return_value = ['box1:10']
+    redis.pipeline.return_value.execute.return_value = [
+        {'capacity': '4', 'busy': '3', 'heartbeat_at': '99.5'},
+        set(['b', 'a']),
+    ]
+    registry = WorkerRegistry(redis=redis, ttl=15)
+
+    registry.nodes(now=100).should.equal([{
+        'node': 'box1:10',
+        'capacity': 4,
+        'busy': 3,
+        'heartbeat_at': 99.5,
+        'leases': ['a', 'b'],
+    }])
+    redis.zremrangebyscore.assert_called_once_with('workers', '-inf', 85)
+
+
+def test_worker_registry_heartbeat():
+    ("WorkerRegistry.heartbeat() should advertise the node capacity "
+     "with an expiration")
+
+    redis = Mock()
+    WorkerRegistry(redis=redis, node='box1:10', ttl=15).heartbeat(4, 1, now=100)
+
+    pipe = redis.pipeline.return_value
+    pipe.hmset.assert_called_once_with('workers:box1:10', {
+        'node': 'box1:10',
+        'capacity': 4,
+        'busy': 1,
+        'heartbeat_at': 100,
+    })
+    pipe.expire.assert_called_once_with('workers:box1:10', 15)
+    pipe.zadd.assert_called_once_with('workers', 100, 'box1:10')
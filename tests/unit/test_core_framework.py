@@ -138,6 +138,26 @@ def test_application_enable_assets(Flask, AssetsManager):
     app.assets.create_bundles.assert_called_once_with()
 
 
+@patch('oggweed.framework.core.Api')
+@patch('oggweed.framework.core.Flask')
+def test_application_enable_api(Flask, Api):
+    ("Application.enable_api() should serve each resource under the prefix")
+
+    # Given an application
+    app = Application()
+    resource = Mock(name='SongResource')
+
+    # When I enable the api
+    app.enable_api([('/songs/<token>', resource)])
+
+    # Then the api was created for the flask app
+    Api.assert_called_once_with(Flask.return_value, prefix='/api')
+    app.api.should.equal(Api.return_value)
+
+    # And the resource was added
+    app.api.add_resource.assert_called_once_with(resource, '/songs/<token>')
+
+
 
 @patch('oggweed.framework.core.Manager')
 @patch('oggweed.framework.core.Flask')
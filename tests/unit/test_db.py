@@ -6,6 +6,7 @@
 import json
 import sqlalchemy as db
 from mock import patch, call, Mock
+from redis.exceptions import ConnectionError
 from datetime import datetime, date, time
 from decimal import Decimal
 from oggweed.framework.db import (
@@ -16,6 +17,8 @@ from oggweed.framework.db import (
     EngineNotSpecified,
     MultipleEnginesSpecified,
     get_redis_connection,
+    get_redis_pool_stats,
+    RedisConnectionPool,
 )
 
 
@@ -743,18 +746,79 @@ def test_query_by():
         'ORDER BY dummy_user_model.id DESC')
 
 
+@patch('oggweed.framework.db.redis_pools', {})
+@patch('oggweed.framework.db.RedisConnectionPool')
 @patch('oggweed.framework.db.StrictRedis')
-def test_get_redis_connection(StrictRedis):
-    ("get_redis_connection() should return a redis connection from the setting `REDIS_URI`")
+def test_get_redis_connection(StrictRedis, RedisConnectionPool):
+    ("get_redis_connection() should return a redis connection from the "
+     "setting `REDIS_URI` that uses the connection pool of the given db")
 
     conn = get_redis_connection(42)
 
-    StrictRedis.assert_called_once_with(
+    RedisConnectionPool.assert_called_once_with(
+        max_connections=50,
+        timeout=20.0,
+        socket_timeout=5.0,
         db=42,
         host='localhost',
         port=6379,
         password=''
     )
+    StrictRedis.assert_called_once_with(
+        connection_pool=RedisConnectionPool.return_value)
+
+
+@patch('oggweed.framework.db.redis_pools', {})
+@patch('oggweed.framework.db.RedisConnectionPool')
+@patch('oggweed.framework.db.StrictRedis')
+def test_get_redis_connection_shares_the_pool(StrictRedis, RedisConnectionPool):
+    ("get_redis_connection() should create a single pool per db")
+
+    # When I get 3 connections to 2 databases
+    get_redis_connection(1)
+    get_redis_connection(1)
+    get_redis_connection(2)
+
+    # Then only 2 pools were created
+    RedisConnectionPool.call_count.should.equal(2)
+
+    # And the stats are available for both
+    sorted(get_redis_pool_stats().keys()).should.equal(
+        ['localhost:6379/1', 'localhost:6379/2'])
+
+
+def test_redis_connection_pool_stats():
+    ("RedisConnectionPool should count created, in use and waited connections")
+
+    # Given a pool of 2 fake connections that doesn't wait
+    pool = RedisConnectionPool(max_connections=2, timeout=0,
+                               connection_class=Mock)
+
+    # When I take both connections and give one back
+    first = pool.get_connection('GET')
+    second = pool.get_connection('GET')
+    pool.release(first)
+
+    # Then the stats should show it
+    pool.stats().should.equal({
+        'created': 2,
+        'in_use': 1,
+        'waits': 0,
+        'max_connections': 2,
+    })
+
+    # And when I take the released one and ask for another
+    pool.get_connection('GET')
+    pool.get_connection.when.called_with('GET').should.throw(
+        ConnectionError, 'No connection available.')
+
+    # Then the caller had to wait, without creating new connections
+    pool.stats().should.equal({
+        'created': 2,
+        'in_use': 2,
+        'waits': 1,
+        'max_connections': 2,
+    })
 
 
 @patch('oggweed.framework.db.engine')
@@ -3,8 +3,35 @@
 # Copyright © 2013 OggWeed LLC
 #
 from __future__ import unicode_literals
+import io
+import os
+import gzip
+import json
+import shutil
+import tempfile
 from mock import patch, Mock
-from oggweed.framework.http.assets import AssetsManager
+from oggweed.framework.http.assets import (
+    AssetsManager,
+    StaticBuilder,
+    get_fingerprinted_name,
+    gzip_data,
+    static_url,
+)
+
+SCRIPT = b'$(function(){ var player = document.getElementById("player"); });\n' * 20
+FONT = b'\x00\x01font'
+STYLESHEET = (b"@font-face { src: url('../fonts/icons.eot?#iefix'), "
+              b"url(data:font/woff;base64,AAAA), url(//cdn/x.ttf); }\n")
+
+
+def write_files(root, files):
+    for name, data in files.items():
+        path = os.path.join(root, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        with open(path, 'wb') as output:
+            output.write(data)
 
 
 @patch('oggweed.framework.http.assets.Environment')
@@ -33,3 +60,75 @@ def test_assets_manager(Environment):
 
     # And set_directory should have been called with None
     assets_environment.set_directory.assert_called_once_with(None)
+
+
+def test_get_fingerprinted_name():
+    ("get_fingerprinted_name() should put a hash of the content before "
+     "the extension")
+
+    get_fingerprinted_name('js/oggweed.js', b'OggS').should.equal(
+        'js/oggweed.d75128286c95.js')
+    get_fingerprinted_name('js/oggweed.js', b'OggS!').shouldnt.equal(
+        'js/oggweed.d75128286c95.js')
+
+
+def test_gzip_data_is_reproducible():
+    ("gzip_data() should write the same bytes for the same content")
+
+    gzip_data(SCRIPT).should.equal(gzip_data(SCRIPT))
+    gzip.GzipFile(fileobj=io.BytesIO(gzip_data(SCRIPT))).read().should.equal(SCRIPT)
+
+
+def test_static_builder_build():
+    ("StaticBuilder.build() should write fingerprinted files, gzip "
+     "the compressible ones and rewrite the urls in the stylesheets")
+
+    source = tempfile.mkdtemp(prefix='oggweed-static-')
+    destination = tempfile.mkdtemp(prefix='oggweed-build-')
+    write_files(source, {
+        'js/oggweed.js': SCRIPT,
+        'fonts/icons.eot': FONT,
+        'css/oggweed.css': STYLESHEET,
+        '.DS_Store': b'',
+    })
+    try:
+        manifest = StaticBuilder(source, destination).build()
+
+        sorted(manifest).should.equal(['css/oggweed.css', 'fonts/icons.eot', 'js/oggweed.js'])
+        manifest['js/oggweed.js'].should.equal(get_fingerprinted_name('js/oggweed.js', SCRIPT))
+
+        # And the scripts got a smaller gzipped sibling
+        script = os.path.join(destination, manifest['js/oggweed.js'])
+        with open(script + '.gz', 'rb') as compressed:
+            compressed.read().should.equal(gzip_data(SCRIPT))
+
+        # But not the files that compressing would make bigger
+        font = os.path.join(destination, manifest['fonts/icons.eot'])
+        os.path.exists(font).should.be.true
+        os.path.exists(font + '.gz').should.be.false
+
+        # And the stylesheet references the fingerprinted font
+        with open(os.path.join(destination, manifest['css/oggweed.css']), 'rb') as css:
+            css.read().should.equal(STYLESHEET.replace(
+                b'../fonts/icons.eot', '../{0}'.format(manifest['fonts/icons.eot']).encode('ascii')))
+
+        # And the manifest was written
+        with open(os.path.join(destination, 'manifest.json'), 'rb') as written:
+            json.loads(written.read().decode('utf-8')).should.equal(manifest)
+    finally:
+        shutil.rmtree(source)
+        shutil.rmtree(destination)
+
+
+@patch('oggweed.framework.http.assets.settings')
+@patch('oggweed.framework.http.assets.get_static_manifest')
+def test_static_url_resolves_through_the_manifest(get_static_manifest, settings):
+    ("static_url() should point to the fingerprinted files of the "
+     "manifest and keep the other names")
+
+    get_static_manifest.return_value = {'js/oggweed.js': 'js/oggweed.d75128286c95.js'}
+    settings.STATIC_BUILD_URL = '/assets/'
+    settings.STATIC_BASE_URL = '/static/'
+
+    static_url('/js/oggweed.js').should.equal('/assets/js/oggweed.d75128286c95.js')
+    static_url('js/upload.js').should.equal('/static/js/upload.js')
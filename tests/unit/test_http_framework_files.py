@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2013 OggWeed LLC
+#
+from __future__ import unicode_literals
+import tempfile
+from flask import Flask
+from oggweed.framework.http.files import send_file_range, send_asset
+
+CONTENT = bytes(bytearray(index % 256 for index in range(1000)))
+
+
+def make_client(use_x_sendfile=False):
+    song = tempfile.NamedTemporaryFile(suffix='.ogg')
+    song.write(CONTENT)
+    song.flush()
+
+    app = Flask(__name__)
+    app.use_x_sendfile = use_x_sendfile
+    app.song = song
+
+    @app.route('/song.ogg')
+    def serve():
+        return send_file_range(song.name, 'audio/ogg')
+
+    return app.test_client()
+
+
+def test_send_file_range_whole_file():
+    ("send_file_range() should send the whole file with its ETag and "
+     "advertise range support")
+
+    response = make_client().get('/song.ogg')
+
+    response.status_code.should.equal(200)
+    response.data.should.equal(CONTENT)
+    response.headers['Accept-Ranges'].should.equal('bytes')
+    response.headers['Content-Length'].should.equal('1000')
+    response.headers.should.have.key('ETag')
+
+
+def test_send_file_range_partial_content():
+    ("send_file_range() should answer a range with 206 and only the "
+     "requested bytes")
+
+    response = make_client().get('/song.ogg', headers={'Range': 'bytes=100-199'})
+
+    response.status_code.should.equal(206)
+    response.data.should.equal(CONTENT[100:200])
+    response.headers['Content-Range'].should.equal('bytes 100-199/1000')
+    response.headers['Content-Length'].should.equal('100')
+
+
+def test_send_file_range_suffix():
+    ("send_file_range() should support ranges relative to the end")
+
+    response = make_client().get('/song.ogg', headers={'Range': 'bytes=-10'})
+
+    response.status_code.should.equal(206)
+    response.data.should.equal(CONTENT[-10:])
+
+
+def test_send_file_range_unsatisfiable():
+    ("send_file_range() should answer 416 to ranges past the end")
+
+    response = make_client().get('/song.ogg', headers={'Range': 'bytes=5000-'})
+
+    response.status_code.should.equal(416)
+    response.headers['Content-Range'].should.equal('bytes */1000')
+
+
+def test_send_file_range_not_modified():
+    ("send_file_range() should answer 304 when the ETag still matches")
+
+    client = make_client()
+    etag = client.get('/song.ogg').headers['ETag']
+
+    response = client.get('/song.ogg', headers={'If-None-Match': etag})
+
+    response.status_code.should.equal(304)
+    response.data.should.equal(b'')
+
+
+def test_send_file_range_ignores_ranges_of_another_version():
+    ("send_file_range() should send the whole file when If-Range does "
+     "not match the current ETag")
+
+    response = make_client().get('/song.ogg', headers={
+        'Range': 'bytes=0-9',
+        'If-Range': '"stale"',
+    })
+
+    response.status_code.should.equal(200)
+    response.data.should.equal(CONTENT)
+
+
+def test_send_file_range_x_sendfile():
+    ("send_file_range() should let the front server send the file "
+     "when USE_X_SENDFILE is enabled")
+
+    response = make_client(use_x_sendfile=True).get('/song.ogg')
+
+    response.headers['X-Sendfile'].should.match(r'\.ogg$')
+    response.data.should.equal(b'')
+
+
+def make_asset_client():
+    asset = tempfile.NamedTemporaryFile(suffix='.js')
+    asset.write(CONTENT)
+    asset.flush()
+    compressed = open(asset.name + '.gz', 'wb')
+    compressed.write(b'gzipped')
+    compressed.close()
+
+    app = Flask(__name__)
+    app.asset = asset
+
+    @app.route('/oggweed.js')
+    def serve():
+        return send_asset(asset.name, max_age=60)
+
+    return app.test_client()
+
+
+def test_send_asset_is_immutable():
+    ("send_asset() should let browsers keep the file without revalidating")
+
+    response = make_asset_client().get('/oggweed.js')
+
+    response.status_code.should.equal(200)
+    response.data.should.equal(CONTENT)
+    response.mimetype.should.match(r'javascript$')
+    response.headers['Cache-Control'].should.equal('public, max-age=60, immutable')
+    response.headers['Vary'].should.equal('Accept-Encoding')
+    response.headers.shouldnt.have.key('Content-Encoding')
+
+
+def test_send_asset_precompressed():
+    ("send_asset() should send the .gz sibling to clients that accept gzip")
+
+    response = make_asset_client().get('/oggweed.js', headers={
+        'Accept-Encoding': 'gzip, deflate',
+    })
+
+    response.data.should.equal(b'gzipped')
+    response.headers['Content-Encoding'].should.equal('gzip')
+    response.mimetype.should.match(r'javascript$')
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2013 OggWeed LLC
+#
+from __future__ import unicode_literals
+import os
+import json
+import shutil
+import tempfile
+from io import BytesIO
+from hashlib import sha1
+from mock import patch
+from flask import Flask, request
+from werkzeug.test import encode_multipart
+from werkzeug.datastructures import MultiDict, FileStorage
+from werkzeug.exceptions import RequestEntityTooLarge
+from oggweed.framework.http.uploads import (
+    StagedUpload,
+    StreamingUploadRequest,
+    save_upload,
+)
+
+
+def test_staged_upload_hashes_and_counts_what_it_writes():
+    ("StagedUpload should compute the sha1 and size of the bytes "
+     "written to it and move the file without copying it")
+
+    folder = tempfile.mkdtemp()
+    try:
+        staged = StagedUpload(folder, chunk_size=4)
+        staged.write(b'some ')
+        staged.write(b'audio')
+
+        staged.size.should.equal(10)
+        staged.hexdigest().should.equal(sha1(b'some audio').hexdigest())
+
+        destination = os.path.join(folder, 'song.aiff')
+        staged.move_to(destination)
+        staged.close()
+
+        open(destination, 'rb').read().should.equal(b'some audio')
+        os.listdir(folder).should.equal(['song.aiff'])
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_staged_upload_stops_past_its_max_size():
+    ("StagedUpload should refuse bytes past its max size and delete "
+     "the staged file when closed")
+
+    folder = tempfile.mkdtemp()
+    try:
+        staged = StagedUpload(folder, max_size=8)
+        staged.write(b'12345678')
+        staged.write.when.called_with(b'9').should.throw(RequestEntityTooLarge)
+
+        staged.close()
+        os.listdir(folder).should.be.empty
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_streaming_upload_request_stages_files():
+    ("StreamingUploadRequest should write uploaded files to the "
+     "upload folder while parsing the form")
+
+    folder = tempfile.mkdtemp()
+    app = Flask(__name__)
+    app.request_class = StreamingUploadRequest
+
+    @app.route('/upload', methods=['POST'])
+    def upload():
+        file = request.files['file']
+        digest, size = save_upload(file, os.path.join(folder, 'song.aiff'))
+        return json.dumps({
+            'digest': digest,
+            'size': size,
+            'staged': isinstance(file.stream, StagedUpload),
+        })
+
+    try:
+        with patch('oggweed.framework.http.uploads.settings') as settings:
+            settings.UPLOAD_PATH = folder
+            settings.MAX_UPLOAD_SIZE = 1024
+            settings.UPLOAD_CHUNK_SIZE = 16
+
+            response = app.test_client().post('/upload', data={
+                'file': (BytesIO(b'AIFF' * 100), 'song.aiff'),
+            })
+
+        response.status_code.should.equal(200)
+        json.loads(response.data).should.equal({
+            'digest': sha1(b'AIFF' * 100).hexdigest(),
+            'size': 400,
+            'staged': True,
+        })
+        os.listdir(folder).should.equal(['song.aiff'])
+    finally:
+        shutil.rmtree(folder)
+
+
+def make_upload_app(folder):
+    app = Flask(__name__)
+    app.request_class = StreamingUploadRequest
+
+    @app.route('/upload', methods=['POST'])
+    def upload():
+        file = request.files['file']
+        save_upload(file, os.path.join(folder, 'song.aiff'))
+        return 'ok'
+
+    return app
+
+
+def test_streaming_upload_request_deletes_files_past_the_max_size():
+    ("StreamingUploadRequest should answer 413 and leave nothing in the "
+     "upload folder when a file goes past the max upload size")
+
+    folder = tempfile.mkdtemp()
+    app = make_upload_app(folder)
+    try:
+        with patch('oggweed.framework.http.uploads.settings') as settings:
+            settings.UPLOAD_PATH = folder
+            settings.MAX_UPLOAD_SIZE = 100
+            settings.UPLOAD_CHUNK_SIZE = 16
+
+            response = app.test_client().post('/upload', data={
+                'file': (BytesIO(b'AIFF' * 100), 'song.aiff'),
+            })
+
+        response.status_code.should.equal(413)
+        os.listdir(folder).should.be.empty
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_streaming_upload_request_deletes_files_of_truncated_bodies():
+    ("StreamingUploadRequest should answer 400 and leave nothing in the "
+     "upload folder when the body ends before the file does")
+
+    folder = tempfile.mkdtemp()
+    app = make_upload_app(folder)
+    boundary, body = encode_multipart(MultiDict({
+        'file': FileStorage(BytesIO(b'AIFF' * 1000), 'song.aiff'),
+    }))
+    try:
+        with patch('oggweed.framework.http.uploads.settings') as settings:
+            settings.UPLOAD_PATH = folder
+            settings.MAX_UPLOAD_SIZE = 1024 * 1024
+            settings.UPLOAD_CHUNK_SIZE = 16
+
+            response = app.test_client().post(
+                '/upload',
+                input_stream=BytesIO(body[:len(body) // 2]),
+                content_type='multipart/form-data; boundary={0}'.format(boundary),
+                content_length=len(body))
+
+        response.status_code.should.equal(400)
+        os.listdir(folder).should.be.empty
+    finally:
+        shutil.rmtree(folder)
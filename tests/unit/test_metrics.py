@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2013 OggWeed LLC
+#
+from __future__ import unicode_literals
+from mock import Mock, patch, call
+from oggweed.metrics import (
+    BUCKETS,
+    StepMetrics,
+    StepTimer,
+    get_bucket,
+    get_percentile,
+)
+
+
+def test_get_bucket():
+    ("get_bucket() should return the first bucket whose upper bound "
+     "holds the duration")
+
+    get_bucket(0).should.equal(0)
+    get_bucket(0.01).should.equal(0)
+    get_bucket(0.011).should.equal(1)
+    get_bucket(10 ** 9).should.equal(len(BUCKETS) - 1)
+
+
+def test_get_percentile():
+    ("get_percentile() should return the upper bound of the bucket "
+     "holding the given fraction of the samples")
+
+    counts = {0: 50, 5: 45, 20: 5}
+
+    get_percentile(counts, 0.5).should.equal(BUCKETS[0])
+    get_percentile(counts, 0.95).should.equal(BUCKETS[5])
+    get_percentile(counts, 0.99).should.equal(BUCKETS[20])
+    get_percentile({}, 0.5).should.be.none
+
+
+def test_step_metrics_record():
+    ("StepMetrics.record() should count each duration in the histogram "
+     "of the current minute in a single round trip")
+
+    redis = Mock()
+    StepMetrics(redis=redis, retention=3600).record(
+        'AnythingToOgg', {'ffmpeg': 0.01}, now=600)
+
+    redis.pipeline.assert_called_once_with(transaction=False)
+    pipe = redis.pipeline.return_value
+    pipe.hincrby.assert_called_once_with('metrics:AnythingToOgg:ffmpeg:10', 0, 1)
+    pipe.expire.assert_called_once_with('metrics:AnythingToOgg:ffmpeg:10', 3600)
+    pipe.sadd.assert_called_once_with('metrics:series', 'AnythingToOgg:ffmpeg')
+    pipe.execute.assert_called_once_with()
+
+
+def test_step_metrics_report():
+    ("StepMetrics.report() should merge the histograms of the last "
+     "minutes into percentiles and throughput")
+
+    redis = Mock()
+    redis.smembers.return_value = set(['StoreSong:upload'])
+    pipe = redis.pipeline.return_value
+    pipe.execute.return_value = [{'3': '2'}, {}, {'3': '1', '7': '1'}]
+
+    report = StepMetrics(redis=redis).report(minutes=3, now=600)
+
+    pipe.hgetall.assert_has_calls([
+        call('metrics:StoreSong:upload:8'),
+        call('metrics:StoreSong:upload:9'),
+        call('metrics:StoreSong:upload:10'),
+    ])
+    report.should.equal({
+        'StoreSong': {
+            'upload': {
+                'count': 4,
+                'per_minute': 4 / 3.0,
+                'p50': BUCKETS[3],
+                'p95': BUCKETS[7],
+                'p99': BUCKETS[7],
+            },
+        },
+    })
+
+
+@patch('oggweed.metrics.settings.PIPELINE_METRICS', True)
+@patch('oggweed.metrics.time.time')
+def test_step_timer(time):
+    ("StepTimer should record the queue wait, the slot wait, the "
+     "processing and the durations added by the step")
+
+    metrics = Mock()
+    instructions = {'token': 'abc', 'enqueued_at': 90}
+
+    time.return_value = 100
+    timer = StepTimer('AnythingToOgg', instructions, metrics=metrics)
+    time.return_value = 103
+    timer.start()
+    instructions['timings']['AnythingToOgg']['ffmpeg'] = 5
+
+    durations = timer.stop(now=110)
+
+    durations.should.equal({
+        'queue_wait': 10,
+        'slot_wait': 3,
+        'processing': 7,
+        'ffmpeg': 5,
+    })
+    metrics.record.assert_called_once_with('AnythingToOgg', durations, 110)
+    instructions['timings'].should.equal({
+        'AnythingToOgg': {
+            'ffmpeg': 5,
+            'enqueued_at': 90,
+            'dequeued_at': 100,
+            'started_at': 103,
+            'finished_at': 110,
+        },
+    })
+
+
+@patch('oggweed.metrics.settings.PIPELINE_METRICS', True)
+def test_step_timer_never_fails_the_song():
+    ("StepTimer.stop() should only log when redis is unavailable")
+
+    metrics = Mock()
+    metrics.record.side_effect = IOError('connection refused')
+    timer = StepTimer('StoreSong', {'token': 'abc'}, metrics=metrics)
+
+    timer.stop().should.have.key('processing')
+
+
+@patch('oggweed.metrics.time.time')
+def test_step_timer_forgets_the_previous_attempt(time):
+    ("StepTimer should not record the durations of a previous attempt "
+     "of a retried song again")
+
+    instructions = {'token': 'abc', 'timings': {
+        'AnythingToOgg': {'ffmpeg': 50, 'finished_at': 10},
+        'FetchFromS3': {'finished_at': 5},
+    }}
+
+    time.return_value = 100
+    timer = StepTimer('AnythingToOgg', instructions, metrics=Mock())
+
+    timer.stop(now=110).should_not.have.key('ffmpeg')
+    instructions['timings']['AnythingToOgg']['finished_at'].should.equal(110)
+    instructions['timings']['FetchFromS3'].should.equal({'finished_at': 5})
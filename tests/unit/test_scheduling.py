@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2013 OggWeed LLC
+#
+from __future__ import unicode_literals
+import json
+import subprocess
+from mock import Mock, patch, call
+from oggweed.workers import ConversionSlots
+from oggweed.scheduling import SongScheduler, estimate_cost
+
+
+@patch('oggweed.scheduling.probe')
+def test_estimate_cost_reads_the_duration(probe):
+    ("estimate_cost() should return the duration found in the headers")
+
+    probe.return_value = {'format': {'duration': '183.4'}}
+    estimate_cost('song.mp3').should.equal(183.4)
+    probe.assert_called_once_with('song.mp3')
+
+
+@patch('oggweed.scheduling.os.path.getsize')
+@patch('oggweed.scheduling.probe')
+def test_estimate_cost_falls_back_to_the_file_size(probe, getsize):
+    ("estimate_cost() should guess the duration from the size when "
+     "ffprobe can't read the file")
+
+    probe.side_effect = subprocess.CalledProcessError(1, 'ffprobe')
+    getsize.return_value = 160000
+    estimate_cost('song.mp3').should.equal(10.0)
+
+
+def test_aging_bounds_how_long_a_long_job_is_passed():
+    ("A short song uploaded after a long one should only go first "
+     "while it was uploaded less than cost / aging seconds later")
+
+    scheduler = SongScheduler(redis=Mock(), aging=10)
+
+    # Given a 90 minute set uploaded at t=0
+    long_job = scheduler.score(5400, 0)
+
+    # Then a jingle uploaded 8 minutes later goes first
+    scheduler.score(3, 480).should.be.lower_than(long_job)
+
+    # But not one uploaded 10 minutes later
+    scheduler.score(3, 600).should.be.greater_than(long_job)
+
+
+def test_push_stores_the_job_and_its_score():
+    ("SongScheduler.push() should keep the job and index it by score "
+     "in a single transaction")
+
+    redis = Mock()
+    scheduler = SongScheduler(redis=redis, aging=2)
+
+    job = scheduler.push({'token': 'abc', 'filename': 'a.mp3'}, cost=30, now=100)
+
+    job['estimated_cost'].should.equal(30)
+    redis.pipeline.assert_called_once_with(transaction=True)
+    pipe = redis.pipeline.return_value
+    pipe.hset.assert_called_once_with('schedule:songs:jobs', 'abc', json.dumps(job))
+    pipe.zadd.assert_called_once_with('schedule:songs', 230, 'abc')
+    pipe.execute.assert_called_once_with()
+
+
+def test_push_again_puts_converted_songs_first():
+    ("SongScheduler.push_again() should give songs that were already "
+     "converted a cost of 0 and keep the estimate of the others")
+
+    scheduler = SongScheduler(redis=Mock())
+    scheduler.push = Mock(name='push')
+    converted = {'token': 'one', 'checkpoints': {'convert': {'files': {}}}}
+    fresh = {'token': 'two', 'estimated_cost': 300}
+
+    scheduler.push_again(converted)
+    scheduler.push_again(fresh)
+
+    scheduler.push.assert_has_calls([
+        call(converted, cost=0),
+        call(fresh, cost=300),
+    ])
+
+
+def test_pop_skips_jobs_taken_by_another_worker():
+    ("SongScheduler.pop() should try the next job when another worker "
+     "removed the cheapest one first")
+
+    redis = Mock()
+    redis.zrange.side_effect = [['taken'], ['mine']]
+    pipe = redis.pipeline.return_value
+    pipe.execute.side_effect = [
+        [0, None, 0],
+        [1, json.dumps({'token': 'mine'}), 1],
+    ]
+
+    SongScheduler(redis=redis).pop().should.equal({'token': 'mine'})
+    pipe.zrem.assert_has_calls([
+        call('schedule:songs', 'taken'),
+        call('schedule:songs', 'mine'),
+    ])
+
+
+def test_pop_returns_none_when_nothing_is_waiting():
+    ("SongScheduler.pop() should return None for an empty schedule")
+
+    redis = Mock()
+    redis.zrange.return_value = []
+    SongScheduler(redis=redis).pop().should.be.none
+
+
+@patch('oggweed.scheduling.time.time', Mock(return_value=100))
+def test_feed_hands_a_job_over_when_a_slot_is_free():
+    ("SongScheduler.feed() should put the cheapest job in the lineup "
+     "queue and wait for the step to submit it")
+
+    scheduler = SongScheduler(redis=Mock(), leases=Mock())
+    scheduler.pop = Mock(return_value={'token': 'abc'})
+    slots = ConversionSlots(1)
+    queue = Mock()
+    queue.put.side_effect = lambda job: slots.submit(lambda: None)
+
+    job = {'token': 'abc', 'enqueued_at': 100}
+    scheduler.feed(queue, slots).should.equal(job)
+    queue.put.assert_called_once_with(job)
+    slots.submitted.should.equal(1)
+    slots.join()
+
+    # And the job was leased to this node before entering the queue
+    scheduler.leases.acquire.assert_called_once_with(job)
+
+
+def test_feed_gives_up_waiting_for_a_job_taken_elsewhere():
+    ("SongScheduler.feed() should stop waiting for the submission "
+     "after the timeout")
+
+    scheduler = SongScheduler(redis=Mock(), leases=Mock())
+    scheduler.pop = Mock(return_value={'token': 'abc'})
+    slots = ConversionSlots(1)
+
+    scheduler.feed(Mock(), slots, timeout=0.01)['token'].should.equal('abc')
+    slots.submitted.should.equal(0)
+
+
+def test_conversion_slots_wait_for_free_slot_times_out():
+    ("ConversionSlots.wait_for_free_slot() should return False when "
+     "no slot was freed in time")
+
+    slots = ConversionSlots(0)
+    slots.wait_for_free_slot(timeout=0.01).should.be.false
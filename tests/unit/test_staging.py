@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2013 OggWeed LLC
+#
+from __future__ import unicode_literals
+import os
+import shutil
+import tempfile
+from mock import Mock, call
+from oggweed.staging import StagingArea
+
+
+def make_staging_area(redis=None, **kw):
+    folder = tempfile.mkdtemp(prefix='oggweed-staging-')
+    return StagingArea(path=folder, redis=redis or Mock(name='redis'), **kw)
+
+
+def stage(area, token, name, size):
+    folder = os.path.join(area.path, token)
+    if not os.path.isdir(folder):
+        os.mkdir(folder)
+
+    path = os.path.join(folder, name)
+    with open(path, 'wb') as fd:
+        fd.write(b'x' * size)
+
+    return path
+
+
+class FakeRedis(object):
+    """Just enough of the staging keys to run an eviction"""
+
+    def __init__(self, files, finalized):
+        self.files = files
+        self.finalized = finalized
+        self.used = sum(sum(sizes.values()) for sizes in files.values())
+
+    def get(self, key):
+        return str(self.used)
+
+    def zrangebyscore(self, key, minimum, maximum):
+        return [token for token, score in sorted(self.finalized.items(), key=lambda item: item[1])
+                if score <= maximum]
+
+    def zrange(self, key, start, end):
+        tokens = sorted(self.finalized, key=self.finalized.get)
+        return tokens[start:end + 1]
+
+    def zrem(self, key, token):
+        return self.finalized.pop(token, None) is not None
+
+    def hgetall(self, key):
+        return dict((path, str(size)) for path, size in
+                    self.files.pop(key.split(':')[-1], {}).items())
+
+    def pipeline(self, transaction=True):
+        pipe = Mock(name='pipe')
+        pipe.decrby.side_effect = lambda key, amount: setattr(self, 'used', self.used - amount)
+        return pipe
+
+
+def test_staging_area_accepts_uploads_below_the_high_watermark():
+    ("StagingArea.accepts() should refuse uploads that would go past "
+     "the high watermark, reading the usage from redis")
+
+    area = make_staging_area(quota=100, high_watermark=0.9)
+    area.redis.get.return_value = '60'
+    try:
+        area.usage().should.equal(60)
+        area.accepts(30).should.be.true
+        area.accepts(31).should.be.false
+    finally:
+        shutil.rmtree(area.path)
+
+    area.redis.get.assert_called_with('staging:usage')
+
+
+def test_staging_area_adds_files_with_their_size():
+    ("StagingArea.add() should record the files of a song and only add "
+     "the difference for a file it knew already")
+
+    area = make_staging_area()
+    try:
+        upload = stage(area, 'abc', 'song.aiff', 30)
+        ogg = stage(area, 'abc', 'song.aiff.ogg', 10)
+        area.redis.hmget.return_value = ['25', None]
+
+        area.add('abc', [upload, ogg])
+    finally:
+        shutil.rmtree(area.path)
+
+    area.redis.hmget.call_args[0][0].should.equal('staging:files:abc')
+    pipe = area.redis.pipeline.return_value
+    pipe.hmset.assert_called_once_with('staging:files:abc', {upload: 30, ogg: 10})
+    pipe.incrby.assert_called_once_with('staging:usage', 15)
+
+
+def test_staging_area_finalize():
+    ("StagingArea.finalize() should make the songs candidates for "
+     "eviction, in the order they were finalized")
+
+    area = make_staging_area()
+    shutil.rmtree(area.path)
+
+    area.finalize(['abc', 'def'], now=300)
+
+    area.redis.pipeline.return_value.zadd.assert_has_calls([
+        call('staging:finalized', 300, 'abc'),
+        call('staging:finalized', 300, 'def'),
+    ])
+
+
+def test_staging_area_evicts_the_oldest_finalized_songs():
+    ("StagingArea.evict() should delete the files of the songs finalized "
+     "first, down to the low watermark, and leave pending ones alone")
+
+    area = make_staging_area(quota=100, low_watermark=0.6, max_age=1000)
+    try:
+        # Given an old and a recent finalized song
+        old = stage(area, 'old', 'old.aiff', 30)
+        old_ogg = stage(area, 'old', 'old.aiff.ogg', 10)
+        recent = stage(area, 'recent', 'recent.aiff', 30)
+
+        # And a song that is still being converted
+        pending = stage(area, 'pending', 'pending.aiff', 30)
+
+        area.redis = FakeRedis({
+            'old': {old: 30, old_ogg: 10},
+            'recent': {recent: 30},
+            'pending': {pending: 30},
+        }, finalized={'old': 100, 'recent': 200})
+
+        # When I evict
+        deleted = area.evict(now=300)
+
+        # Then only the old song was deleted, with its folder
+        sorted(deleted).should.equal(sorted([old, old_ogg]))
+        area.usage().should.equal(60)
+        os.path.exists(os.path.dirname(old)).should.be.false
+
+        # And the other files are still there
+        os.path.exists(recent).should.be.true
+        os.path.exists(pending).should.be.true
+    finally:
+        shutil.rmtree(area.path)
+
+
+def test_staging_area_evicts_old_finalized_songs_under_quota():
+    ("StagingArea.evict() should delete the files of songs finalized "
+     "more than max_age ago even when the quota is fine")
+
+    area = make_staging_area(quota=1000, max_age=100)
+    try:
+        old = stage(area, 'old', 'old.aiff', 10)
+        recent = stage(area, 'recent', 'recent.aiff', 10)
+        area.redis = FakeRedis({
+            'old': {old: 10},
+            'recent': {recent: 10},
+        }, finalized={'old': 100, 'recent': 250})
+
+        area.evict(now=300).should.equal([old])
+        area.usage().should.equal(10)
+    finally:
+        shutil.rmtree(area.path)
+
+
+def test_staging_area_never_deletes_a_song_twice():
+    ("StagingArea.delete() should leave the files alone when another "
+     "process already removed the song from the finalized set")
+
+    area = make_staging_area()
+    area.redis.zrem.return_value = 0
+    try:
+        area.delete('abc').should.equal([])
+    finally:
+        shutil.rmtree(area.path)
+
+    area.redis.hgetall.called.should.be.false
+    area.redis.pipeline.called.should.be.false
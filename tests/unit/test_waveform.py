@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2013 OggWeed LLC
+#
+from __future__ import unicode_literals
+import json
+from array import array
+from mock import Mock, call
+from oggweed.waveform import (
+    PeakBuilder,
+    Waveform,
+    WaveformStore,
+    encode_peaks,
+    get_peaks,
+    merge_peaks,
+)
+
+
+def pcm(*samples):
+    return array(b'h', samples).tostring()
+
+
+def test_get_peaks():
+    ("get_peaks() should return the min and max of every block of "
+     "samples, including the last partial one")
+
+    peaks = get_peaks(pcm(1, -5, 3, 7, -2, 0, 4), 3)
+    list(peaks).should.equal([-5, 3, -2, 7, 4, 4])
+
+
+def test_merge_peaks():
+    ("merge_peaks() should combine every two neighbour peaks")
+
+    merged = merge_peaks(array(b'h', [-5, 3, -2, 7, 4, 4]))
+    list(merged).should.equal([-5, 7, 4, 4])
+
+
+def test_encode_peaks():
+    ("encode_peaks() should keep the high byte for 8 bits and write "
+     "little-endian shorts for 16 bits")
+
+    peaks = array(b'h', [-32768, 32767, 256, -256])
+
+    encode_peaks(peaks, 8).should.equal(b'\x80\x7f\x01\xff')
+    encode_peaks(peaks, 16).should.equal(b'\x00\x80\xff\x7f\x00\x01\x00\xff')
+
+
+def test_peak_builder_is_independent_of_the_chunk_size():
+    ("PeakBuilder should compute the same peaks however the pcm is "
+     "split, even in the middle of a sample")
+
+    data = pcm(*[(index * 37) % 200 - 100 for index in range(1000)])
+    whole = PeakBuilder(64)
+    whole.feed(data)
+
+    split = PeakBuilder(64)
+    for offset in range(0, len(data), 77):
+        split.feed(data[offset:offset + 77])
+
+    split.finish().should.equal(whole.finish())
+    len(whole.peaks).should.equal(2 * 16)
+
+
+def test_waveform_compute_builds_every_zoom_level():
+    ("Waveform.compute() should return the overview first and double "
+     "the peaks at every zoom level")
+
+    waveform = Waveform('song.wav', sample_rate=8000, samples_per_peak=2,
+                        levels=3, bits=8)
+
+    levels = waveform.compute([pcm(1, 2, -3, 4, 5, -6, 7, 8)])
+
+    [list(peaks) for peaks in levels].should.equal([
+        [-6, 8],
+        [-3, 4, -6, 8],
+        [1, 2, -3, 4, -6, 5, 7, 8],
+    ])
+    waveform.describe(levels).should.equal({
+        'sample_rate': 8000,
+        'bits': 8,
+        'levels': [
+            {'zoom': 0, 'samples_per_peak': 8, 'peaks': 1},
+            {'zoom': 1, 'samples_per_peak': 4, 'peaks': 2},
+            {'zoom': 2, 'samples_per_peak': 2, 'peaks': 4},
+        ],
+    })
+
+
+def test_waveform_decodes_to_mono_pcm():
+    ("Waveform.get_args() should make ffmpeg write mono pcm to stdout")
+
+    args = Waveform('song.aiff', sample_rate=8000).get_args()
+
+    args[args.index('-i') + 1].should.equal('song.aiff')
+    args[args.index('-ac') + 1].should.equal('1')
+    args[args.index('-ar') + 1].should.equal('8000')
+    args[-1].should.equal('pipe:1')
+
+
+def test_waveform_store():
+    ("WaveformStore.store() should save the description and every "
+     "level in a single transaction")
+
+    redis = Mock()
+    waveform = Waveform('song.wav', sample_rate=8000, samples_per_peak=2,
+                        levels=2, bits=16)
+    levels = [array(b'h', [-6, 8]), array(b'h', [-3, 4, -6, 8])]
+
+    description = WaveformStore(redis=redis).store('abc', waveform, levels)
+
+    redis.pipeline.assert_called_once_with(transaction=True)
+    redis.pipeline.return_value.set.assert_has_calls([
+        call('song:abc:waveform', json.dumps(description)),
+        call('song:abc:waveform:0', encode_peaks(levels[0], 16)),
+        call('song:abc:waveform:1', encode_peaks(levels[1], 16)),
+    ])
+
+
+def test_waveform_store_copy():
+    ("WaveformStore.copy() should give a song every level of another "
+     "one, or nothing when one of them is missing")
+
+    description = {'bits': 8, 'levels': [{'zoom': 0}, {'zoom': 1}]}
+    redis = Mock()
+    redis.get.return_value = json.dumps(description)
+    redis.pipeline.return_value.execute.side_effect = [[b'\x01', b'\x02'], []]
+
+    WaveformStore(redis=redis).copy('old', 'new').should.equal(description)
+
+    redis.pipeline.return_value.set.assert_has_calls([
+        call('song:new:waveform', json.dumps(description)),
+        call('song:new:waveform:0', b'\x01'),
+        call('song:new:waveform:1', b'\x02'),
+    ])
+
+    redis.pipeline.return_value.execute.side_effect = [[b'\x01', None]]
+    WaveformStore(redis=redis).copy('old', 'new').should.be.none
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2013 OggWeed LLC
+#
+from __future__ import unicode_literals
+import json
+import tempfile
+from io import BytesIO
+from flask import Flask
+from mock import patch
+from oggweed.web.controllers import module
+
+TOKEN = 'a' * 40
+
+
+def make_client():
+    app = Flask(__name__)
+    app.register_blueprint(module)
+    return app.test_client()
+
+
+def post_json(path, data):
+    return make_client().post(path, data=json.dumps(data),
+                              content_type='application/json')
+
+
+@patch('oggweed.web.controllers.save_upload')
+@patch('oggweed.web.controllers.StagingArea')
+def test_upload_refuses_files_when_the_staging_area_is_full(StagingArea, save_upload):
+    ("POST /upload should answer 507 with a Retry-After when evicting "
+     "does not make room for the file")
+
+    staging = StagingArea.return_value
+    staging.accepts.return_value = False
+
+    response = make_client().post('/upload', data={
+        'file': (BytesIO(b'AIFF' * 100), 'set.aiff'),
+    })
+
+    response.status_code.should.equal(507)
+    response.headers['Retry-After'].should.equal('60')
+    staging.evict.assert_called_once_with()
+
+    # And nothing was stored
+    save_upload.called.should.be.false
+    staging.add.called.should.be.false
+
+
+@patch('oggweed.web.controllers.SongScheduler')
+@patch('oggweed.web.controllers.Song.save')
+@patch('oggweed.web.controllers.save_upload')
+@patch('oggweed.web.controllers.StagingArea')
+def test_upload_evicts_to_make_room(StagingArea, save_upload, save, SongScheduler):
+    ("POST /upload should evict finalized songs and accept the file "
+     "when that freed enough space")
+
+    staging = StagingArea.return_value
+    staging.accepts.side_effect = [False, True]
+    save_upload.return_value = ('d1g35t', 400)
+
+    response = make_client().post('/upload', data={
+        'file': (BytesIO(b'AIFF' * 100), 'set.aiff'),
+    })
+
+    response.status_code.should.equal(302)
+    staging.evict.assert_called_once_with()
+
+    song_filename = save_upload.call_args[0][1]
+    token = staging.add.call_args[0][0]
+    staging.add.assert_called_once_with(token, [song_filename])
+    save.assert_called_once_with()
+
+    job = SongScheduler.return_value.push.call_args[0][0]
+    job['token'].should.equal(token)
+    job['source_sha1'].should.equal('d1g35t')
+    job['source_size'].should.equal(400)
+
+
+@patch('oggweed.web.controllers.Song.from_upload')
+@patch('oggweed.web.controllers.connections')
+def test_initiate_upload_returns_a_presigned_post(connections, from_upload):
+    ("POST /upload/initiate should return the form that uploads the "
+     "file straight to the bucket")
+
+    from_upload.return_value.token = TOKEN
+    connection = connections.get_connection.return_value
+    connection.build_post_form_args.return_value = {
+        'action': 'https://oggweed.s3.amazonaws.com/',
+        'fields': [{'name': 'policy', 'value': 'p0l1cy'}],
+    }
+
+    response = post_json('/upload/initiate', {'filename': '../My Set.aiff'})
+
+    response.status_code.should.equal(200)
+    json.loads(response.data).should.equal({
+        'token': TOKEN,
+        'key': 'uploads/{0}/My_Set.aiff'.format(TOKEN),
+        'action': 'https://oggweed.s3.amazonaws.com/',
+        'fields': [{'name': 'policy', 'value': 'p0l1cy'}],
+    })
+    connection.build_post_form_args.assert_called_once_with(
+        'oggweed', 'uploads/{0}/My_Set.aiff'.format(TOKEN),
+        expires_in=3600,
+        max_content_length=1024 * 1024 * 1024,
+        http_method='https')
+
+
+def test_initiate_upload_requires_a_filename():
+    ("POST /upload/initiate should answer 400 without a filename")
+
+    post_json('/upload/initiate', {}).status_code.should.equal(400)
+
+
+@patch('oggweed.web.controllers.SongScheduler')
+@patch('oggweed.web.controllers.Song.get_record', return_value=(None, False))
+@patch('oggweed.web.controllers.Song.save')
+@patch('oggweed.web.controllers.connections')
+def test_complete_upload_schedules_the_song(connections, save, get_record, SongScheduler):
+    ("POST /upload/complete should save the song and schedule it with "
+     "the key of its source")
+
+    key = connections.get_bucket.return_value.get_key.return_value
+    key.size = 16000 * 42
+
+    key_name = 'uploads/{0}/set.aiff'.format(TOKEN)
+    response = post_json('/upload/complete', {'key': key_name})
+
+    response.status_code.should.equal(201)
+    json.loads(response.data)['token'].should.equal(TOKEN)
+    save.assert_called_once_with()
+
+    # And the cost was guessed from the size, nothing was probed
+    key.generate_url.called.should.be.false
+
+    job = SongScheduler.return_value.push.call_args[0][0]
+    job['token'].should.equal(TOKEN)
+    job['source_key'].should.equal(key_name)
+    job['source_size'].should.equal(16000 * 42)
+    job['filename'].should.match(r'_uploads/{0}/set.aiff$'.format(TOKEN))
+    SongScheduler.return_value.push.call_args[1].should.equal({'cost': 42.0})
+
+
+@patch('oggweed.web.controllers.SongScheduler')
+@patch('oggweed.web.controllers.Song.get_record')
+@patch('oggweed.web.controllers.Song.save', autospec=True)
+@patch('oggweed.web.controllers.connections')
+def test_complete_upload_twice(connections, save, get_record, SongScheduler):
+    ("POST /upload/complete should leave a song that exists already "
+     "alone when the browser calls it again")
+
+    records = {}
+    save.side_effect = lambda song: records.update({song.token: song.as_json()})
+    get_record.side_effect = lambda token: (records.get(token), False)
+    connections.get_bucket.return_value.get_key.return_value.size = 16000
+
+    key_name = 'uploads/{0}/set.aiff'.format(TOKEN)
+    first = post_json('/upload/complete', {'key': key_name})
+    second = post_json('/upload/complete', {'key': key_name})
+
+    first.status_code.should.equal(201)
+    second.status_code.should.equal(200)
+    json.loads(second.data).should.equal(json.loads(first.data))
+
+    # And the song was saved and scheduled only once
+    save.call_count.should.equal(1)
+    SongScheduler.return_value.push.call_count.should.equal(1)
+
+
+@patch('oggweed.web.controllers.connections')
+def test_complete_upload_refuses_unknown_keys(connections):
+    ("POST /upload/complete should only accept keys of direct uploads "
+     "that exist in the bucket")
+
+    post_json('/upload/complete', {'key': 'songs/../secret'}).status_code.should.equal(400)
+
+    connections.get_bucket.return_value.get_key.return_value = None
+    key_name = 'uploads/{0}/set.aiff'.format(TOKEN)
+    post_json('/upload/complete', {'key': key_name}).status_code.should.equal(404)
+
+
+@patch('oggweed.web.controllers.WaveformStore')
+def test_waveform_peaks_serves_one_zoom_level(WaveformStore):
+    ("GET /song/<token>/waveform/<zoom> should serve the raw peaks of "
+     "that zoom level with what is needed to draw them")
+
+    WaveformStore.return_value.get.return_value = ({
+        'sample_rate': 8000,
+        'bits': 8,
+        'levels': [{'zoom': 0, 'samples_per_peak': 512, 'peaks': 2}],
+    }, b'\x80\x7f\xf0\x10')
+
+    response = make_client().get('/song/{0}/waveform/0'.format(TOKEN))
+
+    response.status_code.should.equal(200)
+    response.data.should.equal(b'\x80\x7f\xf0\x10')
+    response.mimetype.should.equal('application/octet-stream')
+    response.headers['X-Waveform-Bits'].should.equal('8')
+    response.headers['X-Waveform-Samples-Per-Peak'].should.equal('512')
+    WaveformStore.return_value.get.assert_called_once_with(TOKEN, 0)
+
+
+@patch('oggweed.web.controllers.WaveformStore')
+def test_waveform_peaks_of_unknown_levels(WaveformStore):
+    ("GET /song/<token>/waveform/<zoom> should return 404 for songs "
+     "or zoom levels without peaks")
+
+    WaveformStore.return_value.get.return_value = (None, None)
+    response = make_client().get('/song/{0}/waveform/9'.format(TOKEN))
+    response.status_code.should.equal(404)
+
+
+@patch('oggweed.web.controllers.send_file_range')
+@patch('oggweed.web.controllers.LocalStorage')
+def test_media_serves_the_local_storage(LocalStorage, send_file_range):
+    ("GET /media/<key_name> should serve files of the local storage "
+     "with range support")
+
+    song = tempfile.NamedTemporaryFile(suffix='.ogg')
+    LocalStorage.return_value.get_path.return_value = song.name
+    send_file_range.return_value = 'OggS'
+
+    response = make_client().get('/media/{0}:song.ogg'.format(TOKEN))
+
+    response.data.should.equal(b'OggS')
+    LocalStorage.return_value.get_path.assert_called_once_with(
+        '{0}:song.ogg'.format(TOKEN))
+    send_file_range.assert_called_once_with(song.name, 'audio/ogg')
+
+
+@patch('oggweed.web.controllers.LocalStorage')
+def test_media_of_unknown_files(LocalStorage):
+    ("GET /media/<key_name> should return 404 for missing files")
+
+    LocalStorage.return_value.get_path.return_value = None
+    make_client().get('/media/../secret').status_code.should.equal(404)
+
+
+@patch('oggweed.web.controllers.Song.from_token')
+@patch('oggweed.web.controllers.get_song_events')
+def test_song_events_streams_the_song(get_song_events, from_token):
+    ("GET /song/<token>/events should subscribe before reading the song "
+     "and stream its events")
+
+    events = get_song_events.return_value
+    events.stream.return_value = iter(['event: finalized\ndata: {}\n\n'])
+
+    response = make_client().get('/song/{0}/events'.format(TOKEN))
+
+    response.status_code.should.equal(200)
+    response.mimetype.should.equal('text/event-stream')
+    response.headers['Cache-Control'].should.equal('no-cache')
+    response.data.should.equal(b'event: finalized\ndata: {}\n\n')
+    events.subscribe.assert_called_once_with(TOKEN)
+    events.stream.assert_called_once_with(
+        from_token.return_value, events.subscribe.return_value)
+
+
+@patch('oggweed.web.controllers.Song.from_token')
+@patch('oggweed.web.controllers.get_song_events')
+def test_song_events_of_unknown_songs(get_song_events, from_token):
+    ("GET /song/<token>/events should return 404 for unknown songs")
+
+    events = get_song_events.return_value
+    from_token.side_effect = TypeError('expected string or buffer')
+
+    make_client().get('/song/{0}/events'.format(TOKEN)).status_code.should.equal(404)
+    events.unsubscribe.assert_called_once_with(TOKEN, events.subscribe.return_value)
+
+
+@patch('oggweed.web.controllers.send_asset')
+@patch('oggweed.web.controllers.settings')
+def test_assets_serves_the_static_build(settings, send_asset):
+    ("GET /assets/<filename> should serve the fingerprinted static files")
+
+    settings.STATIC_BUILD_ROOT = tempfile.mkdtemp(prefix='oggweed-build-')
+    settings.STATIC_MAX_AGE = 60
+    open(settings.STATIC_BUILD_ROOT + '/oggweed.d75128286c95.js', 'wb').close()
+    send_asset.return_value = 'var'
+
+    client = make_client()
+
+    client.get('/assets/oggweed.d75128286c95.js').data.should.equal(b'var')
+    send_asset.assert_called_once_with(
+        settings.STATIC_BUILD_ROOT + '/oggweed.d75128286c95.js', max_age=60)
+    client.get('/assets/oggweed.js').status_code.should.equal(404)
+    client.get('/assets/../settings.py').status_code.should.equal(404)
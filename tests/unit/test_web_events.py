@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2013 OggWeed LLC
+#
+from __future__ import unicode_literals
+import json
+from mock import patch
+from oggweed.web.models import Song
+from oggweed.web.events import SongEvents, format_event
+
+
+def pmessage(token, event):
+    return {
+        'type': 'pmessage',
+        'pattern': 'song:*:events',
+        'channel': 'song:{0}:events'.format(token),
+        'data': json.dumps(event),
+    }
+
+
+def test_format_event():
+    ("format_event() should frame the data as json")
+
+    format_event('progress', {'done': 1}).should.equal(
+        'event: progress\ndata: {"done": 1}\n\n')
+
+
+def test_song_events_dispatch_to_the_clients_of_the_song():
+    ("SongEvents.dispatch() should hand the events of a song to the "
+     "clients waiting on it only")
+
+    events = SongEvents(keepalive=1, backlog=10)
+    first = events.subscribe('abc')
+    second = events.subscribe('abc')
+    other = events.subscribe('def')
+
+    events.dispatch({'type': 'psubscribe', 'channel': 'song:*:events', 'data': 1})
+    events.dispatch(pmessage('abc', {'stage': 'convert', 'done': 1}))
+
+    first.get_nowait().should.equal({'stage': 'convert', 'done': 1})
+    second.get_nowait().should.equal({'stage': 'convert', 'done': 1})
+    other.empty().should.be.true
+
+
+def test_song_events_drop_events_of_slow_clients():
+    ("SongEvents.dispatch() should drop the events past the backlog "
+     "of a client instead of blocking the others")
+
+    events = SongEvents(keepalive=1, backlog=1)
+    queue = events.subscribe('abc')
+
+    events.dispatch(pmessage('abc', {'stage': 'convert', 'done': 1}))
+    events.dispatch(pmessage('abc', {'stage': 'convert', 'done': 2}))
+
+    queue.qsize().should.equal(1)
+
+
+def test_song_events_stream_until_finalized():
+    ("SongEvents.stream() should send the progress, keepalives while "
+     "idle and stop after the song was finalized")
+
+    events = SongEvents(keepalive=0.01, backlog=10)
+    queue = events.subscribe('abc')
+    stream = events.stream(Song(token='abc'), queue)
+
+    next(stream).should.equal('retry: 10\n\n')
+    next(stream).should.equal(': keepalive\n\n')
+
+    queue.put({'stage': 'convert', 'done': 5, 'total': 10})
+    queue.put({'stage': 'finalized', 'url': '/media/abc:song.ogg'})
+
+    next(stream).should.match(r'^event: progress\n')
+    next(stream).should.match(r'^event: finalized\n')
+    list(stream).should.equal([])
+
+    # And the client was unsubscribed
+    events.listeners.should.be.empty
+
+
+def test_song_events_stream_finalized_songs_right_away():
+    ("SongEvents.stream() should end at once for songs finalized "
+     "before the client connected")
+
+    events = SongEvents(keepalive=1, backlog=10)
+    queue = events.subscribe('abc')
+    song = Song(token='abc', finalized_at=10, url='/media/abc:song.ogg')
+
+    chunks = list(events.stream(song, queue))
+
+    chunks[1].should.equal(format_event('finalized', {
+        'stage': 'finalized',
+        'url': '/media/abc:song.ogg',
+        'finalized_at': 10,
+    }))
+    events.listeners.should.be.empty
+
+
+@patch('oggweed.web.events.get_redis_pubsub')
+def test_song_events_listen(get_redis_pubsub):
+    ("SongEvents.listen() should use a single pattern subscription "
+     "for all the songs")
+
+    pubsub = get_redis_pubsub.return_value
+    pubsub.listen.return_value = [pmessage('abc', {'stage': 'failed'})]
+    events = SongEvents(keepalive=1, backlog=10)
+    queue = events.subscribe('abc')
+
+    events.listen()
+
+    pubsub.psubscribe.assert_called_once_with('song:*:events')
+    queue.get_nowait().should.equal({'stage': 'failed'})
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2013 OggWeed LLC
+#
+from __future__ import unicode_literals
+import json
+from mock import patch, call
+from oggweed.web.models import Song
+
+
+@patch('oggweed.web.models.get_redis_connection')
+def test_song_save_uses_a_single_transaction(get_redis_connection):
+    ("Song.save() should index the token and store the json in a single MULTI/EXEC")
+
+    # Given a song that was just uploaded
+    song = Song(token='abc', day='2013-10-20', filename='song.aiff',
+                uploaded_at=1382227200)
+
+    # When I save it
+    song.save()
+
+    # Then a transaction was used
+    redis = get_redis_connection.return_value
+    redis.pipeline.assert_called_once_with(transaction=True)
+
+    # And the commands were queued in it
+    pipe = redis.pipeline.return_value
+    pipe.zadd.assert_has_calls([
+        call('index:songs:all', 1382227200, 'abc'),
+        call('index:songs:2013-10-20', 1382227200, 'abc'),
+        call('index:songs:pending', 1382227200, 'abc'),
+    ])
+    pipe.set.assert_called_once_with('song:abc', song.as_json())
+    pipe.publish.called.should.be.false
+
+    # And executed once
+    pipe.execute.assert_called_once_with()
+
+
+@patch('oggweed.web.models.get_redis_connection')
+def test_song_save_many(get_redis_connection):
+    ("Song.save_many() should persist all the songs with a single execute")
+
+    # Given 2 finished songs
+    songs = [
+        Song(token='one', uploaded_at=1, finalized_at=10),
+        Song(token='two', uploaded_at=2, finalized_at=20),
+    ]
+
+    # When I save them together
+    Song.save_many(songs)
+
+    # Then both moved from the pending to the ready index
+    pipe = get_redis_connection.return_value.pipeline.return_value
+    pipe.zrem.assert_has_calls([
+        call('index:songs:pending', 'one'),
+        call('index:songs:pending', 'two'),
+    ])
+    pipe.zadd.assert_has_calls([
+        call('index:songs:ready', 10, 'one'),
+        call('index:songs:ready', 20, 'two'),
+    ], any_order=True)
+
+    # And the browsers waiting on them were told
+    pipe.publish.assert_has_calls([
+        call('song:one:events', json.dumps({'stage': 'finalized', 'url': None, 'finalized_at': 10})),
+        call('song:two:events', json.dumps({'stage': 'finalized', 'url': None, 'finalized_at': 20})),
+    ])
+
+    # And a single round trip was made
+    pipe.execute.assert_called_once_with()
+
+
+@patch('oggweed.web.models.get_redis_connection')
+def test_song_list_returns_a_page_and_the_next_cursor(get_redis_connection):
+    ("Song.list() should read a page of the index and hydrate the "
+     "songs with a single MGET")
+
+    # Given an index with a full page of 2 songs
+    redis = get_redis_connection.return_value
+    redis.zrevrangebyscore.return_value = [('two', 20.0), ('one', 10.5)]
+    redis.mget.return_value = [
+        Song(token='two').as_json(),
+        Song(token='one').as_json(),
+    ]
+
+    # When I list the ready songs after a cursor
+    songs, cursor = Song.list('ready', cursor='30.0:0', limit=2)
+
+    # Then the index was read starting at the cursor
+    redis.zrevrangebyscore.assert_called_once_with(
+        'index:songs:ready', '30.0', '-inf',
+        start=0, num=2, withscores=True)
+
+    # And the songs were fetched at once
+    redis.mget.assert_called_once_with(['song:two', 'song:one'])
+    [s.token for s in songs].should.equal(['two', 'one'])
+
+    # And the next page starts after the last song
+    cursor.should.equal('10.5:1')
+
+
+@patch('oggweed.web.models.get_redis_connection')
+def test_song_list_pages_through_equal_scores(get_redis_connection):
+    ("Song.list() should return every song once when songs with the "
+     "same score cross a page boundary")
+
+    # Given an index where four songs were finalized at the same time
+    index = [('e', 30.0), ('d', 20.0), ('c', 20.0), ('b', 20.0),
+             ('a', 20.0), ('z', 10.0)]
+
+    def zrevrangebyscore(key, maximum, minimum, start, num, withscores):
+        exclusive = maximum.startswith('(')
+        maximum = float(maximum.lstrip('('))
+        below = [entry for entry in index
+                 if entry[1] < maximum or (entry[1] == maximum and not exclusive)]
+        return below[start:start + num]
+
+    redis = get_redis_connection.return_value
+    redis.zrevrangebyscore.side_effect = zrevrangebyscore
+    redis.mget.side_effect = lambda keys: [
+        Song(token=key.split(':')[1]).as_json() for key in keys]
+
+    # When I list them 2 at a time
+    tokens, cursor = [], None
+    while True:
+        songs, cursor = Song.list('ready', cursor=cursor, limit=2)
+        tokens.extend(song.token for song in songs)
+        if not cursor:
+            break
+
+    # Then every song was listed once
+    tokens.should.equal(['e', 'd', 'c', 'b', 'a', 'z'])
+
+
+@patch('oggweed.web.models.get_redis_connection')
+def test_song_list_accepts_old_cursors(get_redis_connection):
+    ("Song.list() should read below the score of a cursor without "
+     "a skip count")
+
+    redis = get_redis_connection.return_value
+    redis.zrevrangebyscore.return_value = []
+
+    Song.list('ready', cursor='30.0', limit=2).should.equal(([], None))
+    redis.zrevrangebyscore.assert_called_once_with(
+        'index:songs:ready', '(30.0', '-inf',
+        start=0, num=2, withscores=True)
+
+
+@patch('oggweed.web.models.get_redis_connection')
+def test_song_list_last_page(get_redis_connection):
+    ("Song.list() should return no cursor after the last page")
+
+    # Given an index with a single song
+    redis = get_redis_connection.return_value
+    redis.zrevrangebyscore.return_value = [('one', 10.0)]
+    redis.mget.return_value = [Song(token='one').as_json()]
+
+    # When I list a page of 20 songs
+    songs, cursor = Song.list()
+
+    # Then there is no next page
+    len(songs).should.equal(1)
+    cursor.should.be.none
+
+
+@patch('oggweed.web.models.get_redis_connection')
+def test_song_get_record(get_redis_connection):
+    ("Song.get_record() should read the stored json and whether the "
+     "song is ready in a single round trip")
+
+    pipe = get_redis_connection.return_value.pipeline.return_value
+    pipe.execute.return_value = ['{"token": "abc"}', 20.0]
+
+    Song.get_record('abc').should.equal(('{"token": "abc"}', True))
+
+    pipe.get.assert_called_once_with('song:abc')
+    pipe.zscore.assert_called_once_with('index:songs:ready', 'abc')
+    pipe.execute.assert_called_once_with()
+
+
+def test_song_from_upload_gets_a_folder_per_upload():
+    ("Song.from_upload() should keep every upload in a folder named "
+     "after its token, even when the names are the same")
+
+    first = Song.from_upload('set.aiff')
+    second = Song.from_upload('set.aiff')
+
+    first.token.should_not.equal(second.token)
+    first.filename.should.match(r'_uploads/{0}/set.aiff$'.format(first.token))
+
+    direct = Song.from_upload('set.aiff', token='a' * 40)
+    direct.token.should.equal('a' * 40)
+    direct.filename.should.match(r'_uploads/a{40}/set.aiff$')
@@ -0,0 +1,1411 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2013 OggWeed LLC
+#
+from __future__ import unicode_literals
+import os
+import json
+import shutil
+import threading
+import tempfile
+import subprocess
+from io import BytesIO
+from array import array
+from hashlib import md5, sha1
+from mock import patch, Mock, call
+from oggweed.workers.storage import (
+    S3Connections,
+    S3Storage,
+    MultipartUpload,
+    ResumableUpload,
+)
+from oggweed.workers import (
+    probe,
+    OggConverter,
+    ConversionError,
+    FFmpegProgress,
+    ConversionSlots,
+    AnythingToOgg,
+    StoreSong,
+    StreamToStorage,
+    TranscodeCache,
+    ProgressReporter,
+    SongBatch,
+    RetryQueue,
+    FetchFromS3,
+    StreamingOggPipeline,
+    file_sha1,
+)
+from oggweed.waveform import Waveform
+
+
+@patch('oggweed.workers.subprocess')
+def test_ogg_converter_stream_yields_ffmpeg_stdout(subprocess):
+    ("OggConverter.stream() should run ffmpeg writing to `pipe:1` "
+     "and yield its stdout in chunks")
+
+    # Background: ffmpeg outputs 10 bytes and exits successfully
+    process = subprocess.Popen.return_value
+    process.stdout = BytesIO(b'0123456789')
+    process.stderr = BytesIO(b'')
+    process.wait.return_value = 0
+
+    # Given an OggConverter
+    audio = OggConverter('/tmp/song.aiff')
+
+    # When I consume the stream in chunks of 4 bytes
+    chunks = list(audio.stream(chunk_size=4))
+
+    # Then it should have yielded the whole stdout
+    chunks.should.equal([b'0123', b'4567', b'89'])
+
+    # And ffmpeg was called writing the ogg container to stdout
+    command = subprocess.Popen.call_args[0][0]
+    command[-3:].should.equal(['-f', 'ogg', 'pipe:1'])
+
+    # And the metadata is available after the stream ended
+    audio.output.should.equal({'encode_path': 'transcode', 'source': None})
+
+
+@patch('oggweed.workers.subprocess')
+def test_ogg_converter_stream_raises_conversion_error(subprocess):
+    ("OggConverter.stream() should raise ConversionError when ffmpeg fails")
+
+    # Background: ffmpeg outputs nothing and exits with an error
+    process = subprocess.Popen.return_value
+    process.stdout = BytesIO(b'')
+    process.stderr = BytesIO(b'')
+    process.wait.return_value = 1
+
+    # Given an OggConverter
+    audio = OggConverter('/tmp/song.aiff')
+
+    # When I consume the stream
+    consume = lambda: list(audio.stream())
+
+    # Then it should raise ConversionError
+    consume.when.called_with().should.throw(ConversionError)
+
+
+@patch('oggweed.workers.probe')
+@patch('oggweed.workers.subprocess')
+def test_ogg_converter_convert_parses_stderr_while_running(subprocess, probe):
+    ("OggConverter.convert() should report the progress of ffmpeg "
+     "and parse the metadata from its log")
+
+    # Background: ffprobe can't read the source
+    probe.side_effect = OSError('ffprobe')
+
+    # Background: ffmpeg logs the input and two progress blocks
+    process = subprocess.Popen.return_value
+    process.stderr = BytesIO(
+        b"Input #0, aiff, from 'song.aiff':\n"
+        b"  Duration: 00:01:40.00, start: 0.000000, bitrate: 1411 kb/s\n"
+        b"bitrate= 120.1kbits/s\n"
+        b"out_time=00:00:50.000000\n"
+        b"speed=25x\n"
+        b"progress=continue\n"
+        b"bitrate= 121.0kbits/s\n"
+        b"out_time=00:01:40.000000\n"
+        b"speed=26.5x\n"
+        b"progress=end\n")
+    process.wait.return_value = 0
+
+    # Given an OggConverter with a progress callback
+    progress = Mock(name='progress')
+    audio = OggConverter('/tmp/song.aiff', progress=progress)
+
+    # When I convert it
+    metadata = audio.convert()
+
+    # Then the progress was reported for each block
+    progress.assert_has_calls([
+        call(50.0, 100.0, speed=25.0, bitrate=b'120.1kbits/s'),
+        call(100.0, 100.0, speed=26.5, bitrate=b'121.0kbits/s'),
+    ])
+
+    # And the metadata came from the log lines
+    metadata.should.equal({
+        'duration': b'00:01:40',
+        'bitrate': b'1411 kb/s',
+        'final_path': '/tmp/song.aiff.ogg',
+        'encode_path': 'transcode',
+        'source': None,
+        'renditions': {
+            'high': {'final_path': '/tmp/song.aiff.ogg',
+                     'encode_path': 'encode'},
+            'standard': {'final_path': '/tmp/song.aiff.standard.ogg',
+                         'encode_path': 'encode'},
+            'mobile': {'final_path': '/tmp/song.aiff.mobile.ogg',
+                       'encode_path': 'encode'},
+        },
+    })
+
+    # And ffmpeg was called once for all the renditions
+    subprocess.Popen.call_count.should.equal(1)
+    command = subprocess.Popen.call_args[0][0]
+    command.count('-map').should.equal(3)
+
+
+def test_ffmpeg_progress_keeps_log_lines_apart():
+    ("FFmpegProgress should keep only the regular log lines in `output`")
+
+    # Given a parser
+    parser = FFmpegProgress()
+
+    # When it is fed log and progress lines
+    parser.feed(b'Stream #0:0: Audio: vorbis\n')
+    parser.feed(b'out_time=00:00:01.500000\n')
+    parser.feed(b'speed=N/A\n')
+    parser.feed(b'progress=continue\n')
+
+    # Then the output has only the log
+    parser.output.should.equal(b'Stream #0:0: Audio: vorbis\n')
+
+    # And the progress was parsed
+    parser.out_time.should.equal(1.5)
+    parser.speed.should.be.none
+
+
+@patch('oggweed.workers.settings')
+def test_ogg_converter_is_too_slow(settings):
+    ("OggConverter.is_too_slow() should only be true after the grace "
+     "period when the conversion runs slower than the minimum speed")
+
+    # Background: conversions must run at realtime after 10 seconds
+    settings.FFMPEG_MIN_SPEED = 1
+    settings.FFMPEG_SPEED_GRACE = 10
+
+    # Given a conversion that started at 100 and converted 15 seconds
+    audio = OggConverter('/tmp/song.aiff')
+    audio.started_at = 100
+    audio.parser = FFmpegProgress()
+    audio.parser.out_time = 15.0
+
+    # Then it is not too slow during the grace period
+    audio.is_too_slow(105).should.be.false
+
+    # And it is fine at 1.5x
+    audio.is_too_slow(110).should.be.false
+
+    # But it is too slow at 0.75x
+    audio.is_too_slow(120).should.be.true
+
+
+@patch('oggweed.workers.settings')
+def test_ogg_converter_is_not_too_slow_while_its_output_waits(settings):
+    ("OggConverter.is_too_slow() should not count the time the output "
+     "of a streamed conversion waited on its consumer")
+
+    settings.FFMPEG_MIN_SPEED = 1
+    settings.FFMPEG_SPEED_GRACE = 10
+
+    # Given a conversion that started at 100 and converted 15 seconds
+    audio = OggConverter('/tmp/song.aiff')
+    audio.started_at = 100
+    audio.parser = FFmpegProgress()
+    audio.parser.out_time = 15.0
+
+    # When its consumer held a chunk from 105 to 125
+    audio.stall(now=105)
+
+    # Then the conversion is not too slow while the chunk is held
+    audio.is_too_slow(120).should.be.false
+    audio.get_running_time(120).should.equal(5)
+
+    # Nor after the consumer came back
+    audio.resume(now=125)
+    audio.is_too_slow(130).should.be.false
+    audio.get_running_time(130).should.equal(10)
+
+    # But it still is when ffmpeg itself falls behind
+    audio.is_too_slow(145).should.be.true
+
+
+def test_multipart_upload_sends_parts_of_part_size():
+    ("MultipartUpload should send a part whenever `part_size` bytes "
+     "are buffered and the remaining bytes when closed")
+
+    # Given a bucket
+    bucket = Mock(name='bucket')
+    multipart = bucket.initiate_multipart_upload.return_value
+    sizes = []
+    multipart.upload_part_from_file.side_effect = (
+        lambda fp, number, size: sizes.append((number, fp.read(size))))
+
+    # And a progress callback
+    callback = Mock(name='callback')
+
+    # And a multipart upload with a tiny minimum part size
+    class TinyUpload(MultipartUpload):
+        minimum_part_size = 4
+
+    upload = TinyUpload(bucket, 'token:song.ogg', callback=callback)
+
+    # When I write 10 bytes in chunks of 3 and close it
+    for chunk in [b'012', b'345', b'678', b'9']:
+        upload.write(chunk)
+
+    upload.close()
+
+    # Then it should have uploaded 2 parts
+    sizes.should.equal([
+        (1, b'012345'),
+        (2, b'6789'),
+    ])
+
+    # And the upload was completed
+    multipart.complete_upload.assert_called_once_with()
+
+    # And the progress was reported after each part
+    callback.assert_has_calls([call(6, None), call(10, None)])
+
+
+def test_conversion_slots_never_exceed_its_size():
+    ("ConversionSlots should not run more than `size` callables at once")
+
+    # Given 2 conversion slots
+    slots = ConversionSlots(2)
+
+    # And a callable that records how many slots are busy
+    release = threading.Event()
+    seen = []
+
+    def convert():
+        seen.append(slots.busy)
+        release.wait()
+
+    # When I submit 2 callables
+    slots.submit(convert)
+    slots.submit(convert)
+
+    # Then a third submission blocks
+    third = threading.Thread(target=slots.submit, args=(convert, ))
+    third.start()
+    third.join(0.1)
+    third.is_alive().should.be.true
+
+    # And when the running callables finish, every one of them ran
+    release.set()
+    third.join()
+    slots.join()
+
+    len(seen).should.equal(3)
+    max(seen).should.be.lower_than(3)
+
+
+@patch('oggweed.workers.TranscodeCache')
+@patch('oggweed.workers.OggConverter')
+def test_anything_to_ogg_rolls_back_failed_conversions(OggConverter, TranscodeCache):
+    ("AnythingToOgg should call rollback with the traceback when "
+     "a conversion fails inside of a slot")
+
+    # Background: the transcode cache is empty
+    TranscodeCache.return_value.lookup.return_value = False
+
+    # And the conversion fails
+    OggConverter.return_value.convert.side_effect = ValueError('boom')
+
+    # Given an AnythingToOgg step that mocks rollback
+    step = AnythingToOgg(Mock(), Mock(), Mock(), Mock())
+    step.rollback = Mock(name='rollback')
+
+    # When it consumes a song
+    instructions = {'token': 'abc', 'filename': '/tmp/song.aiff', 'metadata': {}}
+    step.consume(instructions)
+    step.get_slots().join()
+
+    # Then rollback was called
+    step.rollback.assert_called_once_with(instructions)
+
+    # And the traceback was stored in the instructions
+    instructions['__lineup__error__']['traceback'].should.contain('boom')
+
+
+@patch('oggweed.workers.time')
+def test_transcode_cache_lookup_hit(time):
+    ("TranscodeCache.lookup() should fill the instructions with the "
+     "url and metadata of a previous conversion of the same audio")
+
+    # Background: time is mocked
+    time.time.return_value = 42
+
+    # Given a redis connection that has a cached conversion
+    redis = Mock(name='redis')
+    redis.get.return_value = (
+        '{"url": "http://s3/abc:song.ogg", '
+        '"metadata": {"key_name": "abc:song.ogg"}}')
+
+    # And an audio with a known digest
+    audio = Mock(name='audio')
+    audio.get_digest.return_value = 'd1g3st'
+
+    # When I look up a song that already has some metadata
+    instructions = {'token': 'newtoken', 'metadata': {'original_name': 'a.wav'}}
+    found = TranscodeCache(redis).lookup(instructions, audio)
+
+    # Then it should have been found
+    found.should.be.true
+    redis.get.assert_called_once_with('cache:transcode:d1g3st')
+
+    # And the instructions point to the existing key, keeping the
+    # metadata of the song
+    instructions.should.equal({
+        'token': 'newtoken',
+        'url': 'http://s3/abc:song.ogg',
+        'metadata': {'key_name': 'abc:song.ogg', 'cached': True,
+                     'original_name': 'a.wav'},
+        'converted_at': 42,
+        'finalized_at': 42,
+    })
+
+
+@patch('oggweed.workers.WaveformStore')
+def test_transcode_cache_lookup_hit_copies_the_waveform(WaveformStore):
+    ("TranscodeCache.lookup() should give the song the waveform of the "
+     "conversion it found, since it is saved right away")
+
+    # Given a cached conversion of the song `abc`
+    redis = Mock(name='redis')
+    redis.get.return_value = json.dumps({
+        'token': 'abc',
+        'url': 'http://s3/abc:song.ogg',
+        'metadata': {'key_name': 'abc:song.ogg', 'waveform': {'bits': 16}},
+    })
+    WaveformStore.return_value.copy.return_value = {'bits': 8}
+    audio = Mock(name='audio')
+    audio.get_digest.return_value = 'd1g3st'
+
+    # When I look it up
+    instructions = {'token': 'newtoken'}
+    TranscodeCache(redis).lookup(instructions, audio).should.be.true
+
+    # Then the peaks of `abc` were copied to the new song
+    WaveformStore.assert_called_once_with(redis)
+    WaveformStore.return_value.copy.assert_called_once_with('abc', 'newtoken')
+    instructions['metadata']['waveform'].should.equal({'bits': 8})
+
+
+def test_transcode_cache_lookup_miss_and_store():
+    ("TranscodeCache.lookup() should record the digest of a miss so "
+     "that store() can save the conversion result under it")
+
+    # Given an empty cache
+    redis = Mock(name='redis')
+    redis.get.return_value = None
+    cache = TranscodeCache(redis)
+
+    # And an audio with a known digest
+    audio = Mock(name='audio')
+    audio.get_digest.return_value = 'd1g3st'
+
+    # When I look it up
+    instructions = {'token': 'abc'}
+    cache.lookup(instructions, audio).should.be.false
+
+    # Then the digest is kept out of the metadata saved with the song
+    instructions['transcode_digest'].should.equal('d1g3st')
+    instructions['metadata'].should.be.empty
+
+    # When I store the result of the conversion
+    instructions['url'] = 'http://s3/abc:song.ogg'
+    instructions['metadata'].update({
+        'final_path': '/tmp/song.aiff.ogg',
+        'key_name': 'abc:song.ogg',
+    })
+    cache.store(instructions)
+
+    # Then the token, url and metadata were saved without the local path
+    key, raw = redis.set.call_args[0]
+    key.should.equal('cache:transcode:d1g3st')
+    json.loads(raw).should.equal({
+        'token': 'abc',
+        'url': 'http://s3/abc:song.ogg',
+        'metadata': {'key_name': 'abc:song.ogg'},
+    })
+
+
+def test_upload_s3_skips_cached_conversions():
+    ("StoreSong should not upload songs that were found in the transcode cache")
+
+    # Given a StoreSong step that mocks store_file
+    step = StoreSong(Mock(), Mock(), Mock(), Mock())
+    step.store_file = Mock(name='store_file')
+    step.produce = Mock(name='produce')
+
+    # When it consumes a cached song
+    instructions = {'metadata': {'cached': True}}
+    step.consume(instructions)
+
+    # Then nothing was uploaded
+    step.store_file.called.should.be.false
+
+    # And the song was passed along
+    step.produce.assert_called_once_with(instructions)
+
+
+@patch('oggweed.workers.StepTimer')
+def test_steps_stop_their_timer_before_producing(StepTimer):
+    ("Steps should stop timing a song before it goes to the next queue, "
+     "stamping when it was enqueued")
+
+    # Given a StoreSong step that consumes a cached song
+    produce_queue = Mock(name='produce_queue')
+    step = StoreSong(Mock(), produce_queue, Mock(), Mock())
+    instructions = {'token': 'abc', 'metadata': {'cached': True}}
+    step.consume(instructions)
+
+    # Then the song was timed as StoreSong
+    StepTimer.assert_called_once_with('StoreSong', instructions)
+    timer = StepTimer.return_value
+    timer.start.assert_called_once_with()
+    timer.stop.assert_called_once_with()
+
+    # And it was enqueued with a timestamp for the next step
+    produce_queue.put.assert_called_once_with(instructions)
+    instructions.should.have.key('enqueued_at')
+    step.get_timers().should.be.empty
+
+
+class FakeMultipart(object):
+    """Just enough of boto's MultiPartUpload to record the parts"""
+    id = 'upl0ad1d'
+
+    def __init__(self, key_name):
+        self.key_name = key_name
+        self.parts = {}
+        self.sent = []
+        self.completed = False
+        self.cancelled = False
+
+    def __iter__(self):
+        return iter(self.parts.values())
+
+    def add_part(self, part_num, data):
+        self.parts[part_num] = Mock(
+            part_number=part_num, size=len(data),
+            etag='"{0}"'.format(md5(data).hexdigest()))
+
+    def upload_part_from_file(self, fp, part_num, size):
+        self.sent.append(part_num)
+        self.add_part(part_num, fp.read(size))
+
+    def complete_upload(self):
+        self.completed = True
+
+    def cancel_upload(self):
+        self.cancelled = True
+
+
+def make_local_file(data):
+    local = tempfile.NamedTemporaryFile()
+    local.write(data)
+    local.flush()
+    return local
+
+
+def test_resumable_upload_sends_every_part():
+    ("ResumableUpload should split the file in parts and upload all of them")
+
+    # Given a 10 bytes local file
+    local = make_local_file(b'0123456789')
+
+    # And a bucket without unfinished uploads
+    bucket = Mock(name='bucket')
+    bucket.get_all_multipart_uploads.return_value = []
+    multipart = FakeMultipart('abc:song.ogg')
+    bucket.initiate_multipart_upload.return_value = multipart
+
+    # And an upload of 4 bytes parts
+    class TinyUpload(ResumableUpload):
+        minimum_part_size = 4
+
+    callback = Mock(name='callback')
+    upload = TinyUpload(bucket, 'abc:song.ogg', local.name,
+                        concurrency=2, callback=callback)
+
+    # When I run it
+    upload.run()
+
+    # Then all the 3 parts were uploaded
+    sorted(multipart.parts.keys()).should.equal([1, 2, 3])
+    [multipart.parts[n].size for n in [1, 2, 3]].should.equal([4, 4, 2])
+
+    # And the upload was completed
+    multipart.completed.should.be.true
+
+    # And the progress reached the total size
+    callback.assert_called_with(10, 10)
+
+
+def test_resumable_upload_resumes_unfinished_uploads():
+    ("ResumableUpload should only send the parts that a previous "
+     "attempt did not upload")
+
+    # Given a 10 bytes local file
+    local = make_local_file(b'0123456789')
+
+    # And an unfinished upload that already has the first part
+    multipart = FakeMultipart('abc:song.ogg')
+    multipart.add_part(1, b'0123')
+
+    bucket = Mock(name='bucket')
+    bucket.get_all_multipart_uploads.return_value = [multipart]
+
+    class TinyUpload(ResumableUpload):
+        minimum_part_size = 4
+
+    # When I run the upload
+    TinyUpload(bucket, 'abc:song.ogg', local.name).run()
+
+    # Then no new upload was initiated
+    bucket.initiate_multipart_upload.called.should.be.false
+
+    # And only the 2 missing parts were sent
+    sorted(multipart.sent).should.equal([2, 3])
+
+    # And the upload was completed
+    multipart.completed.should.be.true
+
+
+@patch('oggweed.workers.TranscodeCache')
+@patch('oggweed.workers.finished_songs')
+@patch('oggweed.workers.storage.Key')
+@patch('oggweed.workers.storage.boto')
+def test_upload_s3_reuses_connection_and_bucket(boto, Key, finished_songs, TranscodeCache):
+    ("StoreSong should connect to S3 and look the bucket up only "
+     "for the first song of the process")
+
+    # Given a small local file
+    local = make_local_file(b'ogg')
+
+    # And a StoreSong step with its own connection cache
+    step = StoreSong(Mock(), Mock(), Mock(), Mock())
+    step.produce = Mock(name='produce')
+
+    with patch('oggweed.workers.storage.connections', S3Connections()):
+        # When it uploads 3 songs
+        songs = [{
+            'token': token,
+            'filename': '/tmp/song.aiff',
+            'metadata': {'final_path': local.name},
+        } for token in ['one', 'two', 'three']]
+
+        for instructions in songs:
+            step.consume(instructions)
+
+    # Then the first song paid for the connection and the bucket lookup
+    [s['metadata']['storage_setups'] for s in songs].should.equal([2, 0, 0])
+
+    # And boto was only called once
+    boto.connect_s3.assert_called_once_with()
+    boto.connect_s3.return_value.lookup.assert_called_once_with('oggweed')
+
+
+@patch('oggweed.workers.storage.boto')
+def test_s3_connections_count_the_setups_of_each_thread(boto):
+    ("S3Connections.get_thread_setups() should only count the setups "
+     "made by the calling thread")
+
+    # Given a connection cache
+    connections = S3Connections()
+
+    # When another thread connects and looks a bucket up
+    thread = threading.Thread(target=connections.get_bucket, args=('oggweed', ))
+    thread.start()
+    thread.join()
+
+    # Then they count for the process but not for this thread
+    connections.setups.should.equal(2)
+    connections.get_thread_setups().should.equal(0)
+
+    # And this thread only pays for what it sets up itself
+    connections.get_bucket('other')
+    connections.get_thread_setups().should.equal(1)
+
+
+@patch('oggweed.workers.storage.boto')
+def test_s3_connections_reset_creates_a_new_connection(boto):
+    ("S3Connections.reset() should drop the cached connection and buckets")
+
+    # Given a connection cache that already looked a bucket up
+    connections = S3Connections()
+    connections.get_bucket('oggweed')
+
+    # When I reset it and look the bucket up again
+    connections.reset()
+    connections.get_bucket('oggweed')
+
+    # Then it should have connected twice
+    boto.connect_s3.call_count.should.equal(2)
+    connections.setups.should.equal(4)
+
+
+@patch('oggweed.workers.time')
+def test_progress_reporter_coalesces_updates(time):
+    ("ProgressReporter should write at most one update per `step` "
+     "percent, in a single pipeline that also publishes it")
+
+    # Background: every update happens 1 second after the previous one
+    time.time.side_effect = range(1000)
+
+    # Given a progress reporter
+    redis = Mock(name='redis')
+    progress = ProgressReporter('abc', 's3', redis=redis, interval=1, step=10)
+
+    # When it gets 100 updates
+    for sent in range(1, 101):
+        progress.update(sent, 100)
+
+    progress.flush()
+
+    # Then it should have written 11 times: 1%, 11%, 21%... and 100%
+    progress.writes.should.equal(11)
+
+    # And each write set the key and published the event together
+    pipe = redis.pipeline.return_value
+    event = '{"total": 100, "done": 100, "stage": "s3"}'
+    pipe.set.assert_called_with('song:abc:s3:progress', event)
+    pipe.publish.assert_called_with('song:abc:events', event)
+    pipe.execute.call_count.should.equal(11)
+
+
+def test_progress_reporter_stores_the_speed_and_bitrate():
+    ("ProgressReporter should store the extra fields of an update, like "
+     "the speed and bitrate of ffmpeg, with the progress")
+
+    redis = Mock(name='redis')
+    progress = ProgressReporter('abc', 'convert', redis=redis)
+
+    progress.update(50.0, 100.0, speed=25.0, bitrate=b'120.1kbits/s')
+
+    key, value = redis.pipeline.return_value.set.call_args[0]
+    key.should.equal('song:abc:convert:progress')
+    json.loads(value).should.equal({
+        'stage': 'convert',
+        'done': 50.0,
+        'total': 100.0,
+        'speed': 25.0,
+        'bitrate': '120.1kbits/s',
+    })
+
+
+@patch('oggweed.workers.time')
+def test_progress_reporter_unknown_total(time):
+    ("ProgressReporter should only throttle by time when the total is unknown")
+
+    # Background: every update happens half a second after the previous one
+    time.time.side_effect = [x / 2.0 for x in range(1000)]
+
+    # Given a progress reporter that writes every 5 seconds
+    redis = Mock(name='redis')
+    progress = ProgressReporter('abc', 's3', redis=redis, interval=5, step=10)
+
+    # When it gets 100 updates without a total
+    for sent in range(100):
+        progress.update(sent, None)
+
+    # Then it should have written once every 5 of the 50 seconds
+    progress.writes.should.equal(10)
+
+
+@patch('oggweed.workers.Song')
+def test_song_batch_saves_songs_in_groups(Song):
+    ("SongBatch should save the pending songs together once it has `size` of them")
+
+    # Given a batch of 2 songs that would wait for a long time
+    batch = SongBatch(2, max_wait=60)
+
+    # When I add 3 songs
+    batch.add('one')
+    batch.add('two')
+    batch.add('three')
+
+    # Then the first 2 were saved together
+    Song.save_many.assert_called_once_with(['one', 'two'])
+
+    # And the third is saved when the batch is flushed
+    timer = batch.timer
+    batch.flush()
+    Song.save_many.assert_called_with(['three'])
+
+    # And its timer was cancelled
+    timer.join()
+    batch.timer.should.be.none
+
+
+@patch('oggweed.workers.Song')
+def test_song_batch_calls_back_after_saving(Song):
+    ("SongBatch should call `on_saved` with the songs it just saved")
+
+    on_saved = Mock(name='on_saved')
+    batch = SongBatch(2, max_wait=60, on_saved=on_saved)
+
+    batch.add('one')
+    on_saved.called.should.be.false
+
+    batch.add('two')
+    on_saved.assert_called_once_with(['one', 'two'])
+
+
+def test_upload_s3_stores_every_rendition():
+    ("StoreSong.store_file() should upload every rendition and record "
+     "its key and url in the metadata")
+
+    # Given a StoreSong step that mocks the upload of each file
+    step = StoreSong(Mock(), Mock(), Mock(), Mock())
+    step.upload_file = Mock(name='upload_file', side_effect=lambda i, path, **kw: (
+        'abc:' + path, 'http://s3/' + path))
+
+    # When it stores a song with 2 renditions
+    instructions = {
+        'token': 'abc',
+        'metadata': {
+            'final_path': 'song.ogg',
+            'renditions': {
+                'high': {'final_path': 'song.ogg'},
+                'mobile': {'final_path': 'song.mobile.ogg'},
+            },
+        },
+    }
+    step.store_file(instructions)
+
+    # Then each file was uploaded once
+    step.upload_file.call_count.should.equal(2)
+
+    # And the renditions know where they were stored
+    instructions['metadata']['renditions'].should.equal({
+        'high': {'final_path': 'song.ogg',
+                 'key_name': 'abc:song.ogg',
+                 'url': 'http://s3/song.ogg'},
+        'mobile': {'final_path': 'song.mobile.ogg',
+                   'key_name': 'abc:song.mobile.ogg',
+                   'url': 'http://s3/song.mobile.ogg'},
+    })
+
+    # And the song url is the one of the first rendition
+    instructions['url'].should.equal('http://s3/song.ogg')
+
+
+def test_retry_queue_backs_off_exponentially():
+    ("RetryQueue.fail() should schedule each attempt twice as far as "
+     "the previous one, up to the max delay")
+
+    redis = Mock()
+    queue = RetryQueue(redis=redis, max_attempts=10, base_delay=5, max_delay=30)
+    instructions = {'token': 'abc'}
+
+    def fail():
+        instructions['__lineup__error__'] = {'traceback': 'boom'}
+        return queue.fail(instructions, now=100)
+
+    [fail() for _ in range(4)].should.equal([105, 110, 120, 130])
+
+    # And the error was moved out of the lineup key
+    instructions['attempts'].should.equal(4)
+    instructions['last_error'].should.equal('boom')
+    instructions.shouldnt.have.key('__lineup__error__')
+
+
+def test_retry_queue_buries_songs_that_keep_failing():
+    ("RetryQueue.fail() should push the song to the dead-letter list "
+     "after max_attempts failures")
+
+    redis = Mock()
+    queue = RetryQueue(redis=redis, max_attempts=2, base_delay=5, max_delay=30)
+    instructions = {'token': 'abc', 'attempts': 1, 'leased': True}
+
+    queue.fail(instructions, now=100).should.be.none
+    redis.lpush.assert_called_once_with('deadletter:songs', json.dumps(instructions))
+    redis.zadd.called.should.be.false
+    redis.publish.assert_called_once_with(
+        'song:abc:events', json.dumps({'stage': 'failed', 'attempts': 2}))
+
+    # And its lease was released
+    instructions.shouldnt.have.key('leased')
+    redis.pipeline.return_value.zrem.assert_called_once_with('leases:songs', 'abc')
+
+    # And its staged files can be evicted
+    redis.pipeline.return_value.zadd.assert_called_once_with('staging:finalized', 100, 'abc')
+
+
+def test_retry_queue_pump_hands_due_songs_to_the_scheduler():
+    ("RetryQueue.pump() should reschedule the due songs that no other "
+     "worker took")
+
+    redis = Mock()
+    converted = {'token': 'one', 'checkpoints': {'convert': {'files': {}}}}
+    fresh = {'token': 'two', 'estimated_cost': 300}
+    taken = {'token': 'three'}
+    redis.zrangebyscore.return_value = [json.dumps(s) for s in (converted, fresh, taken)]
+    redis.zrem.side_effect = [1, 1, 0]
+    scheduler = Mock()
+
+    RetryQueue(redis=redis).pump(scheduler, now=100).should.have.length_of(2)
+
+    redis.zrangebyscore.assert_called_once_with('retry:songs', '-inf', 100)
+    scheduler.push_again.assert_has_calls([
+        call(converted),
+        call(fresh),
+    ])
+
+
+@patch('oggweed.workers.TranscodeCache')
+@patch('oggweed.workers.OggConverter')
+def test_anything_to_ogg_resumes_from_its_checkpoint(OggConverter, TranscodeCache):
+    ("AnythingToOgg should skip ffmpeg when the converted file of a "
+     "retried song is still intact")
+
+    # Given a song that was converted before its upload failed
+    local = make_local_file(b'ogg')
+    instructions = {
+        'token': 'abc',
+        'filename': '/tmp/song.aiff',
+        'transcode_digest': 'd1g',
+        'metadata': {},
+        'checkpoints': {'convert': {
+            'files': {local.name: file_sha1(local.name)},
+            'metadata': {'final_path': local.name},
+            'converted_at': 10,
+        }},
+    }
+
+    # When an AnythingToOgg step processes it again
+    step = AnythingToOgg(Mock(), Mock(), Mock(), Mock())
+    step.produce = Mock(name='produce')
+    step.process(instructions)
+
+    # Then nothing was converted
+    OggConverter.return_value.convert.called.should.be.false
+    TranscodeCache.return_value.lookup.called.should.be.false
+
+    # And the song went on with the checkpointed metadata
+    step.produce.assert_called_once_with(instructions)
+    instructions['metadata']['final_path'].should.equal(local.name)
+    instructions['converted_at'].should.equal(10)
+
+
+@patch('oggweed.workers.StagingArea')
+@patch('oggweed.workers.TranscodeCache')
+@patch('oggweed.workers.OggConverter')
+def test_anything_to_ogg_converts_again_when_the_checkpoint_changed(OggConverter, TranscodeCache,
+                                                                   StagingArea):
+    ("AnythingToOgg should not trust a checkpoint whose file "
+     "changed since the conversion")
+
+    local = make_local_file(b'ogg')
+    TranscodeCache.return_value.lookup.return_value = False
+    OggConverter.return_value.convert.return_value = {'final_path': local.name}
+    OggConverter.return_value.waveform_levels = None
+    instructions = {
+        'token': 'abc',
+        'filename': '/tmp/song.aiff',
+        'metadata': {},
+        'checkpoints': {'convert': {
+            'files': {local.name: 'not-the-sha1'},
+            'metadata': {},
+            'converted_at': 10,
+        }},
+    }
+
+    step = AnythingToOgg(Mock(), Mock(), Mock(), Mock())
+    step.produce = Mock(name='produce')
+    step.process(instructions)
+
+    OggConverter.return_value.convert.assert_called_once_with()
+
+    # And the new files were checkpointed
+    instructions['checkpoints']['convert']['files'].should.equal({
+        local.name: file_sha1(local.name),
+    })
+
+    # And counted in the staging area
+    StagingArea.return_value.add.assert_called_once_with('abc', set([local.name]))
+
+
+@patch('oggweed.workers.TranscodeCache')
+@patch('oggweed.workers.finished_songs')
+def test_upload_s3_resumes_from_its_checkpoint(finished_songs, TranscodeCache):
+    ("StoreSong should not upload the files of a song that only "
+     "failed after they were stored")
+
+    step = StoreSong(Mock(), Mock(), Mock(), Mock())
+    step.store_file = Mock(name='store_file')
+    step.produce = Mock(name='produce')
+
+    instructions = {
+        'token': 'abc',
+        'filename': '/tmp/song.aiff',
+        'metadata': {},
+        'checkpoints': {'store': {
+            'url': 'http://s3/song.ogg',
+            'finalized_at': 20,
+            'metadata': {'key_name': 'abc:song.ogg'},
+        }},
+    }
+    step.consume(instructions)
+
+    step.store_file.called.should.be.false
+    instructions['url'].should.equal('http://s3/song.ogg')
+    step.produce.assert_called_once_with(instructions)
+
+
+@patch('oggweed.workers.TranscodeCache')
+@patch('oggweed.workers.finished_songs')
+def test_upload_s3_migrates_the_s3_checkpoint(finished_songs, TranscodeCache):
+    ("StoreSong should resume songs checkpointed under the old `s3` "
+     "name, and report its progress under the `s3` stage")
+
+    # Given a song retried from before the checkpoint was renamed
+    step = StoreSong(Mock(), Mock(), Mock(), Mock())
+    step.store_file = Mock(name='store_file')
+    step.produce = Mock(name='produce')
+    instructions = {
+        'token': 'abc',
+        'metadata': {},
+        'checkpoints': {'s3': {
+            'url': 'http://s3/song.ogg',
+            'finalized_at': 20,
+            'metadata': {'key_name': 'abc:song.ogg'},
+        }},
+    }
+
+    # When it is consumed
+    step.consume(instructions)
+
+    # Then nothing was uploaded again and the checkpoint got its new name
+    step.store_file.called.should.be.false
+    instructions['checkpoints'].keys().should.equal(['store'])
+
+    # And the progress keeps its key
+    step.get_progress_reporter(instructions).key.should.equal('song:abc:s3:progress')
+
+
+def test_ogg_converter_digest_uses_the_upload_sha1():
+    ("OggConverter.get_digest() should not read the source again "
+     "when its sha1 was computed during the upload")
+
+    # Given the digest of a file that gets read
+    local = make_local_file(b'audio')
+    expected = OggConverter(local.name).get_digest()
+
+    # When the sha1 from the upload is given
+    audio = OggConverter(local.name, source_digest=file_sha1(local.name))
+    with patch('oggweed.workers.file_sha1') as file_sha1_mock:
+        digest = audio.get_digest()
+
+    # Then the digest is the same without reading the file
+    digest.should.equal(expected)
+    file_sha1_mock.called.should.be.false
+
+
+@patch('oggweed.workers.StagingArea')
+@patch('oggweed.workers.ProgressReporter')
+@patch('oggweed.workers.connections')
+def test_fetch_from_s3_downloads_direct_uploads(connections, ProgressReporter, StagingArea):
+    ("FetchFromS3 should download the source of a direct upload to "
+     "its filename and record its sha1")
+
+    folder = tempfile.mkdtemp()
+    key = connections.get_bucket.return_value.get_key.return_value
+    key.get_contents_to_file.side_effect = lambda fd, **kw: fd.write(b'AIFF')
+
+    step = FetchFromS3(Mock(), Mock(), Mock(), Mock())
+    step.produce = Mock(name='produce')
+    instructions = {
+        'token': 'abc',
+        'filename': os.path.join(folder, 'abc', 'set.aiff'),
+        'source_key': 'uploads/abc/set.aiff',
+    }
+    try:
+        step.consume(instructions)
+        step.get_slots().join()
+
+        open(instructions['filename'], 'rb').read().should.equal(b'AIFF')
+        os.listdir(os.path.join(folder, 'abc')).should.equal(['set.aiff'])
+    finally:
+        shutil.rmtree(folder)
+
+    connections.get_bucket.return_value.get_key.assert_called_once_with('uploads/abc/set.aiff')
+    instructions['source_sha1'].should.equal(sha1(b'AIFF').hexdigest())
+    instructions['checkpoints']['fetch'].should.equal({
+        'source_sha1': sha1(b'AIFF').hexdigest(),
+    })
+    step.produce.assert_called_once_with(instructions)
+    StagingArea.return_value.add.assert_called_once_with('abc', [instructions['filename']])
+
+
+@patch('oggweed.workers.connections')
+def test_fetch_from_s3_passes_web_uploads_through(connections):
+    ("FetchFromS3 should not touch songs uploaded through the web tier")
+
+    step = FetchFromS3(Mock(), Mock(), Mock(), Mock())
+    step.produce = Mock(name='produce')
+    instructions = {'token': 'abc', 'filename': '/tmp/song.aiff'}
+
+    step.consume(instructions)
+
+    connections.get_bucket.called.should.be.false
+    step.produce.assert_called_once_with(instructions)
+
+
+@patch('oggweed.workers.StagingArea')
+@patch('oggweed.workers.ProgressReporter')
+@patch('oggweed.workers.connections')
+def test_fetch_from_s3_downloads_concurrently(connections, ProgressReporter, StagingArea):
+    ("FetchFromS3 should download several direct uploads at the same "
+     "time, in slots of their own")
+
+    # Background: every download waits until both started
+    started = threading.Semaphore(0)
+    both_started = threading.Event()
+
+    def download(fd, **kw):
+        started.release()
+        both_started.wait(5)
+        fd.write(b'AIFF')
+
+    key = connections.get_bucket.return_value.get_key.return_value
+    key.get_contents_to_file.side_effect = download
+
+    # Given a FetchFromS3 step with two slots
+    folder = tempfile.mkdtemp()
+    step = FetchFromS3(Mock(), Mock(), Mock(), Mock())
+    step.slots = ConversionSlots(2)
+    step.produce = Mock(name='produce')
+
+    # When it consumes two songs
+    songs = [{'token': token, 'source_key': 'uploads/{0}/set.aiff'.format(token),
+              'filename': os.path.join(folder, token, 'set.aiff')}
+             for token in ('abc', 'def')]
+    try:
+        for instructions in songs:
+            step.consume(instructions)
+
+        # Then both downloads were in flight at the same time
+        started.acquire()
+        started.acquire()
+        both_started.set()
+        step.get_slots().join()
+    finally:
+        shutil.rmtree(folder)
+
+    step.produce.call_count.should.equal(2)
+
+
+@patch('oggweed.workers.storage.settings')
+@patch('oggweed.workers.storage.boto')
+def test_s3_connections_can_point_to_a_local_stand_in(boto, settings):
+    ("S3Connections should connect to settings.S3_HOST with path "
+     "style urls when it is set")
+
+    settings.S3_HOST = 'localhost'
+    settings.S3_PORT = 4567
+    settings.S3_SECURE = False
+
+    S3Connections().get_connection()
+
+    kwargs = boto.connect_s3.call_args[1]
+    kwargs['host'].should.equal('localhost')
+    kwargs['port'].should.equal(4567)
+    kwargs['is_secure'].should.be.false
+    kwargs['calling_format'].__class__.__name__.should.equal('OrdinaryCallingFormat')
+
+
+def vorbis_probe(bit_rate, sample_rate=44100, format_name='ogg', streams=1):
+    return {
+        'format': {'format_name': format_name, 'duration': '125.5',
+                   'bit_rate': str(bit_rate)},
+        'streams': [{'codec_type': 'audio', 'codec_name': 'vorbis',
+                     'channels': 2, 'sample_rate': str(sample_rate),
+                     'bit_rate': str(bit_rate)}] * streams,
+    }
+
+
+@patch('oggweed.workers.settings')
+def test_probe_kills_ffprobe_after_its_timeout(settings):
+    ("probe() should kill an ffprobe that takes longer than its "
+     "timeout instead of waiting on it")
+
+    # Given an ffprobe that hangs
+    folder = tempfile.mkdtemp()
+    settings.FFPROBE_BIN = os.path.join(folder, 'ffprobe')
+    with open(settings.FFPROBE_BIN, 'w') as fd:
+        fd.write('#!/bin/sh\nexec sleep 10\n')
+    os.chmod(settings.FFPROBE_BIN, 0o755)
+
+    # When I probe a file with a short timeout
+    try:
+        probe.when.called_with('song.mp3', timeout=0.1).should.throw(
+            subprocess.CalledProcessError)
+    finally:
+        shutil.rmtree(folder)
+
+
+@patch('oggweed.workers.probe')
+def test_ogg_converter_plans_the_encode_path(probe):
+    ("OggConverter.plan() should copy the vorbis audio that suits a "
+     "profile and only encode the others")
+
+    audio = OggConverter('/tmp/song.ogg')
+    outputs = audio.get_outputs('/tmp/out.ogg')
+
+    # A 48kbps ogg vorbis file at 32kHz suits every profile
+    probe.return_value = vorbis_probe(48000, sample_rate=32000)
+    audio.plan(outputs).should.equal('passthrough')
+
+    # Unless it has a cover art stream
+    probe.return_value = vorbis_probe(48000, sample_rate=32000, streams=2)
+    audio.plan(outputs).should.equal('remux')
+
+    # Or lives in another container
+    probe.return_value = vorbis_probe(48000, sample_rate=32000, format_name='matroska,webm')
+    audio.plan(outputs).should.equal('remux')
+
+    # At 128kbps and 44.1kHz only the mobile profile gets encoded
+    probe.return_value = vorbis_probe(128000)
+    audio.plan(outputs).should.equal('transcode')
+    audio.copies.should.equal(set(['high', 'standard']))
+
+    command = audio.get_multi_args(outputs)
+    position = command.index('/tmp/out.ogg')
+    command[position - 4:position].should.equal(['-acodec', 'copy', '-f', 'ogg'])
+    command[-1].should.equal('/tmp/out.mobile.ogg')
+    command[-3:-1].should.equal(['-f', 'ogg'])
+    command.count('copy').should.equal(2)
+
+    # And anything that is not vorbis gets encoded
+    probe.return_value['streams'][0]['codec_name'] = 'mp3'
+    audio.plan(outputs).should.equal('transcode')
+    audio.copies.should.be.empty
+
+
+@patch('oggweed.workers.subprocess')
+@patch('oggweed.workers.probe')
+def test_ogg_converter_passes_suitable_files_through(probe, subprocess):
+    ("OggConverter.convert() should copy a source that suits every "
+     "profile without running ffmpeg")
+
+    probe.return_value = vorbis_probe(48000, sample_rate=32000)
+    local = make_local_file(b'OggS')
+    final_path = local.name + '.ogg'
+    try:
+        metadata = OggConverter(local.name).convert(final_path)
+        open(final_path, 'rb').read().should.equal(b'OggS')
+    finally:
+        os.remove(final_path)
+
+    subprocess.Popen.called.should.be.false
+    metadata['encode_path'].should.equal('passthrough')
+    metadata['duration'].should.equal('00:02:05.50')
+    metadata['bitrate'].should.equal('48 kb/s')
+    metadata['source']['codec_name'].should.equal('vorbis')
+    set(r['final_path'] for r in metadata['renditions'].values()).should.equal(
+        set([final_path]))
+
+
+def fake_ffmpeg(stdout=b'', pcm=b'', returncode=0):
+    """A Popen that writes `pcm` to the pipe of the waveform, if any:
+    the output that follows the `-f s16le` of `Waveform.get_output_args`"""
+    def popen(command, **kw):
+        for position, arg in enumerate(command[:-2]):
+            target = command[position + 2]
+            if (arg == '-f' and command[position + 1] in ('s16le', 's16be') and
+                    target.startswith('pipe:')):
+                os.write(int(target.split(':')[1]), pcm)
+
+        process = Mock(name='ffmpeg')
+        process.stdout = BytesIO(stdout)
+        process.stderr = BytesIO(b'')
+        process.wait.return_value = returncode
+        return process
+
+    return popen
+
+
+@patch('oggweed.workers.probe')
+@patch('oggweed.workers.subprocess')
+def test_ogg_converter_computes_the_waveform_while_converting(subprocess, probe):
+    ("OggConverter should compute the peaks from pcm that the same "
+     "ffmpeg writes to a pipe, decoding the source only once")
+
+    probe.side_effect = OSError('ffprobe')
+
+    # Background: ffmpeg writes 8 samples to the pcm pipe
+    pcm = array(b'h', [1, 2, -3, 4, 5, -6, 7, 8]).tostring()
+    subprocess.Popen.side_effect = fake_ffmpeg(stdout=b'OggS', pcm=pcm)
+
+    # Given an OggConverter that wants a waveform
+    waveform = Waveform('/tmp/song.aiff', sample_rate=8000,
+                        samples_per_peak=2, levels=2, bits=8)
+    audio = OggConverter('/tmp/song.aiff', waveform=waveform)
+
+    # When I stream it
+    list(audio.stream()).should.equal([b'OggS'])
+
+    # Then ffmpeg ran once, with the pcm output right after the input
+    subprocess.Popen.call_count.should.equal(1)
+    command = subprocess.Popen.call_args[0][0]
+    command[command.index('/tmp/song.aiff') + 1:][:2].should.equal(
+        ['-map', '0:a:0'])
+    command[-3:].should.equal(['-f', 'ogg', 'pipe:1'])
+
+    # And the peaks of every zoom level are available
+    [list(peaks) for peaks in audio.waveform_levels].should.equal([
+        [-3, 4, -6, 8],
+        [1, 2, -3, 4, -6, 5, 7, 8],
+    ])
+
+
+@patch('oggweed.workers.subprocess')
+def test_ogg_converter_without_pcm_has_no_waveform(subprocess):
+    ("OggConverter should leave the song without a waveform when "
+     "ffmpeg wrote no samples")
+
+    subprocess.Popen.side_effect = fake_ffmpeg(stdout=b'OggS', pcm=b'\x01')
+    audio = OggConverter('/tmp/song.aiff', waveform=Waveform('/tmp/song.aiff'))
+
+    list(audio.stream()).should.equal([b'OggS'])
+    audio.waveform_levels.should.be.none
+
+
+@patch('oggweed.workers.Song')
+@patch('oggweed.workers.finished_songs')
+@patch('oggweed.workers.WaveformStore')
+@patch('oggweed.workers.get_redis_connection')
+@patch('oggweed.workers.subprocess')
+def test_streaming_pipeline_saves_the_waveform(subprocess, get_redis_connection,
+                                               WaveformStore, finished_songs, Song):
+    ("StreamingOggPipeline should save songs with the waveform that was "
+     "computed while streaming them to the storage")
+
+    # Background: the transcode cache is empty
+    get_redis_connection.return_value.get.return_value = None
+
+    # And ffmpeg writes the audio and its pcm
+    pcm = array(b'h', range(-512, 512)).tostring()
+    subprocess.Popen.side_effect = fake_ffmpeg(stdout=b'OggS', pcm=pcm)
+    WaveformStore.return_value.store.return_value = {'bits': 8, 'levels': []}
+
+    # And a storage that reads the stream
+    storage = Mock(name='storage')
+    storage.setups = 0
+    storage.store_stream.side_effect = lambda key_name, chunks, progress: (
+        list(chunks) and 'http://media/{0}'.format(key_name))
+
+    # Given the steps of the streaming pipeline
+    fetch, stream = [step(Mock(), Mock(), Mock(), Mock())
+                     for step in StreamingOggPipeline.steps]
+    stream.storage = storage
+
+    # When a song goes through them
+    local = make_local_file(b'RIFF')
+    instructions = {'token': 'abc', 'filename': local.name,
+                    'metadata': {'original_name': 'song.aiff'}}
+    fetch.consume(instructions)
+    fetch.get_slots().join()
+    stream.consume(fetch.produce_queue.put.call_args[0][0])
+    stream.get_slots().join()
+
+    # Then the song was saved with its waveform and its metadata
+    instructions.should_not.have.key('__lineup__error__')
+    metadata = Song.call_args[1]['metadata']
+    metadata['waveform'].should.equal({'bits': 8, 'levels': []})
+    metadata['original_name'].should.equal('song.aiff')
+    metadata.should_not.have.key('transcode_digest')
+    finished_songs.add.assert_called_once_with(Song.return_value)
+    stream.produce_queue.put.assert_called_once_with(instructions)
+
+
+def make_stream_step(bucket):
+    """A StreamToStorage step that stores to an S3Storage of `bucket`,
+    whose multipart uploads are a FakeMultipart"""
+    multipart = FakeMultipart('abc:song.aiff.ogg')
+    bucket.initiate_multipart_upload.return_value = multipart
+
+    step = StreamToStorage(Mock(), Mock(), Mock(), Mock())
+    step.storage = S3Storage('oggweed')
+    step.produce = Mock(name='produce')
+    step.rollback = Mock(name='rollback')
+    return step, multipart
+
+
+@patch('oggweed.workers.ProgressReporter')
+@patch('oggweed.workers.TranscodeCache')
+@patch('oggweed.workers.finished_songs')
+@patch('oggweed.workers.OggConverter')
+@patch('oggweed.workers.storage.Key')
+@patch('oggweed.workers.storage.connections')
+def test_stream_to_storage_sends_the_stream_as_a_multipart_upload(
+        connections, Key, OggConverter, finished_songs, TranscodeCache, ProgressReporter):
+    ("StreamToStorage should send what ffmpeg writes as the parts of a "
+     "multipart upload and publish the song")
+
+    # Background: the transcode cache is empty
+    TranscodeCache.return_value.lookup.return_value = False
+
+    # And ffmpeg writes two chunks
+    audio = OggConverter.return_value
+    audio.stream.return_value = iter([b'Ogg', b'S'])
+    audio.output = {'encode_path': 'transcode'}
+    audio.waveform_levels = None
+    Key.return_value.generate_url.return_value = 'http://s3/abc:song.aiff.ogg'
+
+    # Given a StreamToStorage step that stores to S3
+    step, multipart = make_stream_step(connections.get_bucket.return_value)
+
+    # When it processes a song
+    instructions = {'token': 'abc', 'filename': '/tmp/song.aiff', 'metadata': {}}
+    step.process(instructions)
+
+    # Then the stream went up as a single part and was completed
+    multipart.sent.should.equal([1])
+    multipart.completed.should.be.true
+    multipart.cancelled.should.be.false
+
+    # And the song was published and passed along
+    instructions['url'].should.equal('http://s3/abc:song.aiff.ogg')
+    instructions['metadata']['key_name'].should.equal('abc:song.aiff.ogg')
+    instructions['metadata']['encode_path'].should.equal('transcode')
+    finished_songs.add.called.should.be.true
+    TranscodeCache.return_value.store.assert_called_once_with(instructions)
+    step.produce.assert_called_once_with(instructions)
+
+
+@patch('oggweed.workers.ProgressReporter')
+@patch('oggweed.workers.TranscodeCache')
+@patch('oggweed.workers.finished_songs')
+@patch('oggweed.workers.OggConverter')
+@patch('oggweed.workers.storage.connections')
+def test_stream_to_storage_cancels_the_upload_when_ffmpeg_fails(
+        connections, OggConverter, finished_songs, TranscodeCache, ProgressReporter):
+    ("StreamToStorage should abort the multipart upload and roll the "
+     "song back when ffmpeg fails in the middle of the stream")
+
+    TranscodeCache.return_value.lookup.return_value = False
+
+    # Background: ffmpeg fails after writing a chunk
+    def stream():
+        yield b'Ogg'
+        raise ConversionError('broken pipe')
+
+    OggConverter.return_value.stream.return_value = stream()
+
+    # Given a StreamToStorage step that stores to S3
+    step, multipart = make_stream_step(connections.get_bucket.return_value)
+
+    # When it consumes a song
+    instructions = {'token': 'abc', 'filename': '/tmp/song.aiff', 'metadata': {}}
+    step.consume(instructions)
+    step.get_slots().join()
+
+    # Then the multipart upload was aborted rather than completed
+    multipart.cancelled.should.be.true
+    multipart.completed.should.be.false
+
+    # And the song was rolled back, not published
+    step.rollback.assert_called_once_with(instructions)
+    instructions['__lineup__error__']['traceback'].should.contain('broken pipe')
+    instructions.should_not.have.key('url')
+    finished_songs.add.called.should.be.false
+    step.produce.called.should.be.false
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright © 2013 OggWeed LLC
+#
+from __future__ import unicode_literals
+import os
+import shutil
+import tempfile
+from mock import patch, Mock, call
+from oggweed.workers.storage import (
+    Storage,
+    LocalStorage,
+    S3Storage,
+    get_storage,
+)
+
+
+def make_storage():
+    root = tempfile.mkdtemp(prefix='oggweed-media-')
+    return LocalStorage(root=root, base_url='/media/')
+
+
+def test_local_storage_store_stream():
+    ("LocalStorage.store_stream() should write the chunks under the "
+     "key name and return the url the web app serves it from")
+
+    storage = make_storage()
+    progress = Mock(name='progress')
+    try:
+        url = storage.store_stream('abc:song.ogg', [b'Ogg', b'S'], progress=progress)
+
+        url.should.equal('/media/abc%3Asong.ogg')
+        with open(os.path.join(storage.root, 'abc:song.ogg'), 'rb') as stored:
+            stored.read().should.equal(b'OggS')
+
+        progress.assert_has_calls([call(3, None), call(4, None)])
+        os.listdir(storage.root).should.equal(['abc:song.ogg'])
+    finally:
+        shutil.rmtree(storage.root)
+
+
+def test_local_storage_store_file():
+    ("LocalStorage.store_file() should copy the local file")
+
+    storage = make_storage()
+    source = tempfile.NamedTemporaryFile(suffix='.ogg')
+    source.write(b'OggS' * 100)
+    source.flush()
+    try:
+        storage.store_file('abc:song.ogg', source.name)
+        os.path.getsize(storage.get_path('abc:song.ogg')).should.equal(400)
+    finally:
+        shutil.rmtree(storage.root)
+
+
+def test_local_storage_refuses_paths_outside_its_folder():
+    ("LocalStorage.get_path() should return None for key names that "
+     "escape the storage folder")
+
+    storage = LocalStorage(root='/var/oggweed/media')
+
+    storage.get_path('abc:song.ogg').should.equal('/var/oggweed/media/abc:song.ogg')
+    storage.get_path('../settings.py').should.be.none
+    storage.get_path('/etc/passwd').should.be.none
+    storage.store_stream.when.called_with('../x.ogg', []).should.throw(ValueError)
+
+
+@patch('oggweed.workers.storage.connections')
+@patch('oggweed.workers.storage.Key')
+def test_s3_storage_publishes_the_key(Key, connections):
+    ("S3Storage.store_file() should upload small files in one request "
+     "and make them public")
+
+    source = tempfile.NamedTemporaryFile(suffix='.ogg')
+    source.write(b'OggS')
+    source.flush()
+    key = Key.return_value
+    key.generate_url.return_value = 'http://oggweed.s3.amazonaws.com/abc:song.ogg'
+
+    url = S3Storage('oggweed').store_file('abc:song.ogg', source.name)
+
+    url.should.equal('http://oggweed.s3.amazonaws.com/abc:song.ogg')
+    connections.get_bucket.assert_called_once_with('oggweed')
+    Key.assert_called_once_with(connections.get_bucket.return_value, 'abc:song.ogg')
+    key.set_contents_from_filename.assert_called_once_with(source.name, cb=None)
+    key.make_public.assert_called_once_with()
+
+
+@patch('oggweed.workers.storage.settings')
+def test_get_storage_follows_the_settings(settings):
+    ("get_storage() should return the backend of settings.STORAGE_BACKEND")
+
+    settings.STORAGE_BACKEND = 'local'
+    settings.LOCAL_STORAGE_ROOT = '/tmp/media'
+    settings.LOCAL_STORAGE_URL = '/media'
+
+    get_storage().should.be.a(LocalStorage)
+    get_storage('s3').should.be.a(S3Storage)
+
+
+def test_storage_backends_implement_the_whole_interface():
+    ("Storage should refuse to build backends that miss one of its "
+     "abstract methods")
+
+    class HalfStorage(Storage):
+        def get_url(self, key_name):
+            return key_name
+
+    Storage.when.called_with().should.throw(TypeError)
+    HalfStorage.when.called_with().should.throw(TypeError)